@@ -0,0 +1,186 @@
+'''
+content-addressed cache of training libraries and trained PCA bases
+
+each entry is a `basis_store` directory, named by a hash of every input
+    that determines it. Two kinds of entry are kept:
+     - 'library': the LSF-convolved, regridded training spectra and their
+        metadata (expensive to build, independent of `q` and of the
+        wavelength limits of the fit)
+     - 'basis': a trained basis, keyed by the library key plus the
+        arguments of the fit itself
+
+CSP/SFH files enter the key through their path, size, and modification
+    time, rather than through their contents, since hashing many GB of
+    spectra would cost as much as rebuilding the library
+'''
+
+import numpy as np
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import pickle
+
+import basis_store
+
+kinds = ['library', 'basis']
+
+
+def canonical(v):
+    '''
+    convert an input into a JSON-serializable, order-independent form
+    '''
+    from astropy import units as u
+
+    if isinstance(v, u.Quantity):
+        return {'value': canonical(v.value), 'unit': v.unit.to_string()}
+    elif isinstance(v, dict):
+        return {str(k): canonical(v[k]) for k in sorted(v, key=str)}
+    elif isinstance(v, (list, tuple)):
+        return [canonical(e) for e in v]
+    elif isinstance(v, np.ndarray):
+        return canonical(v.tolist())
+    elif isinstance(v, np.generic):
+        return v.item()
+    elif (v is None) or isinstance(v, (str, int, float, bool)):
+        return v
+    else:
+        raise TypeError('cannot canonicalize {} for cache key'.format(type(v)))
+
+
+def hash_inputs(inputs):
+    '''
+    hash a dict of inputs into a hex key
+    '''
+    s = json.dumps(canonical(inputs), sort_keys=True)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def file_signature(fname):
+    '''
+    cheap stand-in for a file's contents
+    '''
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_size, st.st_mtime_ns]
+
+
+def callable_signature(f):
+    '''
+    signature of an object used in building the library (e.g., an LSF)
+
+    objects may define a `signature` method; otherwise, their pickled bytes
+        are hashed
+    '''
+    if f is None:
+        return None
+    elif hasattr(f, 'signature'):
+        return f.signature()
+    else:
+        return hashlib.sha1(pickle.dumps(f)).hexdigest()
+
+
+def dir_size(d):
+    return sum(os.path.getsize(os.path.join(dp, fn))
+               for dp, _, fns in os.walk(d) for fn in fns)
+
+
+class BasisCache(object):
+    '''
+    directory of cached libraries and bases, with eviction by age and size
+
+    params:
+     - cache_dir: root directory of the cache
+     - max_age: entries unused for this many seconds are evicted
+     - max_bytes: least-recently-used entries are evicted until the
+        cache is no larger than this
+    '''
+    def __init__(self, cache_dir, max_age=None, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+        for kind in kinds:
+            d = os.path.join(cache_dir, kind)
+            if not os.path.isdir(d):
+                os.makedirs(d, exist_ok=True)
+
+    def key(self, inputs):
+        return hash_inputs(inputs)
+
+    def entry_dir(self, kind, key):
+        if kind not in kinds:
+            raise ValueError('unknown cache entry kind: {}'.format(kind))
+        return os.path.join(self.cache_dir, kind, key)
+
+    def has(self, kind, key):
+        return basis_store.basis_exists(self.entry_dir(kind, key))
+
+    def touch(self, kind, key):
+        '''
+        record use of an entry (the manifest's mtime is its last use)
+        '''
+        try:
+            os.utime(os.path.join(self.entry_dir(kind, key),
+                                  basis_store.MANIFEST_FNAME))
+        except FileNotFoundError:
+            pass
+
+    def lookup(self, kind, key):
+        '''
+        directory of entry if it exists (recording its use), else None
+        '''
+        if not self.has(kind, key):
+            return None
+        self.touch(kind, key)
+        return self.entry_dir(kind, key)
+
+    def entries(self):
+        '''
+        list of (kind, key, last use, size in bytes) for all complete entries
+        '''
+        ents = []
+        for kind in kinds:
+            kind_dir = os.path.join(self.cache_dir, kind)
+            for key in os.listdir(kind_dir):
+                # skip partially-written entries
+                if key.startswith('.'):
+                    continue
+                d = os.path.join(kind_dir, key)
+                manifest = os.path.join(d, basis_store.MANIFEST_FNAME)
+                if not os.path.isfile(manifest):
+                    continue
+                ents.append((kind, key, os.path.getmtime(manifest), dir_size(d)))
+        return ents
+
+    def evict(self, now=None):
+        '''
+        remove stale entries, then least-recently-used entries over size budget
+
+        returns list of (kind, key) evicted
+        '''
+        if now is None:
+            now = time.time()
+
+        ents = sorted(self.entries(), key=lambda e: e[2])
+        evicted = []
+
+        if self.max_age is not None:
+            for e in ents:
+                if now - e[2] > self.max_age:
+                    evicted.append(e)
+            ents = [e for e in ents if e not in evicted]
+
+        if self.max_bytes is not None:
+            total = sum(e[3] for e in ents)
+            for e in ents:
+                if total <= self.max_bytes:
+                    break
+                evicted.append(e)
+                total -= e[3]
+
+        for kind, key, *_ in evicted:
+            shutil.rmtree(self.entry_dir(kind, key), ignore_errors=True)
+
+        return [(kind, key) for kind, key, *_ in evicted]
@@ -0,0 +1,201 @@
+'''
+on-disk, memory-mappable storage for a trained PCA basis
+
+a basis directory holds one `.npy` file per array, plus a JSON manifest
+    describing the arrays, the metadata columns (and their `meta` dicts),
+    and the scalar properties of the training library. Arrays are opened
+    with `mmap_mode='r'`, so many worker processes can share the same pages
+    through the OS cache rather than each holding a private copy
+'''
+
+import numpy as np
+
+import os
+import json
+import shutil
+import tempfile
+
+BASIS_FORMAT_VERSION = 1
+MANIFEST_FNAME = 'manifest.json'
+
+# arrays that every basis must provide
+required_arrays = ['l', 'logl', 'M', 'PCs', 'trn_PC_wts']
+# arrays written if the source object has them
+optional_arrays = ['cov_th', 'normed_trn', 'PVE', 'evals']
+
+
+class BasisFormatError(Exception):
+    '''
+    basis directory is missing, incomplete, or of an unsupported version
+    '''
+    pass
+
+
+def _colfname(i):
+    return 'meta_{:03d}.npy'.format(i)
+
+
+def _orderfname(i):
+    return 'order_{:03d}.npy'.format(i)
+
+
+def _jsonable(v):
+    '''
+    coerce numpy scalars (common in column `meta` dicts) to python types
+    '''
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def finite_sort_order(v):
+    '''
+    sort order of the finite elements of `v`, as consumed by
+        `param_estimate.param_interp_map` after non-finite values are dropped
+    '''
+    v = np.asarray(v)
+    return np.argsort(v[np.isfinite(v)], kind='mergesort')
+
+
+def write_basis(basis_dir, arrays, metadata, props, float_dtype=None,
+                required=required_arrays):
+    '''
+    write a basis to `basis_dir`
+
+    the directory is assembled next to its destination and then renamed
+        into place, so readers never see a partially-written basis
+
+    params:
+     - basis_dir: destination directory
+     - arrays: dict of name: array
+     - metadata: astropy table of training-set properties
+     - props: dict of JSON-serializable scalar properties
+     - float_dtype: if given, cast the large training-set arrays
+        (`trn_PC_wts`, `normed_trn`) to this type on disk
+     - required: names of arrays that must be present
+    '''
+
+    missing = [k for k in required if k not in arrays]
+    if missing:
+        raise BasisFormatError('missing required arrays: {}'.format(missing))
+
+    parent = os.path.dirname(os.path.abspath(basis_dir))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp_basis_')
+
+    try:
+        manifest = {'format_version': BASIS_FORMAT_VERSION,
+                    'props': props, 'arrays': {}, 'metadata': []}
+
+        for k, a in arrays.items():
+            if a is None:
+                continue
+            a = np.asarray(a)
+            if (float_dtype is not None) and (k in ['trn_PC_wts', 'normed_trn']):
+                a = a.astype(float_dtype)
+            np.save(os.path.join(tmp_dir, '{}.npy'.format(k)),
+                    np.ascontiguousarray(a))
+            manifest['arrays'][k] = {'shape': list(a.shape), 'dtype': a.dtype.str}
+
+        for i, n in enumerate(metadata.colnames):
+            col = np.asarray(metadata[n])
+            np.save(os.path.join(tmp_dir, _colfname(i)), np.ascontiguousarray(col))
+            np.save(os.path.join(tmp_dir, _orderfname(i)), finite_sort_order(col))
+            manifest['metadata'].append(
+                {'name': n, 'file': _colfname(i), 'order': _orderfname(i),
+                 'dtype': col.dtype.str,
+                 'meta': {k: _jsonable(v) for k, v in metadata[n].meta.items()}})
+
+        with open(os.path.join(tmp_dir, MANIFEST_FNAME), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+        if os.path.isdir(basis_dir):
+            shutil.rmtree(basis_dir)
+        os.rename(tmp_dir, basis_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def read_manifest(basis_dir):
+    '''
+    read and validate the manifest of a basis directory
+    '''
+    fname = os.path.join(basis_dir, MANIFEST_FNAME)
+    if not os.path.isfile(fname):
+        raise BasisFormatError('no basis manifest in {}'.format(basis_dir))
+
+    with open(fname, 'r') as f:
+        manifest = json.load(f)
+
+    version = manifest.get('format_version', None)
+    if version != BASIS_FORMAT_VERSION:
+        raise BasisFormatError(
+            'basis format version {} unsupported (expected {})'.format(
+                version, BASIS_FORMAT_VERSION))
+
+    return manifest
+
+
+def basis_exists(basis_dir):
+    '''
+    does `basis_dir` hold a readable basis of the current format version?
+    '''
+    try:
+        read_manifest(basis_dir)
+    except (BasisFormatError, ValueError):
+        return False
+    else:
+        return True
+
+
+class BasisReader(object):
+    '''
+    lazy, memory-mapped access to the contents of a basis directory
+
+    nothing but the manifest is read on construction; each array is
+        memory-mapped the first time it is asked for
+    '''
+    def __init__(self, basis_dir, mmap_mode='r'):
+        self.basis_dir = basis_dir
+        self.mmap_mode = mmap_mode
+        self.manifest = read_manifest(basis_dir)
+        self.props = self.manifest['props']
+        self._cache = {}
+
+    def _load(self, fname):
+        if fname not in self._cache:
+            self._cache[fname] = np.load(
+                os.path.join(self.basis_dir, fname), mmap_mode=self.mmap_mode)
+        return self._cache[fname]
+
+    def has(self, name):
+        return name in self.manifest['arrays']
+
+    def __getitem__(self, name):
+        if not self.has(name):
+            raise KeyError(name)
+        return self._load('{}.npy'.format(name))
+
+    @property
+    def colnames(self):
+        return [c['name'] for c in self.manifest['metadata']]
+
+    def metadata_table(self):
+        '''
+        build an astropy table whose columns are views of the mapped files
+        '''
+        from astropy import table as t
+
+        cols = [t.Column(self._load(c['file']), name=c['name'],
+                         meta=c['meta'], copy=False)
+                for c in self.manifest['metadata']]
+        return t.Table(cols, copy=False)
+
+    def metadata_orders(self):
+        '''
+        precomputed finite-value sort orders, keyed by column name
+        '''
+        return {c['name']: self._load(c['order'])
+                for c in self.manifest['metadata']}
@@ -0,0 +1,672 @@
+'''
+offline, synthetic benchmark of the per-galaxy pipeline
+
+builds everything the pipeline needs from random numbers, so no SAS data,
+    CSP library, or network access is required: a training library drawn
+    from a `linalg.HighDimDataSet` (a continuum and a low-dimensional,
+    smooth basis), with absorption features (and made-up derived
+    parameters), an observational covariance from `linalg.gen_Kinst`, and
+    MaNGA-like DRP logcubes and DAP maps for each IFU size (19 to 127 fibers),
+    which are turned into mock observations by `fakedata.FakeData`
+
+each mock galaxy is then run through `PCA_Result` construction, `solve`, and
+    writing results, with `instrument` recording these and their inner stages.
+    All random draws are seeded, so reports from different commits (see
+    `compare`) measure the same work
+
+the pipeline imports personal packages (`manga_tools`, `spec_tools`,
+    `manga_elines`, `elines`) that are not on PyPI; where these are not
+    installed, minimal stand-ins for the few things the benchmarked stages
+    use are put in their place (see `install_standins`), so that timings
+    are comparable, though emission-line masks are built from approximate
+    line lists. Still required: numpy, scipy, astropy, matplotlib,
+    scikit-learn, numba, speclite, extinction, and threadpoolctl
+
+    python benchmark.py run --ifusizes 19 61 127 --repeats 3
+    python benchmark.py compare bench-old.json bench-new.json
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import platform
+import subprocess
+from traceback import print_exception
+
+# the pipeline reads these at import; point anything unset at scratch space
+_scratch_dir = None
+for _k in ['PCAY_VER', 'PCAY_CSPBASE', 'PCAY_RESULTSDIR', 'PCAY_DIR',
+           'SAS_BASE_DIR']:
+    if _k not in os.environ:
+        if _scratch_dir is None:
+            _scratch_dir = tempfile.mkdtemp(prefix='pcay_bench_env_')
+        os.environ[_k] = 'benchmark' if _k == 'PCAY_VER' else _scratch_dir
+
+import types
+
+import numpy as np
+
+from astropy import units as u, table as t
+from astropy.io import fits
+
+
+def _standin_manga_tools():
+    m = types.ModuleType('manga_tools')
+    m.__doc__ = 'benchmark stand-in for manga_tools'
+
+    def mask_from_maskbits(a, b):
+        a = np.asarray(a)
+        return np.logical_or.reduce(
+            [(np.right_shift(a, int(bit)) & 1) != 0 for bit in b])
+
+    import importer
+    m.mask_from_maskbits = mask_from_maskbits
+    m.DRP_MPL_versions = {importer.mpl_v: 'benchmark'}
+    m.Mgy = u.def_unit('Mgy', 3631. * u.Jy)
+    return m
+
+
+def _standin_spec_tools():
+    spec_tools = types.ModuleType('spec_tools')
+    spec_tools.__doc__ = 'benchmark stand-in for spec_tools'
+
+    def determine_dlogl(logl):
+        return np.round(np.mean(logl[1:] - logl[:-1]), 8)
+
+    def air2vac(l, unit=u.AA):
+        # IAU conversion (Morton 1991), as in idlutils `airtovac`
+        l_air = (l * unit).to(u.AA).value
+        l_vac = 1. * l_air
+        for _ in range(2):
+            sigma2 = (1.0e4 / l_vac)**2.
+            fact = 1. + 5.792105e-2 / (238.0185 - sigma2) + \
+                   1.67917e-3 / (57.362 - sigma2)
+            l_vac = l_air * fact
+        return (l_vac * u.AA).to(unit)
+
+    spec_tools.determine_dlogl = determine_dlogl
+    spec_tools.air2vac = air2vac
+    return spec_tools
+
+
+def _standin_elines():
+    elines = types.ModuleType('elines')
+    elines.__doc__ = 'benchmark stand-in for elines (air wavelengths, AA)'
+    elines.balmer_low = {'Ha': 6562.80, 'Hb': 4861.32, 'Hg': 4340.46,
+                         'Hd': 4101.73}
+    elines.balmer_high = {'He': 3970.07, 'H8': 3889.05, 'H9': 3835.38,
+                          'H10': 3797.90}
+    elines.helium = {'HeI-4471': 4471.48, 'HeII-4686': 4685.68,
+                     'HeI-5876': 5875.62, 'HeI-6678': 6678.15}
+    elines.bright_metal = {'OII-3726': 3726.03, 'OII-3729': 3728.82,
+                           'OIII-4959': 4958.91, 'OIII-5007': 5006.84,
+                           'NII-6548': 6548.05, 'NII-6583': 6583.45,
+                           'SII-6716': 6716.44, 'SII-6731': 6730.82}
+    elines.faint_metal = {'NeIII-3869': 3868.76, 'OI-6300': 6300.30,
+                          'OI-6364': 6363.78, 'ArIII-7136': 7135.79}
+    return elines
+
+
+def _standin_manga_elines():
+    manga_elines = types.ModuleType('manga_elines')
+    manga_elines.__doc__ = 'benchmark stand-in for manga_elines'
+
+    def get_emline_qty(maps, qty, key, sn_th=3., maskbits=range(32)):
+        hdu = maps['EMLINE_{}'.format(qty)]
+        channels = {v: int(k[1:]) - 1 for k, v in hdu.header.items()
+                    if k.startswith('C') and k[1:].isdigit()}
+        ch = channels[key]
+        data = hdu.data[ch]
+        ivar = maps['EMLINE_{}_IVAR'.format(qty)].data[ch]
+        maskdata = maps['EMLINE_{}_MASK'.format(qty)].data[ch]
+        mask = np.logical_or(
+            np.logical_or.reduce(
+                [(np.right_shift(maskdata, int(bit)) & 1) != 0
+                 for bit in maskbits]),
+            data * np.sqrt(ivar) < sn_th)
+        return np.ma.array(data, mask=mask)
+
+    manga_elines.get_emline_qty = get_emline_qty
+    return manga_elines
+
+
+standins = {'manga_tools': _standin_manga_tools,
+            'spec_tools': _standin_spec_tools,
+            'elines': _standin_elines,
+            'manga_elines': _standin_manga_elines}
+
+
+def install_standins():
+    '''
+    put a minimal stand-in in place of each personal package that cannot
+        be imported, returning the names of those replaced
+    '''
+    replaced = []
+    for name, make in standins.items():
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = make()
+            replaced.append(name)
+    return replaced
+
+
+standins_used = install_standins()
+
+from importer import *
+import linalg
+import cov_obs
+import instrument
+import scheduler
+from fakedata import FakeData
+from rectify import MaNGA_deredshift
+from find_pcs import StellarPop_PCA, PCA_Result
+from partition import MemoryPlanner
+
+# MaNGA logcube wavelength grid
+drp_lllim, drp_dlogl, drp_nl = 3621.6, 1.0e-4, 4563
+
+# IFU size (fibers): (bundle diameter [arcsec], cube side [spaxels])
+ifu_geometry = {19: (12.5, 34), 37: (17.5, 44), 61: (22.5, 54),
+                91: (27.5, 64), 127: (32.5, 74)}
+
+# emission-line channels (Ha is channel 7, as `compute_eline_mask` expects)
+emline_channels = ['OIId-3728', 'Hb-4862', 'OIII-4960', 'OIII-5008',
+                   'OI-6302', 'OI-6365', 'NII-6549', 'Ha-6564',
+                   'NII-6585', 'SII-6718', 'SII-6732']
+
+# absorption features imprinted on the training spectra
+absorption_lines = [3934., 3969., 4102., 4304., 4341., 4861., 5175.,
+                    5270., 5890., 6563., 8542.]
+
+# derived parameters of the training library: (low, high, scale)
+param_ranges = {
+    'MLi': (-.6, .6, 'log'), 'MLV': (-.6, .8, 'log'), 'MWA': (-.3, 1.1, 'log'),
+    'sigma': (10., 350., 'linear'), 'logzsol': (-2., .2, 'linear'),
+    'tau_V': (0., 4., 'linear'), 'mu': (.1, .9, 'linear'),
+    'Dn4000': (1., 2.2, 'linear'), 'Hdelta_A': (-4., 10., 'linear'),
+    'Mg_b': (0., 6., 'linear'), 'Ca_HK': (5., 25., 'linear'),
+    'F_1G': (-20., 0., 'log'), 'F_200M': (-20., 0., 'log'),
+    'uv_slope': (-3., 1., 'linear'), 'tf': (1.5, 13.5, 'linear'),
+    'd1': (.1, 10., 'linear'), 'tt': (1., 13., 'linear'),
+    'logQHpersolmass': (40., 47., 'linear')}
+
+default_config = {'seed': 0, 'ifusizes': sorted(ifu_geometry), 'repeats': 1,
+                  'warmup': 1, 'nmodels': 2000, 'q': 6, 'cov_th_rank': None,
+                  'lllim': 3700., 'lulim': 8800., 'z': .03,
+                  'dered_method': 'drizzle', 'dered_kwargs': {'nper': 10},
+                  'pc_cov_method': 'precomp', 'mem_budget': None,
+                  'compact_results': False}
+
+
+def _continuum(l):
+    # shaped like `linalg.HighDimDataSet.Randomize`, but positive from 3000AA
+    Mf = lambda slope, xint, x: slope * (x - xint)
+    M0 = np.minimum(Mf(2., 3000., l), Mf(-.1, 15000., l))
+    return M0 / M0.mean()
+
+
+def synthetic_dataset(logl, ncomp):
+    '''
+    `linalg.HighDimDataSet` whose mean is a smooth continuum, and whose
+        basis is `ncomp` orthonormalized Legendre polynomials in `logl`
+
+    `HighDimDataSet.Randomize` is not used: it finds a random basis of all
+        nl dimensions by a dense (nl, nl) eigendecomposition, and `gen` draws
+        additively from all of it, which makes rough spectra that are often
+        negative (and so cannot be median-normalized); instead, spectra are
+        drawn multiplicatively from the reduced basis (see
+        `synthetic_library`). The observational covariance lives on the DRP
+        grid, so is not kept here (see `synthetic_K_obs`)
+    '''
+    x = np.linspace(-1., 1., len(logl))
+    E_full, _ = np.linalg.qr(np.polynomial.legendre.legvander(x, ncomp - 1))
+    return linalg.HighDimDataSet(
+        M=_continuum(10.**logl), E_full=E_full.T, K_inst=None, q=ncomp,
+        x=logl)
+
+
+def synthetic_library(nmodels, rng, dlogl=drp_dlogl, llims=(3400., 9800.),
+                      ncomp=12):
+    '''
+    training library: mean of a `synthetic_dataset` times smooth random
+        distortions drawn from its basis, less absorption features of random
+        depth and width, and derived parameters that depend (nonlinearly) on
+        the same random coefficients
+
+    returns wavelength grid (Quantity), spectra (nmodels, nl), and
+        metadata table (with 'TeX' & 'scale' column metadata, as
+        `StellarPop_PCA` expects)
+    '''
+    logl = np.arange(np.log10(llims[0]), np.log10(llims[1]), dlogl)
+    l = 10.**logl
+    dataset = synthetic_dataset(logl, ncomp)
+
+    # orthonormal basis vectors have per-channel rms 1 / sqrt(nl)
+    coeffs = rng.randn(nmodels, ncomp)
+    shape = 1. + .1 * np.sqrt(dataset.n) * (coeffs @ dataset.E)
+
+    depths = .3 / (1. + np.exp(-coeffs[:, :len(absorption_lines)]))
+    widths = 3. + 5. * rng.rand(nmodels, 1)
+    absorption = np.zeros_like(shape)
+    for i, l_line in enumerate(absorption_lines):
+        absorption += depths[:, i:i + 1] * np.exp(
+            -.5 * ((l[None, :] - l_line) / widths)**2.)
+
+    spectra = dataset.M[None, :] * np.clip(shape, .2, None) * \
+              (1. - np.clip(absorption, 0., .9))
+
+    metadata = t.Table()
+    mix = rng.randn(ncomp, len(param_ranges))
+    latent = 1. / (1. + np.exp(-(coeffs @ mix) / np.sqrt(ncomp)))
+    for i, (n, (lo, hi, scale)) in enumerate(param_ranges.items()):
+        metadata[n] = (lo + (hi - lo) * latent[:, i]).astype(np.float32)
+        metadata[n].meta.update({'TeX': n, 'scale': scale})
+
+    metadata['tau_V mu'] = metadata['tau_V'] * metadata['mu']
+    metadata['tau_V mu'].meta['TeX'] = 'tau_V mu'
+    metadata['tau_V (1 - mu)'] = metadata['tau_V'] * (1. - metadata['mu'])
+    metadata['tau_V (1 - mu)'].meta['TeX'] = 'tau_V (1 - mu)'
+
+    return l * u.AA, spectra.astype(np.float32), metadata
+
+
+def synthetic_K_obs(rng, nl=drp_nl):
+    '''
+    observational covariance on the MaNGA wavelength grid
+    '''
+    np.random.seed(rng.randint(2**31))
+    cov = linalg.gen_Kinst(nl).covariance_
+    return cov_obs.Cov_Obs(cov, lllim=drp_lllim, dlogl=drp_dlogl, nobj=1000)
+
+
+def hexagon_footprint(mapside, radius):
+    '''
+    True inside a flat-topped hexagon of circumradius `radius` (spaxels)
+        centered in a square map
+    '''
+    ctr = (mapside - 1) / 2.
+    yy, xx = np.abs(np.mgrid[:mapside, :mapside] - ctr)
+    return (xx <= radius) & (yy <= radius * np.sqrt(3.) / 2.) & \
+           (np.sqrt(3.) * xx + yy <= np.sqrt(3.) * radius)
+
+
+def _channel_hdu(data, extname, channels):
+    hdu = fits.ImageHDU(data)
+    hdu.header['EXTNAME'] = extname
+    for i, ch in enumerate(channels):
+        hdu.header['C{}'.format(i + 1)] = ch
+    return hdu
+
+
+def synthetic_manga_cubes(plateifu, ifusize, z, rng):
+    '''
+    MaNGA-like DRP logcube & DAP maps of an exponential disk galaxy
+
+    returns DRP HDUList, DAP HDUList, and drpall-like row
+    '''
+    diam, mapside = ifu_geometry[ifusize]
+    inside = hexagon_footprint(mapside, radius=diam)
+    mapshape = (mapside, mapside)
+
+    # geometry of the disk
+    ctr = (mapside - 1) / 2.
+    yy, xx = np.mgrid[:mapside, :mapside] - ctr
+    pa, ba = rng.uniform(0., np.pi), rng.uniform(.3, 1.)
+    xd = xx * np.cos(pa) + yy * np.sin(pa)
+    yd = (-xx * np.sin(pa) + yy * np.cos(pa)) / ba
+    R = np.sqrt(xd**2. + yd**2.)
+    theta = np.arctan2(yd, xd)
+    Re = diam / 3.  # spaxels
+    sb = np.exp(-1.68 * R / Re) * inside
+
+    l_obs = drp_lllim * 10.**(drp_dlogl * np.arange(drp_nl))
+    flux = 2. * sb[None, ...] * _continuum(l_obs / (1. + z))[:, None, None]
+    snr = 40. * np.sqrt(sb)[None, ...]
+    ivar = np.where(flux > 0., (snr / (flux + 1.0e-12))**2., 0.)
+    # NOCOV & DONOTUSE outside the fiber bundle
+    mask = np.repeat(np.where(inside, 0, 2**0 + 2**10).astype(np.int32)[None, ...],
+                     drp_nl, axis=0)
+
+    drp = fits.HDUList([fits.PrimaryHDU()])
+    drp[0].header['PLATEIFU'] = plateifu
+    drp[0].header['EBVGAL'] = .05
+    for name, data in [('FLUX', flux), ('IVAR', ivar),
+                       ('MASK', mask), ('WAVE', l_obs),
+                       ('SPECRES', np.linspace(1400., 2600., drp_nl))]:
+        drp.append(fits.ImageHDU(data, name=name))
+    for band, f in zip('griz', [.6, 1., 1.2, 1.3]):
+        drp.append(fits.ImageHDU(f * sb, name='{}IMG'.format(band)))
+
+    # stellar & gas kinematics, and emission-line strengths
+    bad = np.where(inside, 0, 2**30).astype(np.int32)
+    vel = 150. * np.tanh(R / Re) * np.cos(theta) * np.sqrt(1. - ba**2.)
+    ew = 5. * sb[None, ...] * rng.uniform(.2, 2., (len(emline_channels), 1, 1))
+    gsigma = 60. * np.ones((len(emline_channels), ) + mapshape)
+    ellcoo = np.stack([.5 * R, R / Re, np.degrees(theta) % 360.])
+
+    dap = fits.HDUList([fits.PrimaryHDU()])
+    dap[0].header['PLATEIFU'] = plateifu
+    for name, data in [('STELLAR_VEL', vel),
+                       ('STELLAR_VEL_IVAR', np.full(mapshape, 10.**-2.)),
+                       ('STELLAR_VEL_MASK', bad),
+                       ('STELLAR_SIGMA', np.full(mapshape, 120.)),
+                       ('STELLAR_SIGMACORR', np.full(mapshape, 30.)),
+                       ('STELLAR_SIGMA_IVAR', np.full(mapshape, 10.**-2.)),
+                       ('STELLAR_SIGMA_MASK', bad)]:
+        dap.append(fits.ImageHDU(data, name=name))
+    dap.append(_channel_hdu(ew, 'EMLINE_SEW', emline_channels))
+    dap.append(_channel_hdu(gsigma, 'EMLINE_GSIGMA', emline_channels))
+    dap.append(_channel_hdu(np.full_like(gsigma, 5.**-2.), 'EMLINE_GSIGMA_IVAR',
+                            emline_channels))
+    dap.append(_channel_hdu(bad[None, ...] * np.ones_like(gsigma, dtype=np.int32),
+                            'EMLINE_GSIGMA_MASK', emline_channels))
+    dap.append(_channel_hdu(ellcoo, 'SPX_ELLCOO',
+                            ['Elliptical radius', 'R/Re', 'Elliptical azimuth']))
+
+    row = {'plateifu': plateifu, 'nsa_z': z, 'nsa_zdist': z,
+           'nsa_elpetro_th50_r': .5 * Re, 'ifudesignsize': ifusize}
+
+    return drp, dap, row
+
+
+class SyntheticSetup(object):
+    '''
+    PCA basis, observational covariance, and mock galaxies for one
+        benchmark configuration
+    '''
+    def __init__(self, config, workdir):
+        self.config = config
+        self.workdir = workdir
+        self.mock_dir = os.path.join(workdir, 'mocks')
+        self.results_dir = os.path.join(workdir, 'results')
+        os.makedirs(self.mock_dir, exist_ok=True)
+        self.setup_times = {}
+
+        rng = np.random.RandomState(config['seed'])
+
+        t0 = time.perf_counter()
+        self.K_obs = synthetic_K_obs(rng)
+        self.setup_times['K_obs'] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        self.l_lib, self.spec_lib, metadata = synthetic_library(
+            config['nmodels'], rng)
+        self.pca = StellarPop_PCA(
+            l=self.l_lib, trn_spectra=self.spec_lib, gen_dicts=None,
+            metadata=metadata, K_obs=self.K_obs, src='synthetic',
+            sfh_fnames=[], nsubpersfh=1, nsfhperfile=config['nmodels'],
+            basedir=workdir, lllim=config['lllim'] * u.AA,
+            lulim=config['lulim'] * u.AA)
+        self.pca.run_pca_models(q=config['q'], cov_th_rank=config['cov_th_rank'])
+        self.setup_times['pca'] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        self.K_obs.precompute_Kpcs(self.pca.PCs)
+        self.K_obs._init_windows(len(self.pca.l))
+        self.setup_times['precompute_Kpcs'] = time.perf_counter() - t0
+
+        mem_budget = config['mem_budget']
+        self.planner = MemoryPlanner(
+            budget=None if mem_budget is None else mem_budget * 1024**3)
+
+        self.rows = {}
+
+    @staticmethod
+    def plateifu(ifusize):
+        return '{}-{}01'.format(90000 + ifusize, ifusize)
+
+    def mock(self, ifusize):
+        '''
+        make (once) the mock observation for an IFU size, returning
+            its drpall-like row
+        '''
+        if ifusize in self.rows:
+            return self.rows[ifusize]
+
+        plateifu = self.plateifu(ifusize)
+        rng = np.random.RandomState([self.config['seed'], ifusize])
+        t0 = time.perf_counter()
+
+        drp, dap, row = synthetic_manga_cubes(
+            plateifu, ifusize, self.config['z'], rng)
+        model_ix = rng.randint(len(self.pca.metadata))
+        spec = self.spec_lib[model_ix].astype(float)
+
+        # FakeData draws its noise from the global generator
+        np.random.seed(rng.randint(2**31))
+        data = FakeData(
+            lam_model=self.l_lib.value, spec_model=spec / np.median(spec),
+            meta_model=self.pca.metadata[model_ix], row=row,
+            drp_base=drp, dap_base=dap, plateifu_base=plateifu,
+            model_ix=model_ix, Kspec_obs=self.K_obs)
+        data.write(self.mock_dir)
+
+        self.setup_times['mock-{}'.format(ifusize)] = time.perf_counter() - t0
+        self.rows[ifusize] = row
+        return row
+
+
+def run_galaxy(setup, ifusize, **info):
+    '''
+    construct, solve, and write results of one mock galaxy, returning its
+        `instrument` record
+    '''
+    config = setup.config
+    row = setup.mock(ifusize)
+    plate, ifu = row['plateifu'].split('-')
+
+    instrument.start(row['plateifu'], ifudesignsize=ifusize, **info)
+    status, dered = 'failed', None
+    try:
+        with instrument.stage('PCA_Result.__init__'):
+            dered = MaNGA_deredshift.from_fakedata(
+                plate=plate, ifu=ifu, MPL_v=mpl_v, basedir=setup.mock_dir,
+                row=row, kind=daptype)
+            pca_res = PCA_Result(
+                pca=setup.pca, dered=dered, K_obs=setup.K_obs, z=row['nsa_zdist'],
+                cosmo=cosmo, figdir=setup.results_dir,
+                dered_method=config['dered_method'],
+                dered_kwargs=config['dered_kwargs'],
+                pc_cov_method=config['pc_cov_method'],
+                planner=setup.planner)
+
+        with instrument.stage('PCA_Result.solve'):
+            pca_res.solve(vdisp_wt=False)
+
+        with instrument.stage('PCA_Result.write_results'):
+            # the files of a production run (stage name kept for `compare`)
+            pca_res.write_products(['mangapca', 'zpmangapca'],
+                                   compact=config['compact_results'])
+    except Exception:
+        print('ERROR: {}'.format(row['plateifu']))
+        print_exception(*sys.exc_info())
+    else:
+        status = 'success'
+    finally:
+        if dered is not None:
+            dered.close()
+        record = instrument.finish(status)
+
+    return record
+
+
+def git_info():
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def git(*args):
+        try:
+            return subprocess.check_output(
+                ['git'] + list(args), cwd=here,
+                stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {'commit': git('rev-parse', 'HEAD'),
+            'subject': git('log', '-1', '--format=%s'),
+            'dirty': None if status is None else bool(status)}
+
+
+def machine_info():
+    import scipy
+    return {'host': socket.gethostname(), 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'blas_threads': {k: os.environ.get(k)
+                             for k in scheduler.blas_env_vars}}
+
+
+def _table_rows(tab):
+    return [{n: (r[n].item() if hasattr(r[n], 'item') else r[n])
+             for n in tab.colnames} for r in tab]
+
+
+def run(config, workdir=None, blas_threads=None):
+    '''
+    run the benchmark, returning its report (a JSON-serializable dict)
+    '''
+    if blas_threads is not None:
+        scheduler.limit_blas_threads(blas_threads)
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='pcay_bench_')
+
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'git': git_info(), 'machine': machine_info(), 'config': config,
+              'standins': standins_used}
+
+    setup = SyntheticSetup(config, workdir)
+
+    # the first galaxy pays one-off costs (e.g., JIT compilation)
+    for i in range(config['warmup']):
+        run_galaxy(setup, min(config['ifusizes']), warmup=True)
+
+    records = []
+    for ifusize in config['ifusizes']:
+        for i in range(config['repeats']):
+            record = run_galaxy(setup, ifusize, repeat=i)
+            records.append(record)
+            print('{} ({} fibers, repeat {}): {}, {:.1f} s, {:.2f} GB'.format(
+                record['name'], ifusize, i, record['status'], record['wall'],
+                record['peak_rss'] / 1024.**3))
+
+    report['setup_times'] = setup.setup_times
+    report['records'] = records
+    report['summary'] = _table_rows(instrument.summarize(records))
+
+    return report
+
+
+def compare(report_a, report_b, tol=.1):
+    '''
+    compare median wall time and peak memory of each stage (and IFU size)
+        of two reports; a change beyond fractional `tol` is flagged
+    '''
+    if report_a['config'] != report_b['config']:
+        print('WARNING: reports have different configurations')
+    for rep, tag in [(report_a, 'A'), (report_b, 'B')]:
+        g = rep.get('git', {})
+        print('{}: {} {}{} ({})'.format(
+            tag, (g.get('commit') or 'unknown')[:10], g.get('subject'),
+            ' [dirty]' if g.get('dirty') else '', rep['machine']['host']))
+
+    keyed = lambda rep: {(r['ifudesignsize'], r['stage']): r
+                         for r in rep['summary']}
+    a, b = keyed(report_a), keyed(report_b)
+
+    rows = []
+    for k in sorted(set(a) & set(b), key=lambda k: (k[0], k[1] == 'TOTAL', k[1])):
+        ratio = b[k]['wall_med'] / a[k]['wall_med'] if a[k]['wall_med'] else np.nan
+        if ratio > 1. + tol:
+            flag = 'slower'
+        elif ratio < 1. - tol:
+            flag = 'faster'
+        else:
+            flag = ''
+        rows.append((k[0], k[1], a[k]['wall_med'], b[k]['wall_med'], ratio,
+                     a[k]['peak_rss_gb'], b[k]['peak_rss_gb'], flag))
+
+    return t.Table(rows=rows if rows else None,
+                   names=['ifudesignsize', 'stage', 'wall_A', 'wall_B', 'B/A',
+                          'peak_gb_A', 'peak_gb_B', 'flag'])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='offline synthetic benchmark of the per-galaxy pipeline')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run benchmark')
+    run_parser.add_argument('--ifusizes', nargs='+', type=int,
+                            choices=sorted(ifu_geometry),
+                            default=default_config['ifusizes'],
+                            help='IFU sizes (fibers) of mock galaxies')
+    run_parser.add_argument('--repeats', type=int, default=default_config['repeats'],
+                            help='runs of each mock galaxy')
+    run_parser.add_argument('--warmup', type=int, default=default_config['warmup'],
+                            help='unrecorded runs before timing starts')
+    run_parser.add_argument('--nmodels', type=int, default=default_config['nmodels'],
+                            help='size of training library')
+    run_parser.add_argument('--q', type=int, default=default_config['q'],
+                            help='number of PCs')
+    run_parser.add_argument('--covthrank', type=int, default=None,
+                            help='store theory covariance as low-rank factor')
+    run_parser.add_argument('--membudget', type=float, default=None,
+                            help='memory budget (GB) of each fit (default measured)')
+    run_parser.add_argument('--compact', action='store_true',
+                            help='write compact results files')
+    run_parser.add_argument('--seed', type=int, default=default_config['seed'])
+    run_parser.add_argument('--blasthreads', type=int, default=None,
+                            help='limit BLAS threads')
+    run_parser.add_argument('--workdir', default=None,
+                            help='where mocks and results are written (default temporary)')
+    run_parser.add_argument('--out', default=None, help='report file (JSON)')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two reports')
+    compare_parser.add_argument('report_a')
+    compare_parser.add_argument('report_b')
+    compare_parser.add_argument('--tol', type=float, default=.1,
+                                help='fractional change in wall time flagged')
+
+    argsparsed = parser.parse_args()
+
+    if argsparsed.command == 'run':
+        config = dict(default_config)
+        config.update({'ifusizes': argsparsed.ifusizes,
+                       'repeats': argsparsed.repeats,
+                       'warmup': argsparsed.warmup,
+                       'nmodels': argsparsed.nmodels, 'q': argsparsed.q,
+                       'cov_th_rank': argsparsed.covthrank,
+                       'mem_budget': argsparsed.membudget,
+                       'compact_results': argsparsed.compact,
+                       'seed': argsparsed.seed})
+        report = run(config, workdir=argsparsed.workdir,
+                     blas_threads=argsparsed.blasthreads)
+
+        out = argsparsed.out
+        if out is None:
+            out = 'bench-{}-{}.json'.format(
+                (report['git']['commit'] or 'unknown')[:10], socket.gethostname())
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=1)
+
+        instrument.summarize(report['records']).pprint(
+            max_lines=-1, max_width=-1)
+        print('report written to {}'.format(out))
+
+    elif argsparsed.command == 'compare':
+        with open(argsparsed.report_a, 'r') as f:
+            report_a = json.load(f)
+        with open(argsparsed.report_b, 'r') as f:
+            report_b = json.load(f)
+        compare(report_a, report_b, tol=argsparsed.tol).pprint(
+            max_lines=-1, max_width=-1)
+
+    else:
+        parser.print_help()
@@ -0,0 +1,280 @@
+'''
+global catalogs, loaded on first use and cached
+
+modules ask for a catalog when they need it (e.g., `catalogs.drpall()`)
+    rather than loading it at import, so importing them is cheap, and a
+    worker process loads only what its task uses (forked workers share
+    whatever their parent loaded before forking)
+
+paths come from `importer` (environment variables `PCAY_CSPBASE` and
+    `PCAY_CATALOGDIR`), or may be given explicitly; cached catalogs are
+    shared, so should not be modified in place
+
+for per-galaxy lookups, `drpall_arrays` and `dapall_arrays` hold the
+    commonly-used columns of DRPall and DAPall as plain arrays (see
+    `CatalogArrays`), cached to `.npz` files (one per MPL) in `catalog_dir`
+'''
+
+from functools import lru_cache
+import os
+import json
+
+import numpy as np
+
+from importer import *
+
+# columns kept by `drpall_arrays` and `dapall_arrays`
+drpall_columns = [
+    'plateifu', 'mangaid', 'plate', 'ifudsgn', 'objra', 'objdec', 'ebvgal',
+    'mngtarg1', 'mngtarg2', 'mngtarg3', 'nsa_iauname', 'ifudesignsize',
+    'nsa_z', 'nsa_zdist', 'nsa_nsaid', 'nsa_elpetro_ba', 'nsa_elpetro_mass',
+    'nsa_elpetro_absmag', 'nsa_elpetro_flux', 'nsa_extinction']
+dapall_columns = [
+    'PLATEIFU', 'NSA_Z', 'NSA_ELPETRO_BA', 'NSA_ELPETRO_PHI',
+    'NSA_ELPETRO_TH50_R']
+
+
+def pc_vecs_fname():
+    return os.path.join(csp_basedir, 'pc_vecs.fits')
+
+
+def jhumpa_fname():
+    return os.path.join(catalog_dir, 'jhu_mpa_{}.fits'.format(
+        mpl_v.replace('-', '').lower()))
+
+
+def sfrsd_fname():
+    return os.path.join(catalog_dir, 'sigma_sfr.fits')
+
+
+def arrays_fname(name):
+    return os.path.join(catalog_dir, '{}_{}.npz'.format(
+        name, mpl_v.replace('-', '').lower()))
+
+
+class CatalogArrays(object):
+    '''
+    columns of a catalog as contiguous arrays, with rows indexed by a key
+        (e.g., plateifu)
+
+    `row(key)` gives one row as a dict, and `take(keys)` many rows at once,
+        as arrays; `select(mask)` gives a subset, with its own index
+
+    params:
+     - columns: dict of column name to array (all of the same length)
+     - key: name of column to index by
+    '''
+    def __init__(self, columns, key='plateifu'):
+        self.columns = columns
+        self.key = key
+        self.keys = columns[key]
+
+        self.index = dict(zip(self.keys.tolist(), range(len(self.keys))))
+        if len(self.index) != len(self.keys):
+            raise ValueError('duplicate values in key column {}'.format(key))
+        # sorted keys, for vectorized lookups
+        self._order = np.argsort(self.keys, kind='stable')
+        self._sorted = self.keys[self._order]
+
+    @classmethod
+    def from_table(cls, tab, columns, key='plateifu'):
+        '''
+        extract `columns` from astropy table `tab`
+
+        masked entries are filled, and byte strings decoded and stripped
+        '''
+        arrays = {}
+        for n in columns:
+            a = tab[n]
+            a = np.ascontiguousarray(
+                a.filled() if hasattr(a, 'filled') else np.asarray(a))
+            if a.dtype.kind == 'S':
+                a = np.char.decode(a, 'ascii')
+            if a.dtype.kind == 'U':
+                a = np.char.strip(a)
+            arrays[n] = a
+        return cls(arrays, key=key)
+
+    def save(self, fname, **meta):
+        '''
+        write to `fname` (atomically), recording `meta` alongside columns
+        '''
+        meta = dict(meta, key=self.key, columns=list(self.columns))
+        tmp = '{}.{}.tmp.npz'.format(fname[:-len('.npz')], os.getpid())
+        np.savez(tmp, _meta=np.array(json.dumps(meta)), **self.columns)
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        '''
+        read from `fname`, returning `CatalogArrays` and its recorded meta
+        '''
+        with np.load(fname, allow_pickle=False) as f:
+            meta = json.loads(str(f['_meta']))
+            arrays = {n: f[n] for n in meta['columns']}
+        return cls(arrays, key=meta['key']), meta
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, k):
+        return k in self.index
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def colnames(self):
+        return list(self.columns)
+
+    def row(self, k):
+        '''
+        dict of values in row with key `k` (`KeyError` if absent)
+        '''
+        i = self.index[k]
+        return {n: a[i] for n, a in self.columns.items()}
+
+    def rows(self, keys, missing='raise'):
+        '''
+        row numbers of `keys`
+
+        params:
+         - keys: sequence of keys
+         - missing: 'raise' (`KeyError`) or 'ignore' (row number -1)
+        '''
+        keys = np.asarray(keys)
+        if len(self) == 0:
+            found = np.zeros(keys.shape, dtype=bool)
+            ix = np.full(keys.shape, -1)
+        else:
+            pos = np.searchsorted(self._sorted, keys).clip(max=len(self) - 1)
+            found = (self._sorted[pos] == keys)
+            ix = np.where(found, self._order[pos], -1)
+        if (missing == 'raise') and not found.all():
+            raise KeyError(', '.join(map(str, keys[~found][:5])))
+        return ix
+
+    def take(self, keys, columns=None, missing='raise'):
+        '''
+        dict of arrays of `columns` (default all) in rows with `keys`
+
+        with `missing='ignore'`, absent rows are taken from the last row,
+            and flagged in entry `'_found'`
+        '''
+        ix = self.rows(keys, missing=missing)
+        out = {n: self.columns[n][ix]
+               for n in (self.colnames if columns is None else columns)}
+        if missing != 'raise':
+            out['_found'] = (ix >= 0)
+        return out
+
+    def select(self, mask):
+        '''
+        subset of rows where `mask` is true
+        '''
+        return CatalogArrays(
+            {n: a[mask] for n, a in self.columns.items()}, key=self.key)
+
+    def to_table(self, columns=None):
+        '''
+        astropy table of `columns` (default all)
+        '''
+        from astropy import table as t
+        return t.Table({n: self.columns[n]
+                        for n in (self.colnames if columns is None else columns)})
+
+
+def load_arrays(name, build, columns, key, fname=None, rebuild=False):
+    '''
+    `CatalogArrays` from `.npz` cache `fname`, made (using `build()` to get
+        the full catalog) if the cache is absent, or holds other columns
+    '''
+    if fname is None:
+        fname = arrays_fname(name)
+    if (not rebuild) and os.path.isfile(fname):
+        try:
+            arrays, meta = CatalogArrays.load(fname)
+        except (OSError, ValueError, KeyError):
+            pass
+        else:
+            if (meta['columns'] == list(columns)) and (meta['key'] == key) and \
+                    (meta.get('mpl_v') == mpl_v):
+                return arrays
+
+    arrays = CatalogArrays.from_table(build(), columns, key=key)
+    try:
+        arrays.save(fname, mpl_v=mpl_v, source=name)
+    except OSError as e:
+        print('could not cache {} to {}: {}'.format(name, fname, e))
+    return arrays
+
+
+@lru_cache(maxsize=None)
+def drpall(index='plateifu'):
+    import manga_tools as m
+    return m.load_drpall(mpl_v, index=index)
+
+
+@lru_cache(maxsize=None)
+def dapall():
+    '''
+    DAPall entries of this DAP type that are done, indexed by plateifu
+    '''
+    import manga_tools as m
+    tab = m.load_dapall(mpl_v)
+    tab = tab[tab['DAPDONE'] * (tab['DAPTYPE'] == daptype)]
+    tab.add_index('PLATEIFU')
+    return tab
+
+
+@lru_cache(maxsize=None)
+def drpall_arrays(fname=None, rebuild=False):
+    '''
+    `CatalogArrays` of `drpall_columns`, by plateifu
+    '''
+    return load_arrays('drpall', drpall, drpall_columns, 'plateifu',
+                       fname=fname, rebuild=rebuild)
+
+
+@lru_cache(maxsize=None)
+def dapall_arrays(fname=None, rebuild=False):
+    '''
+    `CatalogArrays` of `dapall_columns` (of this DAP type), by plateifu
+    '''
+    return load_arrays('dapall_{}'.format(daptype), dapall, dapall_columns,
+                       'PLATEIFU', fname=fname, rebuild=rebuild)
+
+
+@lru_cache(maxsize=None)
+def pca_system(fname=None):
+    '''
+    `read_results.PCASystem` of PCs written alongside the CSPs
+    '''
+    import read_results
+    return read_results.PCASystem.fromfile(
+        pc_vecs_fname() if fname is None else fname)
+
+
+@lru_cache(maxsize=None)
+def jhumpa(fname=None):
+    '''
+    JHU-MPA stellar masses, by plateifu
+    '''
+    from astropy import table as t
+    tab = t.Table.read(jhumpa_fname() if fname is None else fname)
+    tab['plateifu'] = [plateifu.strip(' ') for plateifu in tab['PLATEIFU']]
+    tab = tab['plateifu', 'LOG_MSTAR']
+    return tab[tab['LOG_MSTAR'] > 0.]
+
+
+@lru_cache(maxsize=None)
+def sfrsd(fname=None):
+    '''
+    star-formation rate surface densities, indexed by plateifu
+    '''
+    from astropy import table as t
+    tab = t.Table.read(sfrsd_fname() if fname is None else fname)
+    tab['plateifu'] = tab['names']
+    del tab['names']
+    tab.add_index('plateifu')
+    return tab
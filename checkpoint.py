@@ -0,0 +1,100 @@
+'''
+per-galaxy checkpoints of intermediate fit products, for crash-resume
+
+each galaxy gets a directory holding one compressed `.npz` file per
+    completed stage (written to a temporary name, then atomically renamed),
+    and a record of the hash of the configuration the stages were computed
+    with. A retry
+    with the same configuration resumes after the last completed stage;
+    checkpoints from any other configuration are discarded. Checkpoints
+    are removed once the galaxy's results are written
+'''
+
+import numpy as np
+
+import os
+import json
+import shutil
+import hashlib
+
+
+def fingerprint(a):
+    '''
+    short hash of an array's shape, type, and contents
+    '''
+    a = np.ascontiguousarray(a)
+    h = hashlib.sha1(str((a.shape, a.dtype.str)).encode())
+    h.update(a.tobytes())
+    return h.hexdigest()[:16]
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(
+        config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class GalaxyCheckpoint(object):
+    '''
+    checkpointed stages of one galaxy's fit
+
+    params:
+     - basedir: directory holding all galaxies' checkpoints
+     - name: galaxy name (e.g., plateifu)
+     - config: JSON-serializable dict of everything the stages depend on
+    '''
+    def __init__(self, basedir, name, config):
+        self.dir = os.path.join(basedir, name)
+        self.hash = config_hash(config)
+        self.config = config
+
+        config_fname = os.path.join(self.dir, 'config.json')
+        try:
+            with open(config_fname, 'r') as f:
+                old_hash = json.load(f)['hash']
+        except (FileNotFoundError, ValueError, KeyError):
+            old_hash = None
+
+        if old_hash != self.hash:
+            self.clear()
+            os.makedirs(self.dir, exist_ok=True)
+            with open(config_fname, 'w') as f:
+                json.dump({'hash': self.hash, 'config': config}, f,
+                          default=str)
+
+    def fname(self, stage):
+        return os.path.join(self.dir, '{}.npz'.format(stage))
+
+    def has(self, stage):
+        return os.path.isfile(self.fname(stage))
+
+    def save(self, stage, **arrays):
+        '''
+        store arrays of a completed stage (masked arrays lose their masks)
+        '''
+        tmp = os.path.join(self.dir, '.{}.{}.npz'.format(stage, os.getpid()))
+        np.savez_compressed(
+            tmp, **{k: np.ma.getdata(v) for k, v in arrays.items()})
+        os.replace(tmp, self.fname(stage))
+
+    def load(self, stage):
+        '''
+        dict of arrays stored for `stage`, or None if it has not completed
+        '''
+        if not self.has(stage):
+            return None
+        try:
+            with np.load(self.fname(stage), allow_pickle=False) as f:
+                return {k: f[k] for k in f.files}
+        except (OSError, ValueError):
+            # truncated by a crash in some unforeseen way: recompute
+            return None
+
+    def clear(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def clear_galaxy(basedir, name):
+    '''
+    remove a galaxy's checkpoints (e.g., once its results are written)
+    '''
+    shutil.rmtree(os.path.join(basedir, name), ignore_errors=True)
@@ -0,0 +1,233 @@
+'''
+compact storage of per-galaxy results files
+
+compact files hold the same extensions as standard ones, but as
+    tile-compressed images (`CompImageHDU`, one tile per map or per plane of
+    a cube), with most floating-point products stored as float32, flags and
+    indices as integers, GOODFRAC as integer model counts (scaled by
+    1 / NMODELS, so it reads back as fractions), and only the upper triangle
+    of the symmetric CALPHA_PREC. All compression is lossless, so the only
+    loss of precision is in the float32 extensions
+
+each compact extension records its storage in header keyword `PCAYENC`,
+    and the type of the array it replaces in `ORIGTYPE`; `expand` undoes
+    both, and `read_results.PCAOutput.getdata` applies it, so compact and
+    standard files are read alike
+
+run this module directly to measure sizes and write & read times of compact
+    copies of existing results files (or to convert them):
+
+    python compact_fits.py <results files> [--out <dir>]
+'''
+
+import numpy as np
+
+from astropy.io import fits
+
+import os
+import time
+import tempfile
+
+# storage of each extension in compact files; anything not listed (i.e.,
+# a quantity's credible interval, or a map like SNRMED) is stored as float32
+#  - 'triu': upper triangle of two leading (symmetric) axes, full precision
+#    (precision matrices are inverted downstream, so keep float64)
+#  - 'fraction': integer counts of models, scaled by 1 / NMODELS
+#  - otherwise, numpy dtype stored
+encodings = {'MASK': 'int16', 'SUCCESS': 'int16', 'MODELNUM': 'int32',
+             'GOODFRAC': 'fraction', 'CALPHA_PREC': 'triu'}
+default_encoding = 'float32'
+
+# header keywords describing an image's layout, which `CompImageHDU` sets
+structural_keys = ['SIMPLE', 'XTENSION', 'BITPIX', 'PCOUNT', 'GCOUNT',
+                   'EXTEND', 'BSCALE', 'BZERO', 'EXTNAME']
+
+
+def pack_triu(a):
+    '''
+    upper triangle (with diagonal) of the two leading axes of `a`,
+        flattened into one leading axis
+    '''
+    return a[np.triu_indices(a.shape[0])]
+
+
+def unpack_triu(a):
+    '''
+    symmetric array from output of `pack_triu`
+    '''
+    n = int(round((np.sqrt(8 * a.shape[0] + 1) - 1) / 2))
+    iu = np.triu_indices(n)
+    full = np.empty((n, n) + a.shape[1:], dtype=a.dtype)
+    full[iu] = a
+    full[iu[::-1]] = a
+    return full
+
+
+def tile_shape(shape):
+    # one tile per 2d map (or per plane of a cube), so one channel of
+    # a cube can be read without decompressing the rest
+    return (1, ) * (len(shape) - 2) + tuple(shape[-2:])
+
+
+def compact_hdu(data, cards, extname):
+    '''
+    tile-compressed HDU storing `data` as `encodings` directs
+
+    params:
+     - data: array (as would go in a standard `ImageHDU`)
+     - cards: list of (keyword, value) to add to header
+     - extname: name of extension
+    '''
+    data = np.asarray(data)
+    enc = encodings.get(extname, default_encoding)
+    origtype = data.dtype.name
+
+    if enc == 'triu':
+        stored = pack_triu(data)
+    elif enc == 'fraction':
+        stored = data.astype(np.float64)
+    else:
+        stored = data.astype(enc)
+
+    if stored.dtype.kind == 'f':
+        # quantize_level = 0 turns off quantization: lossless
+        hdu = fits.CompImageHDU(
+            stored, compression_type='GZIP_2', quantize_level=0.,
+            tile_shape=tile_shape(stored.shape))
+    else:
+        hdu = fits.CompImageHDU(
+            stored, compression_type='RICE_1',
+            tile_shape=tile_shape(stored.shape))
+
+    for k, v in cards:
+        hdu.header[k] = v
+    if enc == 'fraction':
+        hdu.scale('int32', bscale=1. / hdu.header['NMODELS'])
+    hdu.header['EXTNAME'] = extname
+    hdu.header['PCAYENC'] = enc
+    hdu.header['ORIGTYPE'] = origtype
+
+    return hdu
+
+
+def expand(hdu):
+    '''
+    data of `hdu`, as it was before being made compact (if it was)
+    '''
+    data = hdu.data
+    enc = hdu.header.get('PCAYENC')
+    if enc is None:
+        return data
+    if enc == 'triu':
+        data = unpack_triu(data)
+    return data.astype(hdu.header.get('ORIGTYPE', data.dtype.name), copy=False)
+
+
+def header_cards(header):
+    '''
+    non-structural cards of `header`, to pass to `compact_hdu`
+    '''
+    return [(k, v) for k, v in header.items()
+            if not ((k in structural_keys) or k.startswith('NAXIS'))]
+
+
+def compact_hdulist(hdulist):
+    '''
+    compact version of a standard results file (primary HDU is kept as is)
+    '''
+    return fits.HDUList(
+        [fits.PrimaryHDU(data=hdulist[0].data, header=hdulist[0].header)] +
+        [compact_hdu(hdu.data, header_cards(hdu.header), hdu.header['EXTNAME'])
+         for hdu in hdulist[1:]])
+
+
+def read_all(fname):
+    '''
+    open `fname` and read (and expand) all extensions, as a reader would
+    '''
+    with fits.open(fname) as hdulist:
+        return {hdu.header['EXTNAME']: expand(hdu) for hdu in hdulist[1:]}
+
+
+def compare(fnames, out_dir):
+    '''
+    write compact copies of standard results files to `out_dir`, and
+        compare their sizes, write & read times, and contents
+
+    returns astropy table with one row per file, and one for all files
+    '''
+    from astropy import table as t
+
+    rows = []
+    for fname in fnames:
+        out_fname = os.path.join(out_dir, os.path.basename(fname))
+        std_fname = os.path.join(out_dir, '.std-' + os.path.basename(fname))
+        if os.path.abspath(out_fname) == os.path.abspath(fname):
+            raise ValueError('compact copy would replace {}'.format(fname))
+        with fits.open(fname, memmap=False) as hdulist:
+            hdulist.readall()
+            t0 = time.perf_counter()
+            hdulist.writeto(std_fname, overwrite=True)
+            t_write_std = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            compact_hdulist(hdulist).writeto(out_fname, overwrite=True)
+            t_write = time.perf_counter() - t0
+        os.remove(std_fname)
+
+        t0 = time.perf_counter()
+        std = read_all(fname)
+        t_read_std = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        cmp = read_all(out_fname)
+        t_read = time.perf_counter() - t0
+
+        # largest relative difference (in any finite element) of any extension
+        maxdiff = 0.
+        for k, a in std.items():
+            a, b = a.astype(np.float64), cmp[k].astype(np.float64)
+            if (np.isfinite(a) != np.isfinite(b)).any():
+                maxdiff = np.inf
+                break
+            good = np.isfinite(a)
+            if good.any():
+                scale = np.maximum(np.abs(a[good]), np.finfo(np.float32).tiny)
+                maxdiff = max(maxdiff, (np.abs(a[good] - b[good]) / scale).max())
+
+        rows.append((os.path.basename(fname), os.path.getsize(fname),
+                     os.path.getsize(out_fname), t_write_std, t_write,
+                     t_read_std, t_read, maxdiff))
+
+    tab = t.Table(rows=rows if rows else None,
+                  names=['fname', 'size_std', 'size_compact', 'write_std',
+                         'write_compact', 'read_std', 'read_compact',
+                         'max_reldiff'])
+    if rows:
+        tab.add_row(('TOTAL', tab['size_std'].sum(), tab['size_compact'].sum(),
+                     tab['write_std'].sum(), tab['write_compact'].sum(),
+                     tab['read_std'].sum(), tab['read_compact'].sum(),
+                     tab['max_reldiff'].max()))
+        tab['ratio'] = tab['size_compact'] / tab['size_std']
+        # throughput, in MB of (standard) results per second
+        tab['write_MBps'] = tab['size_std'] / tab['write_compact'] / 1024.**2
+        tab['read_MBps'] = tab['size_std'] / tab['read_compact'] / 1024.**2
+    return tab
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='measure (or make) compact copies of results files')
+    parser.add_argument('fnames', nargs='+', help='standard results files')
+    parser.add_argument('--out', default=None,
+                        help='directory in which to keep compact copies')
+    argsparsed = parser.parse_args()
+
+    if argsparsed.out is None:
+        with tempfile.TemporaryDirectory() as out_dir:
+            tab = compare(argsparsed.fnames, out_dir)
+    else:
+        os.makedirs(argsparsed.out, exist_ok=True)
+        tab = compare(argsparsed.fnames, argsparsed.out)
+
+    tab.pprint(max_lines=-1, max_width=-1)
@@ -30,8 +30,9 @@ eps = np.finfo(float).eps
 
 # =====
 
-print('MaNGA data-product info:', mpl_v, '({})'.format(m.DRP_MPL_versions[mpl_v]))
-print('MaNGA data location:', os.environ['SAS_BASE_DIR'])
+def print_data_info():
+    print('MaNGA data-product info:', mpl_v, '({})'.format(m.DRP_MPL_versions[mpl_v]))
+    print('MaNGA data location:', os.environ['SAS_BASE_DIR'])
 
 
 class Cov_Obs(object):
@@ -67,4 +67,119 @@ def retrieve_meta_table(filelist, i, nsubpersfh=None, nsfhperfile=None):
 
     metadata = t.Table.read(fname)
 
-    return metadata, fii
\ No newline at end of file
+    return metadata, fii
+
+def ingest_csp_file(fname, out_fname, row0, in_lrange, logl_final, lsf, z0,
+                    block_bytes=2**26):
+    '''
+    read, trim, LSF-convolve, regrid, and normalize the spectra in one
+        CSP file, writing them into rows `row0:` of the memory-mapped
+        array in `out_fname`
+
+    `block_bytes` bounds the working memory of the regridding step
+
+    returns the number of rows written
+    '''
+    import utils as ut
+
+    l = fits.getdata(fname, 'lam')[in_lrange]
+    logl = np.log10(l)
+    spec = fits.getdata(fname, 'flam')[:, in_lrange]
+
+    dlogl_hires = ut.determine_dlogl(logl)
+    spec_lsf = lsf(y=spec, lam=l * (1. + z0), dlogl=dlogl_hires, z=z0)
+    del spec
+
+    # regrid straight into this file's rows of the output
+    nspec = len(spec_lsf)
+    out = np.load(out_fname, mmap_mode='r+')
+    spec_lores = out[row0:row0 + nspec]
+    resampler = ut.LinearResampler(x0=logl, xnew=logl_final)
+    resampler(spec_lsf, out=spec_lores, block_bytes=block_bytes)
+    del spec_lsf
+    spec_lores /= spec_lores.max(axis=1)[..., None]
+
+    out.flush()
+    del spec_lores, out
+
+    return nspec
+
+def _ingest_csp_file(args):
+    return ingest_csp_file(*args)
+
+def ingest_csp_files(fnames, nrows, in_lrange, logl_final, lsf, z0,
+                     processes=1, mem_budget=None, out_fname=None,
+                     tmp_dir=None, bytes_per_value=8, nwork_copies=4):
+    '''
+    build the LSF-convolved, regridded training spectra from many CSP files,
+        one file per worker, into a preallocated memory-mapped array
+
+    params:
+     - fnames: CSP file names
+     - nrows: number of spectra in each file
+     - in_lrange: boolean mask of the files' wavelength grid to keep
+     - logl_final: log-wavelength grid of the output
+     - lsf: callable LSF (e.g., `utils.MaNGA_LSF`)
+     - z0: redshift at which LSF is applied
+     - processes: maximum number of worker processes
+     - mem_budget: approximate bytes available to all workers together;
+        the number of workers is reduced so that each has room for
+        `nwork_copies` copies of one file's spectra (the output is on disk,
+        so does not count against this)
+     - out_fname: `.npy` file to hold the result (if None, a temporary file
+        in `tmp_dir` is used, and removed once mapped: its space is freed
+        when the returned array is)
+     - tmp_dir: directory of temporary output file (default: system's),
+        which should have room for the whole library
+
+    returns read-only, memory-mapped array of shape
+        (sum(nrows), len(logl_final))
+    '''
+    import tempfile
+    import multiprocessing as mpc
+
+    nrows = list(map(int, nrows))
+    row0s = np.concatenate([[0], np.cumsum(nrows)[:-1]]).astype(int)
+    nl_hires = int(np.count_nonzero(in_lrange))
+
+    if processes is None:
+        processes = mpc.cpu_count()
+    processes = min(processes, len(fnames))
+    if mem_budget is not None:
+        bytes_per_file = max(nrows) * nl_hires * bytes_per_value * nwork_copies
+        processes = max(1, min(processes, int(mem_budget // bytes_per_file)))
+
+    is_tmp = out_fname is None
+    if is_tmp:
+        fd, out_fname = tempfile.mkstemp(
+            suffix='.npy', prefix='.ingest_', dir=tmp_dir)
+        os.close(fd)
+
+    out = np.lib.format.open_memmap(
+        out_fname, mode='w+', dtype=np.float64,
+        shape=(sum(nrows), len(logl_final)))
+    del out
+
+    tasks = [(fn, out_fname, r0, in_lrange, logl_final, lsf, z0)
+             for fn, r0 in zip(fnames, row0s)]
+
+    print('Ingesting {} CSP files with {} process(es)'.format(
+        len(fnames), processes))
+
+    try:
+        if processes == 1:
+            nwritten = list(map(_ingest_csp_file, tasks))
+        else:
+            with mpc.Pool(processes=processes) as pool:
+                nwritten = list(pool.imap_unordered(_ingest_csp_file, tasks))
+
+        if sum(nwritten) != sum(nrows):
+            raise ValueError('wrote {} spectra, expected {}'.format(
+                sum(nwritten), sum(nrows)))
+
+        spec = np.load(out_fname, mmap_mode='r')
+    finally:
+        if is_tmp:
+            os.remove(out_fname)
+
+    return spec
@@ -117,8 +117,8 @@ class FakeData(object):
         z_obs = (1. + z_cosm) * (1. + z_pec) - 1.
 
         # create a placeholder model cube since flexible broadcasting is hard
-        if specmodel.ndim == 3:
-            spec_model_cube = specmodel
+        if spec_model.ndim == 3:
+            spec_model_cube = spec_model
         else:
             spec_model_cube = np.tile(spec_model[:, None, None], (1, ) + mapshape)
         ivar_model_cube = np.ones_like(spec_model_cube)
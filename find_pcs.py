@@ -13,6 +13,17 @@ from linalg import *
 from param_estimate import *
 from rectify import MaNGA_deredshift
 import pca_status
+import basis_store
+import basis_cache
+import scheduler
+import leases
+import prefetch
+import instrument
+import profiling
+from partition import MemoryPlanner
+import checkpoint
+import compact_fits
+from checkpoint import GalaxyCheckpoint, fingerprint
 
 # personal
 import manga_tools as m
@@ -37,9 +48,10 @@ from astropy.wcs.utils import pixel_to_skycoord
 
 import os
 import sys
+import json
 from warnings import warn, filterwarnings, catch_warnings, simplefilter
 from traceback import print_exception
-from functools import lru_cache
+from functools import lru_cache, partial
 import pickle
 
 # scipy
@@ -61,6 +73,19 @@ class StellarPop_PCA(object):
     class for determining PCs of a library of synthetic spectra
     '''
 
+    important_params = ['MLi', 'Dn4000', 'Hdelta_A',
+                        'MWA', 'sigma', 'logzsol',
+                        'tau_V', 'mu', 'tau_V mu',
+                        'Mg_b', 'Ca_HK', 'F_1G',
+                        'logQHpersolmass']
+
+    importantplus_params = important_params + \
+                           ['F_200M', 'tf', 'd1', 'tt', 'MLV']
+
+    confident_params = ['MLi', 'logzsol',
+                        'tau_V', 'mu', 'tau_V mu', 'tau_V (1 - mu)',
+                        'logQHpersolmass', 'uv_slope']
+
     def __init__(self, l, trn_spectra, gen_dicts, metadata, K_obs, src,
                  sfh_fnames, nsubpersfh, nsfhperfile, basedir,
                  dlogl=None, lllim=3700. * u.AA, lulim=7400. * u.AA):
@@ -94,7 +119,10 @@ class StellarPop_PCA(object):
 
         self.dlogl = dlogl
 
-        self.trn_spectra = trn_spectra[:, l_good]
+        # l_good is contiguous, so slice: a view of memory-mapped spectra
+        # (see `csp.ingest_csp_files`) is not read into memory here
+        l_good_ix = np.flatnonzero(l_good)
+        self.trn_spectra = trn_spectra[:, l_good_ix[0]:l_good_ix[-1] + 1]
 
         self.metadata = metadata
 
@@ -119,19 +147,6 @@ class StellarPop_PCA(object):
         self.nsubpersfh = nsubpersfh
         self.nsfhperfile = nsfhperfile
 
-        self.important_params = ['MLi', 'Dn4000', 'Hdelta_A',
-                                 'MWA', 'sigma', 'logzsol',
-                                 'tau_V', 'mu', 'tau_V mu',
-                                 'Mg_b', 'Ca_HK', 'F_1G',
-                                 'logQHpersolmass']
-
-        self.importantplus_params = self.important_params + \
-                                    ['F_200M', 'tf', 'd1', 'tt', 'MLV']
-
-        self.confident_params = ['MLi', 'logzsol',
-                                 'tau_V', 'mu', 'tau_V mu', 'tau_V (1 - mu)',
-                                 'logQHpersolmass', 'uv_slope']
-
         # observational covariance matrix
         if not isinstance(K_obs, cov_obs.Cov_Obs):
             raise TypeError('incorrect observational covariance matrix class!')
@@ -147,37 +162,167 @@ class StellarPop_PCA(object):
                   inf_replace=dict(zip(['F_20M', 'F_100M', 'F_200M', 'F_500M', 'F_1G'],
                                        [-20., -20., -20., -20., -20.])),
                   vel_params={}, dlogl=1.0e-4, z0_=.04,
-                  preload_llims=[3000. * u.AA, 10000. * u.AA], **kwargs):
+                  preload_llims=[3000. * u.AA, 10000. * u.AA], cache=None,
+                  processes=1, mem_budget=None, ingest_dir=None, **kwargs):
         '''
         Read in FSPS outputs (dicts & metadata + spectra) from some directory
+
+        if `cache` (a `basis_cache.BasisCache`) is given, the LSF-convolved,
+            regridded library is looked up there (and stored, if absent)
+
+        `processes` and `mem_budget` control parallel ingestion of CSP files
+            (see `csp.ingest_csp_files`), whose output is memory-mapped from
+            a temporary file in `ingest_dir` (default: the cache directory,
+            if any, else `base_dir`)
+        '''
+
+        library_kwargs = dict(
+            lsf=lsf, base_dir=base_dir, nfiles=nfiles, log_params=log_params,
+            inf_replace=inf_replace, vel_params=vel_params, dlogl=dlogl,
+            z0_=z0_, preload_llims=preload_llims)
+        if ingest_dir is None:
+            ingest_dir = base_dir if cache is None else cache.cache_dir
+        ingest_kwargs = dict(processes=processes, mem_budget=mem_budget,
+                             ingest_dir=ingest_dir)
+
+        if cache is None:
+            lib = cls.build_training_library(**library_kwargs, **ingest_kwargs)
+        else:
+            lib_key = cache.key(cls.training_inputs(**library_kwargs)[0])
+            lib_dir = cache.lookup('library', lib_key)
+            if lib_dir is None:
+                lib = cls.build_training_library(**library_kwargs, **ingest_kwargs)
+                cls._write_training_library(
+                    cache.entry_dir('library', lib_key), lib,
+                    inputs=cls.training_inputs(**library_kwargs)[0])
+            else:
+                print('Using cached training library: {}'.format(lib_dir))
+                lib = cls._read_training_library(lib_dir)
+
+        l_final, spec_lores, meta, sfh_fnames, Nsubsample, Nsfhper = lib
+
+        return cls(l=l_final, trn_spectra=spec_lores,
+                   gen_dicts=None, metadata=meta, sfh_fnames=sfh_fnames,
+                   K_obs=K_obs, dlogl=None, src='FSPS',
+                   nsubpersfh=Nsubsample, nsfhperfile=Nsfhper, basedir=base_dir,
+                   **kwargs)
+
+    @staticmethod
+    def find_training_files(base_dir, nfiles=None):
+        '''
+        CSP and SFH files used to build the training library
+
+        files are sorted, so that the basis-cache key does not depend on
+            directory order, and so that CSP and SFH files pair up by index
         '''
 
         from glob import glob
-        from utils import pickle_loader, add_losvds
-        from itertools import chain
 
-        csp_fnames = glob(os.path.join(base_dir,'CSPs_*.fits'))
-        sfh_fnames = glob(os.path.join(base_dir,'SFHs_*.fits'))
-        print('Building training library in directory: {}'.format(base_dir))
-        print('CSP files used: {}'.format(' '.join(tuple(csp_fnames))))
+        csp_fnames = sorted(glob(os.path.join(base_dir,'CSPs_*.fits')))
+        sfh_fnames = sorted(glob(os.path.join(base_dir,'SFHs_*.fits')))
+
+        csp_ids = [os.path.basename(fn)[len('CSPs_'):] for fn in csp_fnames]
+        sfh_ids = [os.path.basename(fn)[len('SFHs_'):] for fn in sfh_fnames]
+        if csp_ids != sfh_ids:
+            raise ValueError('CSP and SFH files in {} do not match'.format(
+                base_dir))
 
         if nfiles is not None:
             csp_fnames = csp_fnames[:nfiles]
             sfh_fnames = sfh_fnames[:nfiles]
 
+        return csp_fnames, sfh_fnames
+
+    @classmethod
+    def training_inputs(cls, base_dir, nfiles=None, lsf=None, **kwargs):
+        '''
+        all inputs that determine the training library built by `from_FSPS`,
+            and the extra ones that determine a basis trained on it
+
+        returns (library inputs, fit inputs), used as cache keys
+        '''
+
+        import inspect
+
+        fsps_args = inspect.signature(cls.from_FSPS).bind(
+            K_obs=None, lsf=lsf, base_dir=base_dir, nfiles=nfiles, **kwargs)
+        fsps_args.apply_defaults()
+        fsps_args = fsps_args.arguments
+        init_args = {k: p.default for k, p in
+                     inspect.signature(cls.__init__).parameters.items()
+                     if k in ['lllim', 'lulim']}
+        init_args.update(
+            {k: v for k, v in fsps_args['kwargs'].items() if k in init_args})
+
+        csp_fnames, sfh_fnames = cls.find_training_files(base_dir, nfiles)
+
+        library_inputs = {
+            'csp_files': list(map(basis_cache.file_signature, csp_fnames)),
+            'sfh_files': list(map(basis_cache.file_signature, sfh_fnames)),
+            'lsf': basis_cache.callable_signature(lsf),
+            'format_version': basis_store.BASIS_FORMAT_VERSION}
+        for k in ['log_params', 'inf_replace', 'vel_params', 'dlogl', 'z0_',
+                  'preload_llims']:
+            library_inputs[k] = fsps_args[k]
+
+        return library_inputs, init_args
+
+    @staticmethod
+    def _write_training_library(lib_dir, lib, inputs):
+        l_final, spec_lores, meta, sfh_fnames, Nsubsample, Nsfhper = lib
+        props = {'l_unit': l_final.unit.to_string(), 'sfh_fnames': sfh_fnames,
+                 'nsubpersfh': int(Nsubsample), 'nsfhperfile': int(Nsfhper),
+                 'inputs': basis_cache.canonical(inputs)}
+        basis_store.write_basis(
+            lib_dir, arrays={'l': l_final.value, 'trn_spectra': spec_lores},
+            metadata=meta, props=props, required=['l', 'trn_spectra'])
+
+    @staticmethod
+    def _read_training_library(lib_dir):
+        reader = basis_store.BasisReader(lib_dir, mmap_mode=None)
+        props = reader.props
+        meta = reader.metadata_table()
+        return (reader['l'] * u.Unit(props['l_unit']), reader['trn_spectra'],
+                meta, props['sfh_fnames'], props['nsubpersfh'],
+                props['nsfhperfile'])
+
+    @staticmethod
+    def build_training_library(lsf, base_dir, nfiles=None,
+                               log_params=[], inf_replace={}, vel_params={},
+                               dlogl=1.0e-4, z0_=.04,
+                               preload_llims=[3000. * u.AA, 10000. * u.AA],
+                               processes=1, mem_budget=None, ingest_dir=None):
+        '''
+        read, LSF-convolve, and regrid FSPS outputs (see `from_FSPS`)
+
+        CSP files are processed independently by up to `processes` workers,
+            limited by `mem_budget` (bytes), into a memory-mapped temporary
+            file in `ingest_dir` (see `csp.ingest_csp_files`)
+
+        returns (wavelengths, spectra, metadata, SFH files,
+                 # of subsamples per SFH, # of SFHs per file)
+        '''
+
+        from utils import pickle_loader, add_losvds
+        from itertools import chain
+
+        csp_fnames, sfh_fnames = StellarPop_PCA.find_training_files(
+            base_dir, nfiles)
+        print('Building training library in directory: {}'.format(base_dir))
+        print('CSP files used: {}'.format(' '.join(tuple(csp_fnames))))
+
         l = fits.getdata(csp_fnames[0], 'lam') * u.AA
         logl = np.log10(l.value)
 
         Nsubsample = fits.getval(sfh_fnames[0], ext=0, keyword='NSUBPER')
         Nsfhper = fits.getval(sfh_fnames[0], ext=0, keyword='NSFHPER')
 
-        meta = t.vstack([t.Table.read(f, format='fits', hdu=1)
-                         for f in csp_fnames])
-        spec = np.row_stack(list(map(
-            lambda fn: fits.getdata(fn, 'flam'), csp_fnames)))
+        metas = [t.Table.read(f, format='fits', hdu=1) for f in csp_fnames]
+        nrows = list(map(len, metas))
+        meta = t.vstack(metas)
+        del metas
 
         in_lrange = (l >= preload_llims[0]) * (l <= preload_llims[1])
-        spec = spec[:, in_lrange]
         l = l[in_lrange]
         logl = logl[in_lrange]
 
@@ -250,29 +395,66 @@ class StellarPop_PCA(object):
 
         #spec, meta = spec[models_good, :], meta[models_good]
 
-        # convolve spectra with instrument LSF
-        dlogl_hires = ut.determine_dlogl(logl)
-        spec_lsf = lsf(y=spec, lam=(l.value) * (1. + z0_),
-                       dlogl=dlogl_hires, z=z0_)
-
         # interpolate models to desired l range
         logl_final = np.arange(np.log10(l.value.min()),
                                np.log10(l.value.max()), dlogl)
 
         l_final = 10.**logl_final
-        spec_lores = ut.interp_large(x0=logl, y0=spec_lsf, xnew=logl_final,
-                                     axis=-1, kind='linear')
 
-        spec_lores /= spec_lores.max(axis=1)[..., None]
+        # convolve spectra with instrument LSF, regrid, and normalize
+        spec_lores = csp.ingest_csp_files(
+            fnames=csp_fnames, nrows=nrows, in_lrange=in_lrange,
+            logl_final=logl_final, lsf=lsf, z0=z0_, processes=processes,
+            mem_budget=mem_budget, tmp_dir=ingest_dir)
 
         for k in meta.colnames:
             meta[k] = meta[k].astype(np.float32)
 
-        return cls(l=l_final * l.unit, trn_spectra=spec_lores,
-                   gen_dicts=None, metadata=meta, sfh_fnames=sfh_fnames,
-                   K_obs=K_obs, dlogl=None, src='FSPS',
-                   nsubpersfh=Nsubsample, nsfhperfile=Nsfhper, basedir=base_dir,
-                   **kwargs)
+        return (l_final * l.unit, spec_lores, meta, sfh_fnames,
+                Nsubsample, Nsfhper)
+
+    @classmethod
+    def from_basis(cls, basis_dir, mmap_mode='r'):
+        '''
+        load a trained basis written by `write_basis`
+
+        arrays are memory-mapped rather than read, so this is fast, and
+            processes using the same basis share pages through the OS cache.
+            The raw training spectra are not stored, so this object can fit
+            data, but cannot be re-trained (`run_pca_models`, `xval`)
+        '''
+
+        reader = basis_store.BasisReader(basis_dir, mmap_mode=mmap_mode)
+        props = reader.props
+
+        pca = cls.__new__(cls)
+        pca.basedir = props['basedir']
+        pca.src = props['src']
+        pca.sfh_fnames = props['sfh_fnames']
+        pca.nsubpersfh = props['nsubpersfh']
+        pca.nsfhperfile = props['nsfhperfile']
+        pca.dlogl = props['dlogl']
+        pca.basis_dir = basis_dir
+
+        pca.l = reader['l'] * u.Unit(props['l_unit'])
+        pca.logl = reader['logl']
+        pca.M = reader['M']
+        pca.PCs = reader['PCs']
+        pca.trn_PC_wts = reader['trn_PC_wts']
+        for k in basis_store.optional_arrays:
+            setattr(pca, k, reader[k] if reader.has(k) else None)
+        if reader.has('cov_th_factor'):
+            pca.cov_th = LowRankCov(reader['cov_th_factor'])
+
+        pca.metadata = reader.metadata_table()
+        pca.metadata_orders = reader.metadata_orders()
+        pca.metadata_TeX = [pca.metadata[n].meta['TeX']
+                            for n in pca.metadata.colnames
+                            if 'TeX' in pca.metadata[n].meta]
+
+        pca.scaler = ut.MedianSpecScaler(X=None)
+
+        return pca
 
     # =====
     # methods
@@ -347,9 +529,13 @@ class StellarPop_PCA(object):
 
         return q
 
-    def run_pca_models(self, q):
+    def run_pca_models(self, q, cov_th_rank=None):
         '''
         run PCA on library of model spectra
+
+        if `cov_th_rank` is given, the theoretical (residual) covariance
+            is kept as a `LowRankCov` factor of that many rows, accumulated
+            from the residuals in blocks, rather than as a full nl-by-nl matrix
         '''
 
         self.scaler = ut.MedianSpecScaler(X=self.trn_spectra)
@@ -368,7 +554,11 @@ class StellarPop_PCA(object):
         # percent variance explained
         self.PVE = (self.evals_ / self.evals_.sum())[:q]
 
-        self.cov_th = np.cov(self.trn_resid, rowvar=False)
+        if cov_th_rank is None:
+            self.cov_th = np.cov(self.trn_resid, rowvar=False)
+        else:
+            self.cov_th = LowRankCov.from_residuals(
+                self.trn_resid, rank=cov_th_rank)
 
     def project_cube(self, f, ivar, mask_spax=None, mask_spec=None,
                      mask_cube=None, ivar_as_weights=True):
@@ -438,6 +628,33 @@ class StellarPop_PCA(object):
 
         hdulist.writeto(os.path.join(self.basedir, 'pc_vecs.fits'), overwrite=True)
 
+    def write_basis(self, basis_dir, float_dtype=None, skip=[]):
+        '''
+        write the trained basis to a memory-mappable directory
+            (see `basis_store`), for fast loading with `from_basis`
+
+        optional arrays named in `skip` (see `basis_store.optional_arrays`)
+            are not written
+        '''
+
+        arrays = {'l': self.l.value, 'logl': self.logl, 'M': self.M,
+                  'PCs': self.PCs, 'trn_PC_wts': self.trn_PC_wts}
+        for k in basis_store.optional_arrays:
+            arrays[k] = None if k in skip else getattr(self, k, None)
+        if isinstance(arrays['cov_th'], LowRankCov):
+            arrays['cov_th_factor'] = arrays.pop('cov_th').F
+
+        props = {'q': int(self.PCs.shape[0]), 'nl': int(self.PCs.shape[1]),
+                 'nmodels': len(self.metadata), 'dlogl': float(self.dlogl),
+                 'l_unit': self.l.unit.to_string(), 'src': self.src,
+                 'basedir': self.basedir, 'sfh_fnames': list(self.sfh_fnames),
+                 'nsubpersfh': int(self.nsubpersfh),
+                 'nsfhperfile': int(self.nsfhperfile)}
+
+        basis_store.write_basis(
+            basis_dir, arrays=arrays, metadata=self.metadata, props=props,
+            float_dtype=float_dtype)
+
     def reconstruct_normed(self, A):
         '''
         reconstruct spectra to (one-normalized) cube
@@ -494,7 +711,7 @@ class StellarPop_PCA(object):
 
         return i0_map
 
-    def compute_model_weights(self, P, A):
+    def compute_model_weights(self, P, A, planner=None):
         '''
         compute model weights for each combination of spaxel (PC fits)
             and model
@@ -504,6 +721,8 @@ class StellarPop_PCA(object):
          - A: PC weights OF OBSERVED DATA obtained from weighted PC
             projection routine (robust_project_onto_PCs),
             shape (q, NX, NY)
+         - planner: optional `partition.MemoryPlanner`, which splits the
+            map into tiles computed one at a time
 
         NOTE: this is the equivalent of taking model weights a = A[n, x, y]
             in some spaxel (x, y), and the corresp. inv-cov matrix
@@ -511,6 +730,16 @@ class StellarPop_PCA(object):
             D = C - a; and taking D \dot p \dot D
         '''
 
+        if planner is not None:
+            q, *map_shape = A.shape
+            w = np.empty((self.trn_PC_wts.shape[0], ) + tuple(map_shape))
+            for tile in planner.tiles('weights', tuple(map_shape),
+                                      nmodels=w.shape[0], q=q):
+                w[(slice(None), ) + tile] = self.compute_model_weights(
+                    P=P[(slice(None), slice(None)) + tile],
+                    A=A[(slice(None), ) + tile])
+            return w
+
         C = self.trn_PC_wts
         # C shape: [MODELNUM, PCNUM]
         # A shape: [PCNUM, XNUM, YNUM]
@@ -524,7 +753,8 @@ class StellarPop_PCA(object):
 
         return w
 
-    def param_pct_map(self, qty, W, P, mask, order=None, factor=None, add=None):
+    def param_pct_map(self, qty, W, P, mask, order=None, factor=None, add=None,
+                      planner=None):
         '''
         This is no longer iteration based, which is awesome.
 
@@ -538,11 +768,17 @@ class StellarPop_PCA(object):
             lets you get M by multiplying M/L by L
          - add: array to add to metadata[qty]. Equivalent to factor for
              log-space data
+         - planner: optional `partition.MemoryPlanner`, which splits the
+            map into tiles computed one at a time
         '''
 
         cubeshape = W.shape[-2:]
-        Q = self.metadata[qty][np.isfinite(self.metadata[qty])]
-        W = W[np.isfinite(self.metadata[qty])]
+        good = np.isfinite(self.metadata[qty])
+        Q = self.metadata[qty][good]
+
+        # use sort order precomputed with the basis, if there is one
+        if order is None:
+            order = getattr(self, 'metadata_orders', {}).get(qty, None)
 
         if factor is None:
             factor = np.ones(cubeshape)
@@ -550,7 +786,18 @@ class StellarPop_PCA(object):
         if add is None:
             add = np.zeros(cubeshape)
 
-        A = param_interp_map(v=Q, w=W, pctl=np.array(P), mask=mask, order=order)
+        if planner is None:
+            tiles = [(slice(None), slice(None))]
+        else:
+            tiles = planner.tiles('percentiles', cubeshape, nmodels=len(Q),
+                                  npctl=len(np.atleast_1d(P)))
+
+        A = np.zeros(np.array(P).shape + cubeshape)
+        for tile in tiles:
+            # only this tile's weights are copied
+            A[(Ellipsis, ) + tile] = param_interp_map(
+                v=Q, w=W[(slice(None), ) + tile][good], pctl=np.array(P),
+                mask=mask[tile], order=order)
 
         return (A + add[None, ...]) * factor[None, ...]
 
@@ -964,16 +1211,46 @@ def conservative_maskprop(a, i0, nl):
         [select_cubesequence_from_start(a, i0 + m, nl) for m in [-1, 0, 1]])
     return mask
 
+# output files written for each galaxy: name of profile maps to the
+# quantities with credible intervals (a list, or a `StellarPop_PCA` group
+# such as 'important' or 'confident'), whether to include PC amplitudes &
+# precisions and model log-likelihoods, the file title, and (optionally)
+# whether to write a compact file (see `compact_fits`)
+results_profiles = {
+    # public value-added catalog
+    'mangapca': {'qtys': ['MLi'], 'pc_info': True, 'loglike': False,
+                 'title': 'mangapca'},
+    # extended internal ("Kyle files")
+    'zpmangapca': {'qtys': ['MLi', 'MWA', 'sigma', 'logzsol',
+                            'tau_V mu', 'tau_V (1 - mu)',
+                            'Dn4000', 'Hdelta_A', 'Mg_b', 'Ca_HK',
+                            'F_1G', 'F_200M', 'uv_slope', 'tf', 'd1'],
+                   'pc_info': True, 'loglike': False, 'title': 'zpmangapca'},
+    # mocks
+    'confident': {'qtys': 'confident', 'pc_info': True, 'loglike': False,
+                  'title': 'res'}}
+
 class PCA_Result(object):
 
     '''
     store results of PCA for one galaxy using this
+
+    if `checkpoint_dir` is given, the censored data, the PC fits, and the
+        credible intervals are checkpointed there as they are completed
+        (see `checkpoint.GalaxyCheckpoint`), and a new `PCA_Result` for
+        the same galaxy & configuration resumes from them
     '''
 
+    # everything else made in preparing the data is derived from these (and
+    # from the censored values of S_cens); O & ivar are kept as float32
+    censored_attrs = ['O', 'ivar', 'mask_spax', 'i0_map', 'SNR_med', 'nodata',
+                      'mask_cube', 'a_map']
+    censored_float32 = ['O', 'ivar']
+
     def __init__(self, pca, dered, K_obs, z, cosmo, figdir='.',
                  truth=None, truth_sfh=None, dered_method='nearest',
                  dered_kwargs={}, pc_cov_method='full_iter',
-                 cov_sys_incr=4.0e-4):
+                 cov_sys_incr=4.0e-4, planner=None, checkpoint_dir=None):
         self.objname = dered.drp_hdulist[0].header['plateifu']
         self.pca = pca
         self.dered = dered
@@ -983,6 +1260,11 @@ class PCA_Result(object):
         self.truth = truth  #  known-truth parameters for fake data
         self.truth_sfh = truth_sfh  #  known-true SFH for fake data
 
+        # memory budget and tiling of solver, weights & percentiles
+        if planner is None:
+            planner = MemoryPlanner()
+        self.planner = planner
+
         # where to save all figures
         self.figdir = figdir
         self.__setup_figdir__()
@@ -991,61 +1273,178 @@ class PCA_Result(object):
         self.l = 10.**self.pca.logl
         self.M = self.pca.M
 
-        self.O, self.ivar, self.mask_spax = dered.correct_and_match(
-            template_logl=pca.logl, template_dlogl=pca.dlogl,
-            method=dered_method, dered_kwargs=dered_kwargs)
- 
-        # compute starting index of obs cov for each spaxel
-        self.i0_map = self.pca._compute_i0_map(self.K_obs.logl, self.dered.z_map)
-
-        self.drppixmask = conservative_maskprop(
-            m.mask_from_maskbits(dered.drp_hdulist['MASK'].data, [0, 3, 10]),
-            self.i0_map, len(pca.l))
-        self.eline_mask = dered.compute_eline_mask(
-            template_logl=pca.logl, template_dlogl=self.pca.dlogl,
-            half_dv=300. * u.km / u.s)
-
-        self.nl, *self.map_shape = self.O.shape
-        self.map_shape = tuple(self.map_shape)
-        self.ifu_ctr_ix = [s // 2 for s in self.map_shape]
-
-        self.SNR_med = np.median(self.O * np.sqrt(self.ivar) + eps,
-                                 axis=0)
-        # no data
-        self.nodata = (dered.drp_hdulist['RIMG'].data == 0.)
-
-        # guess bad data not caught in drp pixel mask
-        self.guessbaddata = ut.find_bad_data(self.O, self.ivar, wid=51)
-
-        # combine masks
-        self.to_impute = np.logical_or.reduce((
-            self.drppixmask, self.guessbaddata, self.eline_mask))
-        self.mask_cube = np.logical_or(
-            self.to_impute, np.logical_or(self.nodata, self.mask_spax)[None, ...])
-
-        # normalize data
-        self.O_norm, self.a_map = self.pca.scaler(self.O)
-        self.ivar_norm = self.ivar * self.a_map**2.
-
-        # subtract mean spectrum
-        self.S = (self.O / self.a_map) - self.M[:, None, None]
-        # censor masked values with weighted mean of nearby values
-        self.S_cens = ut.replace_bad_data_with_wtdmean(
-            self.S, self.ivar_norm, self.mask_cube, wid=101)
+        self.checkpoint = None
+        if checkpoint_dir is not None:
+            self.checkpoint = GalaxyCheckpoint(
+                checkpoint_dir, self.objname, self._checkpoint_config(
+                    dered_method, dered_kwargs, pc_cov_method, cov_sys_incr))
+        self._intervals = {}
+        self._products = {}
+
+        state = None
+        if self.checkpoint is not None:
+            state = self.checkpoint.load('censored')
+
+        if state is None:
+            self._prepare(dered_method, dered_kwargs)
+            if self.checkpoint is not None:
+                self.checkpoint.save('censored', **self._censored_state())
+        else:
+            self._restore_censored(state)
 
         # original spectrum
         self.O = np.ma.array(self.O, mask=self.mask_cube)
         self.O_norm = np.ma.array(self.O_norm, mask=self.mask_cube)
 
+    def _checkpoint_config(self, dered_method, dered_kwargs, pc_cov_method,
+                           cov_sys_incr):
+        '''
+        everything checkpointed products depend on, besides the data
+        '''
+        # bump 'format' when what is checkpointed changes
+        return {'format': 2, 'pcay_ver': pcay_ver, 'PCs': fingerprint(self.pca.PCs),
+                'M': fingerprint(self.pca.M),
+                'trn_PC_wts': fingerprint(self.pca.trn_PC_wts),
+                'K_obs': [self.K_obs.lllim, self.K_obs.dlogl, self.K_obs.nspec,
+                          fingerprint(np.diag(self.K_obs.cov))],
+                'z': float(self.z), 'dered_method': dered_method,
+                'dered_kwargs': dered_kwargs, 'pc_cov_method': pc_cov_method,
+                'cov_sys_incr': cov_sys_incr}
+
+    def _censored_state(self):
+        '''
+        arrays to checkpoint after censoring: `censored_attrs`, and only
+            the censored values of S_cens (elsewhere, it equals S)
+        '''
+        state = {k: getattr(self, k) for k in self.censored_attrs}
+        for k in self.censored_float32:
+            state[k] = state[k].astype(np.float32)
+        state['S_cens_masked'] = self.S_cens[self.mask_cube]
+        return state
+
+    def _restore_censored(self, state):
+        with instrument.stage('resume'):
+            for k in self.censored_attrs:
+                setattr(self, k, state[k])
+            for k in self.censored_float32:
+                setattr(self, k, state[k].astype(np.float64))
+
+            self.nl, *self.map_shape = self.O.shape
+            self.map_shape = tuple(self.map_shape)
+            self.ifu_ctr_ix = [s // 2 for s in self.map_shape]
+
+            self.O_norm = self.O / self.a_map[None, ...]
+            self.ivar_norm = self.ivar * self.a_map**2.
+            self.S = (self.O / self.a_map) - self.M[:, None, None]
+            self.S_cens = 1. * self.S
+            self.S_cens[self.mask_cube] = state['S_cens_masked']
+
+    def _prepare(self, dered_method, dered_kwargs):
+        '''
+        deredshift & regrid data, build masks, and censor masked data
+        '''
+
+        pca, dered = self.pca, self.dered
+
+        with instrument.stage('deredshift'):
+            self.O, self.ivar, self.mask_spax = dered.correct_and_match(
+                template_logl=pca.logl, template_dlogl=pca.dlogl,
+                method=dered_method, dered_kwargs=dered_kwargs)
+            instrument.record_arrays(O=self.O, ivar=self.ivar)
+
+        with instrument.stage('masks'):
+            # compute starting index of obs cov for each spaxel
+            self.i0_map = self.pca._compute_i0_map(
+                self.K_obs.logl, self.dered.z_map)
+
+            self.drppixmask = conservative_maskprop(
+                m.mask_from_maskbits(dered.drp_hdulist['MASK'].data, [0, 3, 10]),
+                self.i0_map, len(pca.l))
+            self.eline_mask = dered.compute_eline_mask(
+                template_logl=pca.logl, template_dlogl=self.pca.dlogl,
+                half_dv=300. * u.km / u.s)
+
+            self.nl, *self.map_shape = self.O.shape
+            self.map_shape = tuple(self.map_shape)
+            self.ifu_ctr_ix = [s // 2 for s in self.map_shape]
+
+            self.SNR_med = np.median(self.O * np.sqrt(self.ivar) + eps,
+                                     axis=0)
+            # no data
+            self.nodata = (dered.drp_hdulist['RIMG'].data == 0.)
+
+            # guess bad data not caught in drp pixel mask
+            self.guessbaddata = ut.find_bad_data(self.O, self.ivar, wid=51)
+
+            # combine masks
+            self.to_impute = np.logical_or.reduce((
+                self.drppixmask, self.guessbaddata, self.eline_mask))
+            self.mask_cube = np.logical_or(
+                self.to_impute,
+                np.logical_or(self.nodata, self.mask_spax)[None, ...])
+            instrument.record_arrays(mask_cube=self.mask_cube)
+
+        with instrument.stage('censoring'):
+            # normalize data
+            self.O_norm, self.a_map = self.pca.scaler(self.O)
+            self.ivar_norm = self.ivar * self.a_map**2.
+
+            # subtract mean spectrum
+            self.S = (self.O / self.a_map) - self.M[:, None, None]
+            # censor masked values with weighted mean of nearby values
+            self.S_cens = ut.replace_bad_data_with_wtdmean(
+                self.S, self.ivar_norm, self.mask_cube, wid=101)
+            instrument.record_arrays(S_cens=self.S_cens)
+
     def solve(self, vdisp_wt=False, cosmo_wt=True):
         '''
         packages together logic that solves for PC weights
         '''
 
+        state = None
+        if self.checkpoint is not None:
+            state = self.checkpoint.load('solved')
+
         # solve for PC coefficients and covariances
-        self.A, self.P_PC, self.fit_success = self.solve_cube()
+        with instrument.stage('solve'):
+            if state is None:
+                self.A, self.P_PC, self.fit_success = self.solve_cube()
+                if self.checkpoint is not None:
+                    self.checkpoint.save('solved', A=self.A, P_PC=self.P_PC,
+                                         fit_success=self.fit_success)
+            else:
+                self.A, self.P_PC, self.fit_success = \
+                    state['A'], state['P_PC'], state['fit_success']
+            instrument.record_arrays(A=self.A, P_PC=self.P_PC)
+
+        with instrument.stage('weights'):
+            self._compute_weights(vdisp_wt=vdisp_wt, cosmo_wt=cosmo_wt)
+            instrument.record_arrays(w=self.w)
 
-        self.w = pca.compute_model_weights(P=self.P_PC, A=self.A)
+        # credible intervals already found with these weights
+        self._weights_key = json.dumps([vdisp_wt, cosmo_wt])
+        self.pctls_16_50_84_.cache_clear()
+        self._intervals = {}
+        self._products = {}
+        if self.checkpoint is not None:
+            state = self.checkpoint.load('intervals')
+            if (state is not None) and \
+                (str(state.pop('__weights__')) == self._weights_key):
+                self._intervals = state
+
+    def _checkpoint_intervals(self):
+        if self.checkpoint is None:
+            return
+        self.checkpoint.save('intervals', __weights__=self._weights_key,
+                             **self._intervals)
+
+    def _compute_weights(self, vdisp_wt, cosmo_wt):
+        '''
+        model weights from PC coefficients and covariances
+        '''
+
+        self.w = self.pca.compute_model_weights(
+            P=self.P_PC, A=self.A, planner=self.planner)
 
         if cosmo_wt:
             # disallow models that are at too high a redshift for their age
@@ -1087,9 +1486,12 @@ class PCA_Result(object):
 
     def solve_cube(self):
         '''
+        solve for PC coefficients & precisions, a memory-budgeted tile
+            of spaxels at a time
         '''
-        var_norm = 1. / self.ivar_norm
-        
+        q = self.E.shape[0]
+        tiles = self.planner.tiles('solve', self.map_shape, nl=self.nl, q=q)
+
         solver = PCAProjectionSolver(
             e=self.E, K_inst_cacher=self.K_obs, K_th=self.pca.cov_th, regul=1.0e-2)
 
@@ -1097,19 +1499,32 @@ class PCA_Result(object):
             solver.solve_single, signature='(l),(l),(l),(),(),()->(q),(q,q),()',
             otypes=[np.ndarray, np.ndarray, bool])
 
-        A, P_PC, success = solve_all(
-            np.moveaxis(self.S_cens, 0, -1), np.moveaxis(var_norm, 0, -1),
-            np.moveaxis(self.mask_cube, 0, -1), self.a_map, self.i0_map, self.nodata)
+        A = np.empty((q, ) + self.map_shape)
+        P_PC = np.empty((q, q) + self.map_shape)
+        success = np.empty(self.map_shape, dtype=bool)
+
+        for tile in tiles:
+            cube_tile = (slice(None), ) + tile
+            var_norm = 1. / self.ivar_norm[cube_tile]
+
+            A_, P_PC_, success_ = solve_all(
+                np.moveaxis(self.S_cens[cube_tile], 0, -1),
+                np.moveaxis(var_norm, 0, -1),
+                np.moveaxis(self.mask_cube[cube_tile], 0, -1),
+                self.a_map[tile], self.i0_map[tile], self.nodata[tile])
+
+            P_PC[(slice(None), slice(None)) + tile] = np.moveaxis(
+                P_PC_, [0, 1, 2, 3], [2, 3, 0, 1]).astype(float)
+            A[cube_tile] = np.moveaxis(A_, -1, 0).astype(float)
+            success[tile] = success_
 
-        P_PC = np.moveaxis(P_PC, [0, 1, 2, 3], [2, 3, 0, 1]).astype(float)
-        A = np.moveaxis(A, -1, 0).astype(float)
         return A, P_PC, success
 
     def reconstruct(self):
         '''
         spectral reconstruction logic
         '''
-        self.O_recon = np.ma.array(pca.reconstruct_normed(self.A),
+        self.O_recon = np.ma.array(self.pca.reconstruct_normed(self.A),
                                    mask=self.mask_cube)
 
         self.resid = (self.O_recon - self.O_norm)
@@ -1182,8 +1597,8 @@ class PCA_Result(object):
 
         allzeroweights = (self.w[:, ix[0], ix[1]].max() == 0.)
 
-        # best fitting spectrum
-        if not allzeroweights:
+        # best fitting spectrum (if training spectra were kept)
+        if (not allzeroweights) and (self.pca.normed_trn is not None):
             bestfit = self.pca.normed_trn[np.argmax(self.w[:, ix[0], ix[1]]), :]
             bestfit_ = ax1.plot(self.l, bestfit, drawstyle='steps-mid',
                             c='c', label='Best Model', linewidth=0.5, zorder=0)
@@ -1413,7 +1828,7 @@ class PCA_Result(object):
             S.squeeze(), var_norm.squeeze(),
             mask.squeeze(), a, i0, False)
 
-        w = pca.compute_model_weights(P=P_PC[..., None, None], A=A[..., None, None])
+        w = self.pca.compute_model_weights(P=P_PC[..., None, None], A=A[..., None, None])
 
         lum = np.ma.masked_invalid(self.lum(band=band))
 
@@ -2274,10 +2689,14 @@ class PCA_Result(object):
     def pctls_16_50_84_(self, qty):
         '''
         caches result of external call to pca.param_pctl_map
+            (and keeps it for checkpointing)
         '''
-        return self.pca.param_pct_map(
-            qty, P=[16., 50., 84.], W=self.w,
-            mask=np.logical_or(self.mask_map, ~self.fit_success))
+        if qty not in self._intervals:
+            self._intervals[qty] = self.pca.param_pct_map(
+                qty, P=[16., 50., 84.], W=self.w,
+                mask=np.logical_or(self.mask_map, ~self.fit_success),
+                planner=self.planner)
+        return self._intervals[qty].copy()
 
     def param_cred_intvl(self, qty, factor=None, add=None):
         '''
@@ -2314,120 +2733,185 @@ class PCA_Result(object):
         return P50, l_unc, u_unc, scale
 
     def write_results(self, qtys='important', pc_info=True, loglike=False, title='res'):
+        '''
+        write one results file (see `write_products` to write several)
+        '''
+        self.write_products([{'qtys': qtys, 'pc_info': pc_info,
+                              'loglike': loglike, 'title': title}])
 
-        # initialize FITS hdulist
-        # PrimaryHDU is identical to DRP 0th HDU
-        hdulist = fits.HDUList([self.dered.drp_hdulist[0]])
-        # log version of PCAY (from importer.py)
-        hdulist[0].header['PCAYVER'] = pcay_ver
+    def write_products(self, profiles, compact=None):
+        '''
+        write several results files, computing each product they share once
 
+        params:
+         - profiles: names of entries of `results_profiles`, or dicts like
+            them (with keys 'qtys', 'title', and optionally 'pc_info',
+            'loglike', and 'compact')
+         - compact: if given, whether to write compact files (overriding
+            profiles' own setting)
+
+        products are cached until the model weights next change, so a
+            further call costs little more than writing the files
+        '''
+
+        profiles = [results_profiles[p] if isinstance(p, str) else p
+                    for p in profiles]
+        qtys = [self._resolve_qtys(p['qtys']) for p in profiles]
+
+        with instrument.stage('credible_intervals'):
+            for qty in qtys:
+                self._qty_hdus(qty)
+            self._checkpoint_intervals()
+
+        with instrument.stage('write'):
+            for profile, qty in zip(profiles, qtys):
+                compact_ = profile.get('compact', False) if compact is None \
+                           else compact
+                # PrimaryHDU is identical to DRP 0th HDU
+                hdulist = fits.HDUList([self.dered.drp_hdulist[0]])
+                # log version of PCAY (from importer.py)
+                hdulist[0].header['PCAYVER'] = pcay_ver
+                hdulist += self._qty_hdus(qty, compact=compact_)
+                hdulist += self._aux_hdus(
+                    pc_info=profile.get('pc_info', True),
+                    loglike=profile.get('loglike', False), compact=compact_)
+
+                fname = os.path.join(self.figdir, '{}-{}.fits'.format(
+                    profile['title'], self.objname))
+                hdulist.writeto(fname, overwrite=True)
+
+    def _resolve_qtys(self, qtys):
         if qtys == 'all':
-            qtys = self.pca.metadata.colnames
+            return self.pca.metadata.colnames
         elif qtys == 'important':
-            qtys = self.pca.important_params
+            return self.pca.important_params
         elif qtys == 'important+':
-            qtys = self.pca.importantplus_params
+            return self.pca.importantplus_params
         elif qtys == 'confident':
-            qtys = self.pca.confident_params
+            return self.pca.confident_params
+        return qtys
 
-        for qty in qtys:
-            try:
-                # retrieve results
-                P50, l_unc, u_unc, scale = self.param_cred_intvl(qty=qty)
-
-                # if ground-truth is available, list it
-                if self.truth is not None:
-                    qty_hdu.header['TRUTH'] = self.truth[qty]
-            except (KeyboardInterrupt, SystemExit) as e:
-                print(e)
-                print(e.args)
-                quit(0)
-            except:
-                P50, l_unc, u_unc, scale = \
-                    (np.full(self.map_shape, 0.), np.full(self.map_shape, -np.inf), \
-                     np.full(self.map_shape, np.inf), 'None')
-                goodparam = False
-            else:
-                goodparam = True
-            finally:
-                qty_hdu = fits.ImageHDU(np.stack([P50, l_unc, u_unc]))
-                qty_hdu.header['GOODPARAM'] = goodparam
-                qty_hdu.header['LOGSCALE'] = (scale == 'log')
-                qty_hdu.header['CHANNEL0'] = 'median'
-                qty_hdu.header['CHANNEL1'] = 'lower uncertainty'
-                qty_hdu.header['CHANNEL2'] = 'upper uncertainty'
-                qty_hdu.header['QTYNAME'] = qty
-                qty_hdu.header['EXTNAME'] = qty
-                hdulist.append(qty_hdu)
-
-        # luminosity HDU
-        lum_hdu = fits.ImageHDU(np.log10(self.lum(band='i')))
-        lum_hdu.header['EXTNAME'] = 'LOG_LUM_I'
-        hdulist.append(lum_hdu)
-
-        # make extension with median spectral SNR
-        snr_hdu = fits.ImageHDU(self.SNR_med)
-        snr_hdu.header['EXTNAME'] = 'SNRMED'
-        hdulist.append(snr_hdu)
-
-        # make extensions with mask (True denotes bad fit)
-        mask_hdu = fits.ImageHDU(self.mask_map.astype(float))
-        mask_hdu.header['EXTNAME'] = 'MASK'
-        hdulist.append(mask_hdu)
-
-        # make extension with PDF population statistics
+    def _product(self, extname, build, compact=False):
+        '''
+        HDU `extname` of results files, wrapping an array and header cards
+            made by `build` on first use (and shared by all files after)
+
+        if `compact`, the HDU is tile-compressed, and may store the array
+            more compactly (see `compact_fits.compact_hdu`)
+        '''
+        if extname not in self._products:
+            self._products[extname] = build()
+        data, cards = self._products[extname]
+
+        if compact:
+            return compact_fits.compact_hdu(data, cards, extname)
+
+        hdu = fits.ImageHDU(data)
+        for k, v in cards:
+            hdu.header[k] = v
+        hdu.header['EXTNAME'] = extname
+        return hdu
+
+    def _qty_hdus(self, qtys, compact=False):
+        '''
+        one HDU of median & uncertainties per quantity
+        '''
+
+        return [self._product(qty, partial(self._qty_product, qty), compact)
+                for qty in qtys]
+
+    def _qty_product(self, qty):
+        truth = None
+        try:
+            # retrieve results
+            P50, l_unc, u_unc, scale = self.param_cred_intvl(qty=qty)
+
+            # if ground-truth is available, list it
+            if self.truth is not None:
+                truth = self.truth[qty]
+        except (KeyboardInterrupt, SystemExit) as e:
+            print(e)
+            print(e.args)
+            quit(0)
+        except:
+            P50, l_unc, u_unc, scale = \
+                (np.full(self.map_shape, 0.), np.full(self.map_shape, -np.inf), \
+                 np.full(self.map_shape, np.inf), 'None')
+            goodparam = False
+        else:
+            goodparam = True
+
+        cards = [('GOODPARAM', goodparam), ('LOGSCALE', scale == 'log'),
+                 ('CHANNEL0', 'median'), ('CHANNEL1', 'lower uncertainty'),
+                 ('CHANNEL2', 'upper uncertainty'), ('QTYNAME', qty)]
+        if truth is not None:
+            cards.insert(0, ('TRUTH', truth))
+
+        return np.stack([P50, l_unc, u_unc]), cards
+
+    def _aux_hdus(self, pc_info, loglike, compact=False):
+        '''
+        HDUs other than quantities: luminosity, SNR, masks, PDF statistics,
+            PC amplitudes & precisions (if `pc_info`), KL divergence,
+            and model log-likelihoods (if `loglike`)
+        '''
+
+        nmodels = len(self.pca.metadata)
         fracs = np.array([.01, .05, .1, .25, .5, .9])
-        goodpdf_hdu = fits.ImageHDU(np.stack(
-            [self.sample_diag(f=f_) / len(self.pca.metadata)
-             for f_ in fracs]))
-        for fi, f_ in enumerate(fracs):
-            goodpdf_hdu.header['FRAC{}'.format(fi)] = f_
-        goodpdf_hdu.header['EXTNAME'] = 'GOODFRAC'
-        goodpdf_hdu.header['NMODELS'] = len(self.pca.metadata)
-        hdulist.append(goodpdf_hdu)
-
-        # make extension with fit success
-        fit_success_hdu = fits.ImageHDU(self.fit_success.astype(float))
-        fit_success_hdu.header['EXTNAME'] = 'SUCCESS'
-        hdulist.append(fit_success_hdu)
-
-        # make extension with best-fit model index
-        bestmodel_hdu = fits.ImageHDU(np.argmax(self.w, axis=0))
-        bestmodel_hdu.header['EXTNAME'] = 'MODELNUM'
-        hdulist.append(bestmodel_hdu)
-
-        # make extensions with pc amplitudes and normalization array
+
+        product = partial(self._product, compact=compact)
+
+        hdus = [
+            # luminosity HDU
+            product('LOG_LUM_I', lambda: (np.log10(self.lum(band='i')), [])),
+            # median spectral SNR
+            product('SNRMED', lambda: (self.SNR_med, [])),
+            # mask (True denotes bad fit)
+            product('MASK', lambda: (self.mask_map.astype(float), [])),
+            # PDF population statistics
+            product('GOODFRAC', lambda: (
+                np.stack([self.sample_diag(f=f_) / nmodels for f_ in fracs]),
+                [('FRAC{}'.format(fi), f_) for fi, f_ in enumerate(fracs)] +
+                [('NMODELS', nmodels)])),
+            # fit success
+            product('SUCCESS', lambda: (self.fit_success.astype(float), [])),
+            # best-fit model index
+            product('MODELNUM', lambda: (np.argmax(self.w, axis=0), []))]
+
+        # pc amplitudes and normalization array
         if pc_info:
-            pc_hdu = fits.ImageHDU(self.A)
-            pc_hdu.header['EXTNAME'] = 'CALPHA'
-            hdulist.append(pc_hdu)
-
-            norm_hdu = fits.ImageHDU(self.a_map)
-            norm_hdu.header['EXTNAME'] = 'NORM'
-            hdulist.append(norm_hdu)
-            
-            pc_prec_hdu = fits.ImageHDU(self.P_PC)
-            pc_prec_hdu.header['EXTNAME'] = 'CALPHA_PREC'
-            hdulist.append(pc_prec_hdu)
-
-        kld_hdu = fits.ImageHDU(self.kullback_leibler())
-        kld_hdu.header['EXTNAME'] = 'KLD'
-        hdulist.append(kld_hdu)
-
-        # make extension with model log-likelihoods
-        if loglike:
-            loglike_hdu = fits.ImageHDU(np.log(self.w.astype('float32')))
-            loglike_hdu.header['EXTNAME'] = 'LOGLIKE'
-            hdulist.append(loglike_hdu)
+            hdus += [product('CALPHA', lambda: (self.A, [])),
+                     product('NORM', lambda: (self.a_map, [])),
+                     product('CALPHA_PREC', lambda: (self.P_PC, []))]
 
-        fname = os.path.join(self.figdir, '{}-{}.fits'.format(title, self.objname, title))
+        hdus.append(product('KLD', lambda: (self.kullback_leibler(), [])))
+
+        # model log-likelihoods
+        if loglike:
+            hdus.append(product('LOGLIKE', lambda: (
+                np.log(self.w.astype('float32')), [])))
 
-        hdulist.writeto(fname, overwrite=True)
+        return hdus
 
 
 def setup_pca(base_dir, base_fname, fname=None,
               redo=True, pkl=True, q=7, nfiles=5, fre_target=.005,
-              pca_kwargs={}, makefigs=True):
+              pca_kwargs={}, makefigs=True, basis_dir=None,
+              cache_dir=None, cache_kwargs={}, cov_th_rank=None):
+    '''
+    train (or load) the PCA basis
+
+    if `basis_dir` is given and holds a stored basis with `q` PCs, that is
+        memory-mapped and returned directly; otherwise, after training,
+        the basis is written there for later runs
+
+    if `cache_dir` is given, bases and training libraries are instead
+        looked up in (and added to) a `basis_cache.BasisCache` there,
+        keyed by all inputs that affect them, so a stale basis is never
+        reused; `cache_kwargs` (`max_age`, `max_bytes`) control eviction
+
+    `cov_th_rank` is passed to `StellarPop_PCA.run_pca_models`
+    '''
 
     if (fname is None) or (not os.path.isfile(fname)) or (redo):
         run_pca = True
@@ -2439,11 +2923,48 @@ def setup_pca(base_dir, base_fname, fname=None,
     # shrink covariance matrix based on
     K_obs = cov_obs.ShrunkenCov.from_tremonti(kspec_fname, shrinkage=.005)
 
+    def check_dlogl(pca):
+        if not np.isclose(K_obs.dlogl, pca.dlogl, rtol=1.0e-3):
+            raise PCAError('non-matching log-lambda spacing ({}, {})'.format(
+                           K_obs.dlogl, pca.dlogl))
+
+    cache = None
+    if cache_dir is not None:
+        cache = basis_cache.BasisCache(cache_dir, **cache_kwargs)
+        library_inputs, fit_inputs = StellarPop_PCA.training_inputs(
+            base_dir=base_dir, nfiles=nfiles, **pca_kwargs)
+        fit_inputs['q'] = q
+        fit_inputs['cov_th_rank'] = cov_th_rank
+        if q == 'auto':
+            fit_inputs['fre_target'] = fre_target
+            fit_inputs['validation'] = basis_cache.file_signature(
+                os.path.join(base_dir, '{}_validation.fits'.format(base_fname)))
+        basis_key = cache.key({'library': library_inputs, 'fit': fit_inputs})
+
+        cached_basis_dir = cache.lookup('basis', basis_key)
+        if (not redo) and (cached_basis_dir is not None):
+            print('Using cached basis: {}'.format(cached_basis_dir))
+            pca = StellarPop_PCA.from_basis(cached_basis_dir)
+            check_dlogl(pca)
+            return pca, K_obs
+
+        # cache keys guard against staleness, so skip any pickle
+        run_pca = True
+
+    elif (basis_dir is not None) and (not redo) and \
+        basis_store.basis_exists(basis_dir):
+        pca = StellarPop_PCA.from_basis(basis_dir)
+        stored_q = pca.PCs.shape[0]
+        check_dlogl(pca)
+        if (q == 'auto') or (q == stored_q):
+            return pca, K_obs
+        print('stored basis has q = {}, not {}: not using it'.format(stored_q, q))
+
     if run_pca:
         pca = StellarPop_PCA.from_FSPS(
             K_obs=K_obs, base_dir=base_dir,
-            nfiles=nfiles, **pca_kwargs)
-        if pkl:
+            nfiles=nfiles, cache=cache, **pca_kwargs)
+        if pkl and (fname is not None):
             with open(fname, 'wb') as pk_file:
                 pickle.dump(pca, pk_file)
 
@@ -2456,9 +2977,17 @@ def setup_pca(base_dir, base_fname, fname=None,
             fname=os.path.join(base_dir, '{}_validation.fits'.format(base_fname)),
             qmax=50, target=fre_target)
         print('Optimal number of PCs:', q_opt)
-        pca.run_pca_models(q_opt)
+        pca.run_pca_models(q_opt, cov_th_rank=cov_th_rank)
     else:
-        pca.run_pca_models(q)
+        pca.run_pca_models(q, cov_th_rank=cov_th_rank)
+
+    if cache is not None:
+        pca.write_basis(cache.entry_dir('basis', basis_key))
+        evicted = cache.evict()
+        if evicted:
+            print('Evicted from basis cache: {}'.format(evicted))
+    elif basis_dir is not None:
+        pca.write_basis(basis_dir)
 
     if run_pca and makefigs:
         pca.make_PCs_fig()
@@ -2539,7 +3068,21 @@ def run_object(row, pca, K_obs, force_redo=False, fake=False, redo_fake=False,
                dered_method='nearest', dered_kwargs={}, mockspec_ix=None,
                results_basedir='.', CSPs_basedir='.', mockspec_fname='CSPs_test.fits',
                mocksfh_fname='SFHs_test.fits', vdisp_wt=False,
-               pc_cov_method='full_iter', makefigs=True, mpl_v='MPL-7', sky=None):
+               pc_cov_method='full_iter', makefigs=True, mpl_v='MPL-7', sky=None,
+               prefetcher=None, profile=False, planner=None, checkpoint_dir=None):
+    '''
+    fit one galaxy (or a mock based on it)
+
+    if `profile`, the run is profiled (see `profiling.galaxy_profile`), and
+        the profile and allocation report are written beside the results
+
+    `planner` (a `partition.MemoryPlanner`) sets the memory budget of
+        the fit (default: measured from cgroup limit or available memory)
+
+    if `checkpoint_dir` is given, a fit of observed data resumes from (and
+        adds to) checkpoints there (see `PCA_Result`); mocks are drawn anew
+        each time, so are never checkpointed
+    '''
 
     plateifu = row['plateifu']
 
@@ -2549,47 +3092,55 @@ def run_object(row, pca, K_obs, force_redo=False, fake=False, redo_fake=False,
 
     plate, ifu = plateifu.split('-')
 
-    if fake:
-        dered, data, truth, truth_sfh = setup_fake(
-            row, pca, K_obs, dered_method=dered_method, dered_kwargs=dered_kwargs,
-            mockspec_ix=mockspec_ix, CSPs_dir=CSPs_basedir, fakedata_basedir=results_basedir,
-            mockspec_fname=mockspec_fname, mocksfh_fname=mocksfh_fname, mpl_v=mpl_v,
-            sky=sky)
-        figdir = os.path.join(results_basedir, plate)
-
-    else:
-        dered = MaNGA_deredshift.from_plateifu(
-            plate=int(plate), ifu=int(ifu), MPL_v=mpl_v, row=row, kind=daptype)
-        figdir = os.path.join(results_basedir, plate)
-        truth_sfh = None
-        truth = None
-
-    z_dist = row['nsa_zdist']
-
-    pca_res = PCA_Result(
-        pca=pca, dered=dered, K_obs=K_obs, z=z_dist,
-        cosmo=cosmo, figdir=figdir, truth=truth, truth_sfh=truth_sfh,
-        dered_method=dered_method, dered_kwargs=dered_kwargs, pc_cov_method=pc_cov_method)
-    pca_res.solve(vdisp_wt=vdisp_wt)
-    pca_res.reconstruct()
+    with profiling.galaxy_profile(
+            plateifu, os.path.join(results_basedir, plate), enabled=profile):
+        with instrument.stage('load'):
+            if fake:
+                dered, data, truth, truth_sfh = setup_fake(
+                    row, pca, K_obs, dered_method=dered_method,
+                    dered_kwargs=dered_kwargs, mockspec_ix=mockspec_ix,
+                    CSPs_dir=CSPs_basedir, fakedata_basedir=results_basedir,
+                    mockspec_fname=mockspec_fname, mocksfh_fname=mocksfh_fname,
+                    mpl_v=mpl_v, sky=sky)
+                figdir = os.path.join(results_basedir, plate)
 
-    if makefigs:
-        pca_res.make_full_QA_fig(kde=(False, False))
-        pca_res.make_sample_diag_fig()
-        pca_res.make_qty_fig(qty_str='MLi')
-
-    if fake:
-        # delete intermediate files
-        drp_fname = os.path.join(
-            fakedata_basedir, '{}_drp.fits'.format(pca_res.objname))
-        dap_fname = os.path.join(
-            fakedata_basedir, '{}_dap.fits'.format(pca_res.objname))
-        truth_fname = os.path.join(
-            fakedata_basedir, '{}_truth.tab'.format(pca_res.objname))
-        for fn in [drp_fname, dap_fname, truth_fname]:
-            os.remove(fn)
-
-    return pca_res
+            else:
+                hdulists = None if prefetcher is None else prefetcher.get(plateifu)
+                dered = MaNGA_deredshift.from_plateifu(
+                    plate=int(plate), ifu=int(ifu), MPL_v=mpl_v, row=row, kind=daptype,
+                    hdulists=hdulists)
+                figdir = os.path.join(results_basedir, plate)
+                truth_sfh = None
+                truth = None
+
+        z_dist = row['nsa_zdist']
+
+        pca_res = PCA_Result(
+            pca=pca, dered=dered, K_obs=K_obs, z=z_dist,
+            cosmo=cosmo, figdir=figdir, truth=truth, truth_sfh=truth_sfh,
+            dered_method=dered_method, dered_kwargs=dered_kwargs, pc_cov_method=pc_cov_method,
+            planner=planner, checkpoint_dir=None if fake else checkpoint_dir)
+        pca_res.solve(vdisp_wt=vdisp_wt)
+        pca_res.reconstruct()
+
+        if makefigs:
+            with instrument.stage('figures'):
+                pca_res.make_full_QA_fig(kde=(False, False))
+                pca_res.make_sample_diag_fig()
+                pca_res.make_qty_fig(qty_str='MLi')
+
+        if fake:
+            # delete intermediate files
+            drp_fname = os.path.join(
+                fakedata_basedir, '{}_drp.fits'.format(pca_res.objname))
+            dap_fname = os.path.join(
+                fakedata_basedir, '{}_dap.fits'.format(pca_res.objname))
+            truth_fname = os.path.join(
+                fakedata_basedir, '{}_truth.tab'.format(pca_res.objname))
+            for fn in [drp_fname, dap_fname, truth_fname]:
+                os.remove(fn)
+
+        return pca_res
 
 
 def add_bool_arg(parser, name, default, help_string):
@@ -2678,18 +3229,70 @@ if __name__ == '__main__':
     add_bool_arg(parser, 'mockfromresults', default=False,
                  help_string='use results from obs to construct mock')
 
+    parser.add_argument('--trainprocs', default=1, type=int, required=False,
+                        help='number of processes used to build training library')
+    parser.add_argument('--trainmem', default=None, type=float, required=False,
+                        help='memory budget (GB) for building training library')
+    parser.add_argument('--covthrank', default=None, type=int, required=False,
+                        help='store theory covariance as low-rank factor of this rank')
+    parser.add_argument('--nworkers', default=1, type=int, required=False,
+                        help='number of galaxies fit at once, in separate processes')
+    parser.add_argument('--blasthreads', default=None, type=int, required=False,
+                        help='BLAS threads per worker (default: cores // nworkers)')
+    parser.add_argument('--jobdb', default=pca_status.default_jobdb_fname,
+                        required=False, help='job-state database (on local disk; one per node)')
+    parser.add_argument('--claimdir', required=False,
+                        default=pca_status.default_claim_dir,
+                        help='lease directory shared by all nodes')
+    parser.add_argument('--leasetime', default=leases.default_lease_time,
+                        type=float, required=False,
+                        help='seconds without heartbeat before a lease is stale')
+    parser.add_argument('--maxattempts', default=leases.default_max_attempts,
+                        type=int, required=False,
+                        help='failed attempts (on any node) after which a galaxy is not retried')
+    parser.add_argument('--runid', required=False,
+                        default=os.environ.get('SLURM_ARRAY_JOB_ID',
+                                               os.environ.get('SLURM_JOB_ID')),
+                        help='id shared by all nodes of one run, so that '
+                             '--no-ensurenew redoes each galaxy once per run '
+                             '(default: SLURM job id)')
+    parser.add_argument('--prefetch', default='local', required=False,
+                        choices=['none'] + list(prefetch.storage_profiles),
+                        help='read ahead next galaxies\' data, tuned for storage type')
+    parser.add_argument('--prefetchdepth', default=None, type=int, required=False,
+                        help='number of galaxies to read ahead (overrides profile)')
+    parser.add_argument('--instrumentdir', required=False,
+                        default=os.path.join(manga_results_basedir, 'instrument'),
+                        help='where per-stage timing & memory records are written')
+    add_bool_arg(parser, 'profile', default=False,
+                 help_string='profile galaxies (cProfile & tracemalloc)')
+    parser.add_argument('--profileevery', default=1, type=int, required=False,
+                        help='profile only one in this many galaxies')
+    add_bool_arg(parser, 'compactresults', default=False,
+                 help_string='write compressed, reduced-precision results files')
+    add_bool_arg(parser, 'checkpoint', default=False,
+                 help_string='checkpoint intermediate products, to resume failed fits')
+    parser.add_argument('--checkpointdir', required=False,
+                        default=os.path.join(manga_results_basedir, 'checkpoints'),
+                        help='where checkpoints are kept until a galaxy succeeds')
+    parser.add_argument('--membudget', default=None, type=float, required=False,
+                        help='memory budget (GB) of each galaxy fit '
+                             '(default: measured, shared among workers)')
+
     rungroup = parser.add_mutually_exclusive_group(required=False)
     rungroup.add_argument('--plateifus', '-p', nargs='+', type=str,
                           help='plateifu designations of galaxies to run')
     rungroup.add_argument('--nrun', '-n', help='number of galaxies to run', type=int)
 
     argsparsed = parser.parse_args()
+    cov_obs.print_data_info()
 
     print(argsparsed)
     #'''
 
     #'''
     howmany = 0
+    plateifus = []
     cosmo = WMAP9
     warn_behav = 'ignore'
     dered_method = 'drizzle'
@@ -2702,14 +3305,20 @@ if __name__ == '__main__':
     
     if argsparsed.mock or argsparsed.manga:
         lsf = ut.MaNGA_LSF.from_drpall(drpall=drpall, n=2)
+        trainmem = argsparsed.trainmem
         pca_kwargs = {'lllim': 3700. * u.AA, 'lulim': 8800. * u.AA,
-                      'lsf': lsf, 'z0_': .04}
+                      'lsf': lsf, 'z0_': .04,
+                      'processes': argsparsed.trainprocs,
+                      'mem_budget': None if trainmem is None else trainmem * 1024**3}
 
         pca_pkl_fname = os.path.join(csp_basedir, 'pca.pkl')
+        pca_cache_dir = os.path.join(csp_basedir, 'basis_cache')
         pca, K_obs = setup_pca(
             fname=pca_pkl_fname, base_dir=argsparsed.csp_basedir, base_fname='CSPs',
-            redo=False, pkl=True, q=6, fre_target=.005, nfiles=40,
-            pca_kwargs=pca_kwargs, makefigs=True)
+            redo=False, pkl=False, q=6, fre_target=.005, nfiles=40,
+            pca_kwargs=pca_kwargs, makefigs=True, cache_dir=pca_cache_dir,
+            cache_kwargs={'max_age': 90 * 86400},
+            cov_th_rank=argsparsed.covthrank)
 
         K_obs.precompute_Kpcs(pca.PCs)
         K_obs._init_windows(len(pca.l))
@@ -2726,85 +3335,151 @@ if __name__ == '__main__':
         howmany = argsparsed.nrun
         plateifus = np.random.permutation(list(drpall['plateifu']))  
 
-    i = 0
-    while i < howmany:
-        plateifu = plateifus[i]
+    checkpoint_dir = argsparsed.checkpointdir if argsparsed.checkpoint else None
+
+    # tiles each fit's largest stages to fit in memory
+    planner = MemoryPlanner(
+        budget=None if argsparsed.membudget is None else argsparsed.membudget * 1024**3,
+        nshare=argsparsed.nworkers)
+
+    jobs = pca_status.JobStore(argsparsed.jobdb)
+    claims = leases.LeaseDir(argsparsed.claimdir, lease_time=argsparsed.leasetime,
+                             max_attempts=argsparsed.maxattempts,
+                             run_id=argsparsed.runid)
+    # galaxies with log-files from older runs, or markers from any node's
+    # runs, are not pending
+    jobs.import_logs(drpall)
+    jobs.import_claims(claims)
+
+    def fit_plateifu(plateifu):
+        '''
+        fit one galaxy end-to-end: True on success, False on failure,
+            None if skipped
+        '''
         row = drpall.loc[plateifu]
 
-        if pca_status.log_file_exists(plateifu):
-            if ~argsparsed.ensurenew:
-                continue
-            else:
-                i += 1
-        else:
-            i += 1
+        # atomically claim galaxy across nodes, then locally: the lease
+        # directory alone decides whether a galaxy is (re)tried, and while
+        # we hold the lease, any local 'running' record is left by a dead worker
+        lease = claims.acquire(plateifu, redo=not argsparsed.ensurenew)
+        if lease is None:
+            return None
+        if not jobs.claim(plateifu, redo=True, reclaim=True):
+            lease.release()
+            return None
+
+        instrument.start(plateifu, ifudesignsize=int(row['ifudesignsize']))
+        status = 'failed'
+
+        # profile whole galaxy (fits and results), written beside its results
+        profile_dir = os.path.join(
+            argsparsed.mangaresultsdest if argsparsed.manga else
+            argsparsed.mockresultsdest, plateifu.split('-')[0])
+        profile = argsparsed.profile and \
+            profiling.sampled(plateifu, argsparsed.profileevery)
 
-        # log your start by overwriting any existing log file
-        pca_status.write_log_file(plateifu, 'STARTING', clobber=True)
-        
         try:
-            with catch_warnings():
+            with catch_warnings(), \
+                profiling.galaxy_profile(plateifu, profile_dir, enabled=profile):
                 simplefilter(warn_behav)
-                
-                if argsparsed.manga:
-                    pca_status.write_log_file(plateifu, 'Begin MaNGA analysis')
-                    pca_status.write_log_file(plateifu, 'Fitting with basis set')
-                    pca_res = run_object(
-                        row=row, pca=pca, K_obs=K_obs, force_redo=argsparsed.clobbermanga,
-                        fake=False, redo_fake=False, dered_method=dered_method,
-                        dered_kwargs=dered_kwargs,
-                        results_basedir=argsparsed.mangaresultsdest,
-                        CSPs_basedir=csp_basedir, vdisp_wt=False,
-                        pc_cov_method=pc_cov_method, mpl_v=mpl_v,
-                        makefigs=argsparsed.figs)
-                    pca_status.write_log_file(plateifu, 'Fit complete')
-                    
-                    # write results for general consumption
-                    pca_status.write_log_file(plateifu, 'Writing basic results')
-                    pca_res.write_results(['MLi'], title='mangapca')
-                    pca_status.write_log_file(plateifu, 'Done writing basic results')
-                    
-                    # write results for me ("Kyle files")
-                    pca_status.write_log_file(plateifu, 'Writing advanced results')
-                    pca_res.write_results(
-                        qtys=['MLi', 'MWA', 'sigma', 'logzsol', 
-                              'tau_V mu',  'tau_V (1 - mu)',
-                              'Dn4000', 'Hdelta_A', 'Mg_b', 'Ca_HK',
-                              'F_1G', 'F_200M', 'uv_slope',
-                              'tf', 'd1'],
-                        title='zpmangapca')
-                    pca_status.write_log_file(plateifu, 'Done writing advanced results')
-                    pca_status.write_log_file(plateifu, 'End MaNGA analysis')
 
+                if argsparsed.manga:
+                    with jobs.stage(plateifu, 'manga_fit'):
+                        pca_res = run_object(
+                            row=row, pca=pca, K_obs=K_obs,
+                            force_redo=argsparsed.clobbermanga,
+                            fake=False, redo_fake=False, dered_method=dered_method,
+                            dered_kwargs=dered_kwargs,
+                            results_basedir=argsparsed.mangaresultsdest,
+                            CSPs_basedir=csp_basedir, vdisp_wt=False,
+                            pc_cov_method=pc_cov_method, mpl_v=mpl_v,
+                            makefigs=argsparsed.figs, prefetcher=prefetcher,
+                            planner=planner, checkpoint_dir=checkpoint_dir)
+
+                    # write results for general consumption, and for me
+                    # ("Kyle files"), sharing their common products
+                    with jobs.stage(plateifu, 'manga_results'):
+                        pca_res.write_products(['mangapca', 'zpmangapca'],
+                                               compact=argsparsed.compactresults)
+
+                    pca_res.dered.close()
 
                 if argsparsed.mock:
-                    pca_status.write_log_file(plateifu, 'Begin mocks analysis')
-                    pca_status.write_log_file(plateifu, 'Fitting with basis set')
-                    pca_res_f = run_object(
-                        row=row, pca=pca, K_obs=K_obs, force_redo=argsparsed.clobbermock,
-                        fake=False, redo_fake=argsparsed.clobbermock,
-                        dered_method=dered_method, dered_kwargs=dered_kwargs,
-                        results_basedir=argsparsed.mockresultsdest,
-                        CSPs_basedir=csp_basedir, vdisp_wt=False,
-                        pc_cov_method=pc_cov_method, mpl_v=mpl_v,
-                        makefigs=argsparsed.figs, sky=skymodel)
-                    pca_status.write_log_file(plateifu, 'Fit complete')
-                    
-                    pca_status.write_log_file(plateifu, 'Writing confident results')
-                    pca_res_f.write_results('confident')
-                    pca_status.write_log_file(plateifu, 'Done writing confident results')
-                    
-                    pca_status.write_log_file(plateifu, 'End mocks analysis')
+                    with jobs.stage(plateifu, 'mock_fit'):
+                        pca_res_f = run_object(
+                            row=row, pca=pca, K_obs=K_obs,
+                            force_redo=argsparsed.clobbermock,
+                            fake=False, redo_fake=argsparsed.clobbermock,
+                            dered_method=dered_method, dered_kwargs=dered_kwargs,
+                            results_basedir=argsparsed.mockresultsdest,
+                            CSPs_basedir=csp_basedir, vdisp_wt=False,
+                            pc_cov_method=pc_cov_method, mpl_v=mpl_v,
+                            makefigs=argsparsed.figs, sky=skymodel,
+                            planner=planner)
+
+                    with jobs.stage(plateifu, 'mock_confident_results'):
+                        pca_res_f.write_products(['confident'],
+                                                 compact=argsparsed.compactresults)
+
+                    pca_res_f.dered.close()
 
         except Exception as e:
             exc_info = sys.exc_info()
             print('ERROR: {}'.format(plateifu))
             print_exception(*exc_info)
-            pca_status.write_log_file(plateifu, repr(e))
-            continue
+            jobs.release(plateifu, success=False, error=repr(e))
+            claims.finish(lease, plateifu, success=False, error=repr(e))
+            return False
         else:
-            pca_status.write_log_file(plateifu, 'SUCCESS')
+            status = 'success'
+            if checkpoint_dir is not None:
+                checkpoint.clear_galaxy(checkpoint_dir, plateifu)
+            jobs.release(plateifu, success=True)
+            if not claims.finish(lease, plateifu, success=True):
+                print('WARNING: lease on {} was lost while running'.format(plateifu))
             print('{} completed successfully'.format(plateifu))
+            return True
         finally:
-            pca_status.write_log_file(plateifu, 'ENDING GRACEFULLY')
+            record = instrument.finish(status)
+            instrument.write_record(record, run_dir)
+            print('{}: {:.1f} s, peak memory {:.2f} GB'.format(
+                plateifu, record['wall'], record['peak_rss'] / 1024.**3))
+
+    # per-stage timing & memory records for this run
+    run_dir = instrument.new_run_dir(argsparsed.instrumentdir)
+
+    # read-ahead follows the order of `plateifus`, so only with one worker
+    prefetcher = None
+    if argsparsed.manga and (argsparsed.prefetch != 'none') and \
+        (argsparsed.nworkers == 1):
+        prefetch_kwargs = {}
+        if argsparsed.prefetchdepth is not None:
+            prefetch_kwargs['depth'] = argsparsed.prefetchdepth
+        prefetcher = prefetch.Prefetcher.from_profile(
+            list(plateifus),
+            loader=lambda plateifu: prefetch.load_manga_cubes(
+                plateifu, mpl_v, daptype),
+            profile=argsparsed.prefetch,
+            skip=lambda plateifu: claims.is_settled(
+                plateifu, redo=not argsparsed.ensurenew),
+            **prefetch_kwargs)
+
+    share_dir = scheduler.default_share_dir()
+    try:
+        if argsparsed.mock or argsparsed.manga:
+            pca = scheduler.share_basis(pca, share_dir,
+                                        keep_training=argsparsed.figs)
+            K_obs = scheduler.share_K_obs(K_obs, share_dir, len(pca.l))
+
+        galaxy_scheduler = scheduler.GalaxyScheduler(
+            fit_plateifu, nworkers=argsparsed.nworkers,
+            blas_threads=argsparsed.blasthreads)
+        galaxy_scheduler.run(plateifus, target=howmany)
+
+        if os.listdir(run_dir):
+            print(instrument.write_summary(run_dir))
+    finally:
+        scheduler.cleanup_share_dir(share_dir)
+        if prefetcher is not None:
+            prefetcher.close()
     #'''
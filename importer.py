@@ -8,6 +8,9 @@ csp_basedir = os.environ['PCAY_CSPBASE']
 manga_results_basedir = os.environ['PCAY_RESULTSDIR']
 mocks_results_basedir = os.path.join(
     os.environ['PCAY_RESULTSDIR'], 'mocks')
+# catalogs from outside the SAS (see catalogs.py)
+catalog_dir = os.environ.get(
+    'PCAY_CATALOGDIR', '/usr/data/minhas/zpace/stellarmass_pca')
 
 from astropy.cosmology import WMAP9
 cosmo = WMAP9
@@ -0,0 +1,277 @@
+'''
+per-stage timing and memory instrumentation of the galaxy pipeline
+
+a `StageRecorder` is started for each galaxy; code anywhere in the pipeline
+    then wraps its main stages in `with instrument.stage('solve'):` (or
+    decorates them with `@instrument.timed('solve')`), and may note the sizes
+    of the arrays it builds with `instrument.record_arrays(...)`. With no
+    recorder started, these do nothing
+
+each stage records wall time, CPU time, and peak RSS; each galaxy's record
+    is appended as one JSON line to a per-process file in a run directory,
+    and `summarize` aggregates a run's records by stage and IFU size
+'''
+
+import numpy as np
+
+import os
+import json
+import time
+import socket
+from glob import glob
+from functools import wraps
+from contextlib import contextmanager
+
+_current = None
+
+
+def _peak_rss():
+    from utils import peak_rss
+    return peak_rss()
+
+
+def _reset_peak_rss():
+    from utils import reset_peak_rss
+    return reset_peak_rss()
+
+
+def _current_rss():
+    from utils import current_rss
+    return current_rss()
+
+
+class StageRecorder(object):
+    '''
+    timing and memory record of one galaxy's pass through the pipeline
+
+    params:
+     - name: name of galaxy (e.g., plateifu)
+     - info: other JSON-serializable properties to record (e.g., IFU size)
+    '''
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+        self.stages = []
+        self._active = []
+
+        _reset_peak_rss()
+        self.peak_rss = 0
+        self.wall0, self.cpu0 = time.perf_counter(), time.process_time()
+
+    def _fold_peak(self):
+        # peak RSS is reset at the start of each stage, so the peak so far
+        # is folded into every enclosing stage, and the galaxy, first
+        p = _peak_rss()
+        for rec in self._active:
+            rec['peak_rss'] = max(rec['peak_rss'], p)
+        self.peak_rss = max(self.peak_rss, p)
+
+    @contextmanager
+    def stage(self, stage):
+        self._fold_peak()
+        rec = {'stage': stage, 'peak_rss': 0, 'rss_start': _current_rss(),
+               'est_bytes': None, 'arrays': {}, 'error': None}
+        self._active.append(rec)
+        _reset_peak_rss()
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+
+        try:
+            yield rec
+        except Exception as e:
+            rec['error'] = repr(e)
+            raise
+        finally:
+            rec['wall'] = time.perf_counter() - wall0
+            rec['cpu'] = time.process_time() - cpu0
+            self._fold_peak()
+            self._active.pop()
+            self.stages.append(rec)
+
+    def record_arrays(self, **arrays):
+        '''
+        note shapes and sizes of arrays in the innermost active stage
+        '''
+        if not self._active:
+            return
+        for k, a in arrays.items():
+            a = np.asarray(a)
+            self._active[-1]['arrays'][k] = {
+                'shape': list(a.shape), 'nbytes': int(a.nbytes)}
+
+    def record_estimate(self, nbytes):
+        '''
+        note a planned memory use (bytes beyond RSS at its start) of the
+            innermost active stage, to compare with its measured peak
+        '''
+        if not self._active:
+            return
+        rec = self._active[-1]
+        rec['est_bytes'] = max(rec['est_bytes'] or 0, int(nbytes))
+
+    def finish(self, status):
+        self._fold_peak()
+        record = {'name': self.name, 'status': status,
+                  'host': socket.gethostname(), 'pid': os.getpid(),
+                  'wall': time.perf_counter() - self.wall0,
+                  'cpu': time.process_time() - self.cpu0,
+                  'peak_rss': self.peak_rss, 'stages': self.stages}
+        record.update(self.info)
+        return record
+
+
+def start(name, **info):
+    '''
+    start recording a galaxy (becomes the target of `stage`, etc.)
+    '''
+    global _current
+    _current = StageRecorder(name, **info)
+    return _current
+
+
+def finish(status):
+    '''
+    end recording current galaxy, returning its record
+    '''
+    global _current
+    if _current is None:
+        return None
+    record = _current.finish(status)
+    _current = None
+    return record
+
+
+@contextmanager
+def stage(name):
+    if _current is None:
+        yield None
+    else:
+        with _current.stage(name) as rec:
+            yield rec
+
+
+def timed(name):
+    '''
+    decorator: record each call of a function as stage `name`
+    '''
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_arrays(**arrays):
+    if _current is not None:
+        _current.record_arrays(**arrays)
+
+
+def record_estimate(nbytes):
+    if _current is not None:
+        _current.record_estimate(nbytes)
+
+
+def new_run_dir(basedir):
+    '''
+    directory for the records of one run
+    '''
+    run_dir = os.path.join(basedir, 'run-{}-{}-{}'.format(
+        time.strftime('%Y%m%d-%H%M%S'), socket.gethostname(), os.getpid()))
+    os.makedirs(run_dir, exist_ok=True)
+    return run_dir
+
+
+def write_record(record, run_dir):
+    '''
+    append a galaxy's record to this process's JSON-lines file
+    '''
+    fname = os.path.join(run_dir, 'stages-{}-{}.jsonl'.format(
+        socket.gethostname(), os.getpid()))
+    with open(fname, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def load_records(run_dir):
+    records = []
+    for fname in sorted(glob(os.path.join(run_dir, 'stages-*.jsonl'))):
+        with open(fname, 'r') as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return records
+
+
+def summarize(records, group_col='ifudesignsize'):
+    '''
+    aggregate galaxy records by `group_col` and stage
+
+    a stage run several times for one galaxy (e.g., writing two result
+        files) is summed for that galaxy first. Returns astropy table with
+        the number of galaxies, median and mean wall time, mean CPU time,
+        mean fraction of galaxy wall time, and maximum peak RSS (GB)
+
+    for stages with a planned memory use (see `partition.MemoryPlanner`),
+        the largest estimate and the largest measured growth of RSS over
+        the stage (peak less RSS at its start) are also given (GB), with
+        their ratio (measured / estimated)
+    '''
+    from astropy import table as t
+
+    per_stage = {}
+    for record in records:
+        group = record.get(group_col, -1)
+        totals = {}
+        for rec in record['stages']:
+            tot = totals.setdefault(
+                rec['stage'], {'wall': 0., 'cpu': 0., 'peak_rss': 0,
+                               'est': 0, 'growth': 0})
+            tot['wall'] += rec['wall']
+            tot['cpu'] += rec['cpu']
+            tot['peak_rss'] = max(tot['peak_rss'], rec['peak_rss'])
+            if rec.get('est_bytes'):
+                tot['est'] = max(tot['est'], rec['est_bytes'])
+                tot['growth'] = max(tot['growth'],
+                                    rec['peak_rss'] - rec['rss_start'])
+        totals['TOTAL'] = {'wall': record['wall'], 'cpu': record['cpu'],
+                           'peak_rss': record['peak_rss'], 'est': 0, 'growth': 0}
+        for s, tot in totals.items():
+            tot['frac'] = tot['wall'] / record['wall'] if record['wall'] else 0.
+            per_stage.setdefault((group, s), []).append(tot)
+
+    rows = []
+    for (group, s), tots in sorted(per_stage.items(), key=lambda kv: (
+            kv[0][0], kv[0][1] == 'TOTAL', kv[0][1])):
+        wall = np.array([tot['wall'] for tot in tots])
+        est = max(tot['est'] for tot in tots)
+        growth = max(tot['growth'] for tot in tots)
+        rows.append((group, s, len(tots), np.median(wall), wall.mean(),
+                     np.mean([tot['cpu'] for tot in tots]),
+                     np.mean([tot['frac'] for tot in tots]),
+                     max(tot['peak_rss'] for tot in tots) / 1024.**3,
+                     est / 1024.**3, growth / 1024.**3,
+                     growth / est if est else np.nan))
+
+    return t.Table(rows=rows if rows else None,
+                   names=[group_col, 'stage', 'n', 'wall_med', 'wall_mean',
+                          'cpu_mean', 'wall_frac', 'peak_rss_gb',
+                          'est_gb', 'growth_gb', 'growth/est'])
+
+
+def write_summary(run_dir, group_col='ifudesignsize'):
+    summary = summarize(load_records(run_dir), group_col=group_col)
+    summary.write(os.path.join(run_dir, 'summary.ecsv'),
+                  format='ascii.ecsv', overwrite=True)
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='summarize per-stage timing and memory of a run')
+    parser.add_argument('run_dir', help='directory of JSON-lines stage records')
+    parser.add_argument('--groupby', default='ifudesignsize',
+                        help='galaxy property to group by')
+    argsparsed = parser.parse_args()
+
+    write_summary(argsparsed.run_dir, group_col=argsparsed.groupby).pprint(
+        max_lines=-1, max_width=-1)
@@ -0,0 +1,402 @@
+'''
+cross-node claiming of galaxies with lock files on a shared filesystem
+
+a worker claims a galaxy by atomically creating `<name>.lease` in a claim
+    directory (`O_CREAT | O_EXCL`, which is atomic on local filesystems and
+    on NFSv3+). While it works, a heartbeat thread refreshes the file's
+    modification time. A lease whose file has not been refreshed for
+    `lease_time` seconds belongs to a dead worker, and may be reclaimed:
+    the reclaimer atomically renames the stale file aside (only one
+    reclaimer can succeed), and then claims the galaxy as usual. Ages are
+    measured against the filesystem's own clock, so clock skew between
+    nodes does not matter
+
+completed galaxies get a `<name>.done` marker, so no node claims them again
+    unless asked to redo them; failed galaxies get a `<name>.failed` marker
+    counting their failed attempts, and are not claimed again once they
+    have failed `max_attempts` times (unless asked to redo them). Markers
+    record the id of the run that wrote them: redoing ignores (and, once
+    the lease is held, removes) only markers from other runs, so nodes
+    sharing a run id do not redo each other's work
+
+no external service is needed; run this module directly to exercise the
+    protocol with several local processes
+'''
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+
+default_lease_time = 1800.
+default_max_attempts = 2
+
+
+class LeaseLost(Exception):
+    '''
+    a lease was reclaimed by another worker while still in use
+    '''
+    pass
+
+
+def owner_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class Lease(object):
+    '''
+    a held claim on one name, kept alive by a heartbeat thread
+
+    `lost` becomes True if the heartbeat finds the lease file gone or
+        replaced (i.e., another worker judged this one dead)
+    '''
+    def __init__(self, fname, token, heartbeat_interval, reclaimed=False):
+        self.fname = fname
+        self.token = token
+        self.reclaimed = reclaimed
+        self.lost = False
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._beat, args=(heartbeat_interval, ), daemon=True)
+        self._thread.start()
+
+    def _beat(self, interval):
+        while not self._stop.wait(interval):
+            if not self.is_held():
+                self.lost = True
+                return
+            try:
+                os.utime(self.fname)
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+    def is_held(self):
+        try:
+            with open(self.fname, 'r') as f:
+                return json.load(f)['token'] == self.token
+        except (FileNotFoundError, ValueError, KeyError):
+            return False
+
+    def check(self):
+        '''
+        raise `LeaseLost` if the lease is no longer held
+        '''
+        if self.lost or not self.is_held():
+            self.lost = True
+            raise LeaseLost(self.fname)
+
+    def release(self):
+        '''
+        stop heartbeat and remove lease file (if still ours)
+
+        returns whether the lease was still held
+        '''
+        self._stop.set()
+        self._thread.join()
+        held = self.is_held()
+        if held:
+            os.remove(self.fname)
+        return held
+
+
+class LeaseDir(object):
+    '''
+    directory of lease files and completion markers
+
+    params:
+     - claim_dir: directory on the filesystem shared by all nodes
+     - lease_time: seconds without a heartbeat after which a lease is stale
+     - heartbeat_interval: seconds between heartbeats (default a quarter
+        of `lease_time`)
+     - max_attempts: number of failed attempts after which a name is no
+        longer claimed (unless redone)
+     - run_id: identifies the run, which all nodes working together must
+        share (default: a new id, so this process is its own run)
+    '''
+    def __init__(self, claim_dir, lease_time=default_lease_time,
+                 heartbeat_interval=None, max_attempts=default_max_attempts,
+                 run_id=None):
+        self.claim_dir = claim_dir
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        if run_id is None:
+            run_id = uuid.uuid4().hex
+        self.run_id = str(run_id)
+        if heartbeat_interval is None:
+            heartbeat_interval = lease_time / 4.
+        self.heartbeat_interval = heartbeat_interval
+
+        os.makedirs(claim_dir, exist_ok=True)
+
+    def lease_fname(self, name):
+        return os.path.join(self.claim_dir, '{}.lease'.format(name))
+
+    def done_fname(self, name):
+        return os.path.join(self.claim_dir, '{}.done'.format(name))
+
+    def failed_fname(self, name):
+        return os.path.join(self.claim_dir, '{}.failed'.format(name))
+
+    def _read_marker(self, fname, redo=False):
+        '''
+        contents of a marker, or None if absent (or, if `redo`, if written
+            by another run)
+        '''
+        try:
+            with open(fname, 'r') as f:
+                info = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            info = {}
+        if redo and (info.get('run') != self.run_id):
+            return None
+        return info
+
+    def _write_marker(self, fname, **info):
+        tmp = os.path.join(self.claim_dir, '.{}.{}'.format(
+            os.path.basename(fname), uuid.uuid4().hex))
+        with open(tmp, 'w') as f:
+            json.dump(dict(info, owner=owner_name(), time=time.time(),
+                           run=self.run_id), f)
+        os.rename(tmp, fname)
+
+    def _remove_marker(self, fname):
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+
+    def is_done(self, name, redo=False):
+        return self._read_marker(self.done_fname(name), redo=redo) is not None
+
+    def mark_done(self, name):
+        self._write_marker(self.done_fname(name))
+
+    def clear_done(self, name):
+        self._remove_marker(self.done_fname(name))
+
+    def failed_attempts(self, name, redo=False):
+        '''
+        number of failed attempts recorded for `name` (if `redo`, only by
+            this run)
+        '''
+        info = self._read_marker(self.failed_fname(name), redo=redo)
+        try:
+            return int(info['attempts'])
+        except (TypeError, ValueError, KeyError):
+            return 0
+
+    def mark_failed(self, name, error=None):
+        self._write_marker(self.failed_fname(name),
+                           attempts=self.failed_attempts(name) + 1, error=error)
+
+    def clear_failed(self, name):
+        self._remove_marker(self.failed_fname(name))
+
+    def _clear_other_runs(self, name):
+        '''
+        remove markers of `name` written by other runs (only while holding
+            its lease, so no worker of this run writes one meanwhile)
+        '''
+        for fname in [self.done_fname(name), self.failed_fname(name)]:
+            info = self._read_marker(fname)
+            if (info is not None) and (info.get('run') != self.run_id):
+                self._remove_marker(fname)
+
+    def is_settled(self, name, redo=False):
+        '''
+        is `name` done, or failed too many times to be claimed again?
+            (if `redo`, only markers written by this run count)
+        '''
+        return self.is_done(name, redo=redo) or \
+            (self.failed_attempts(name, redo=redo) >= self.max_attempts)
+
+    def markers(self):
+        '''
+        status ('success' or 'failed'), failed attempts, and last error of
+            every name with a marker, as a dict keyed by name
+        '''
+        states = {}
+        for fn in os.listdir(self.claim_dir):
+            name, ext = os.path.splitext(fn)
+            if fn.startswith('.') or (ext not in ['.done', '.failed']):
+                continue
+            info = self._read_marker(os.path.join(self.claim_dir, fn)) or {}
+            status, attempts, error = states.get(name, ('failed', 0, None))
+            if ext == '.done':
+                status = 'success'
+            else:
+                attempts, error = info.get('attempts', 1), info.get('error')
+            states[name] = (status, attempts, error)
+        return states
+
+    def fs_now(self):
+        '''
+        current time according to the shared filesystem's clock
+        '''
+        probe = os.path.join(self.claim_dir, '.clock-{}'.format(owner_name()))
+        with open(probe, 'w'):
+            pass
+        now = os.stat(probe).st_mtime
+        os.remove(probe)
+        return now
+
+    def _try_create(self, name, reclaimed=False):
+        fname = self.lease_fname(name)
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'token': token, 'owner': owner_name(),
+                       'acquired': time.time()}, f)
+        return Lease(fname, token, self.heartbeat_interval, reclaimed=reclaimed)
+
+    def _reclaim_stale(self, name):
+        '''
+        move a stale lease aside, returning whether one was removed
+        '''
+        fname = self.lease_fname(name)
+        try:
+            age = self.fs_now() - os.stat(fname).st_mtime
+        except FileNotFoundError:
+            return False
+        if age < self.lease_time:
+            return False
+
+        # only one reclaimer's rename can succeed
+        tomb = os.path.join(self.claim_dir, '.{}.stale.{}'.format(
+            name, uuid.uuid4().hex))
+        try:
+            os.rename(fname, tomb)
+        except FileNotFoundError:
+            return False
+
+        # the owner may have heartbeated between our stat and rename:
+        # if so, put the lease back (unless someone has already replaced it)
+        if self.fs_now() - os.stat(tomb).st_mtime < self.lease_time:
+            try:
+                os.link(tomb, fname)
+            except FileExistsError:
+                pass
+            os.remove(tomb)
+            return False
+
+        os.remove(tomb)
+        print('reclaimed stale lease on {}'.format(name))
+        return True
+
+    def acquire(self, name, redo=False):
+        '''
+        claim `name`, returning a `Lease`, or None if it is held by a live
+            worker, or is done or failed `max_attempts` times (if `redo`,
+            only markers written by this run count, and others are removed)
+        '''
+        if self.is_settled(name, redo=redo):
+            return None
+
+        lease = self._try_create(name)
+        if (lease is None) and self._reclaim_stale(name):
+            lease = self._try_create(name, reclaimed=True)
+        if lease is None:
+            return None
+
+        if redo:
+            self._clear_other_runs(name)
+
+        # another worker may have finished (or failed) between our check
+        # and our claim
+        if self.is_settled(name, redo=redo):
+            lease.release()
+            return None
+
+        return lease
+
+    def finish(self, lease, name, success, error=None):
+        '''
+        release a lease, marking `name` done if `success` (or adding a
+            failed attempt, with `error`, if not) if the lease was still held
+
+        returns whether the lease was still held
+        '''
+        # mark while still holding lease, so no one can claim in between
+        held = lease.is_held()
+        if held and success:
+            self.mark_done(name)
+            self.clear_failed(name)
+        elif held:
+            self.mark_failed(name, error=error)
+        return lease.release() and held
+
+
+def _selftest_worker(claim_dir, names, lease_time, die, out_fname,
+                     run_id=None, redo=False):
+    leases = LeaseDir(claim_dir, lease_time=lease_time, run_id=run_id)
+    for name in names:
+        lease = leases.acquire(name, redo=redo)
+        if lease is None:
+            continue
+        if die:
+            # simulate node dying mid-galaxy: lease left behind, no heartbeat
+            lease._stop.set()
+            os._exit(1)
+        time.sleep(.05)
+        if leases.finish(lease, name, success=True):
+            with open(out_fname, 'a') as f:
+                f.write('{}\n'.format(name))
+
+
+if __name__ == '__main__':
+    import tempfile
+    import multiprocessing as mpc
+
+    claim_dir = tempfile.mkdtemp(prefix='leases_test_')
+    out_fname = os.path.join(claim_dir, 'completed.txt')
+    names = ['{}-{}'.format(8000 + i, 1901) for i in range(40)]
+    lease_time = 1.
+
+    procs = [mpc.Process(target=_selftest_worker,
+                         args=(claim_dir, names, lease_time,
+                               i == 0, out_fname))
+             for i in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    # after the dead worker's lease goes stale, a new worker picks up the rest
+    time.sleep(1.5 * lease_time)
+    _selftest_worker(claim_dir, names, lease_time, False, out_fname)
+
+    with open(out_fname, 'r') as f:
+        completed = f.read().split()
+
+    assert sorted(completed) == sorted(names), 'not all names completed'
+    assert len(completed) == len(set(completed)), 'some names ran twice'
+    print('{} names each completed exactly once by {} processes'.format(
+        len(names), len(procs) + 1))
+
+    # redoing everything as one new run still completes each name once
+    os.remove(out_fname)
+    procs = [mpc.Process(target=_selftest_worker,
+                         args=(claim_dir, names, lease_time, False, out_fname,
+                               'redo', True))
+             for i in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    with open(out_fname, 'r') as f:
+        completed = f.read().split()
+
+    assert sorted(completed) == sorted(names), 'not all names redone'
+    assert len(completed) == len(set(completed)), 'some names redone twice'
+    print('{} names each redone exactly once by {} processes'.format(
+        len(names), len(procs)))
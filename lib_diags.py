@@ -14,6 +14,7 @@ from importer import *
 import manga_tools as m
 
 import read_results
+import spaxel_store
 
 import warnings
 
@@ -86,6 +87,52 @@ def harvest_from_result(results_fname, pca_system, types, names, mock=False):
 
     return harvested_data
 
+def harvest_from_store(store, pca_system, types, names, mock=False):
+    '''
+    like `harvest_from_result`, but for all galaxies of a
+        `spaxel_store.SpaxelStore` at once (only spaxels passing the same
+        masking are returned)
+
+    datatype 'map' must be of a single-plane map; 'truth', 'dev', and
+        'dev-wid' need a store of mocks (see `spaxel_store.consolidate`)
+    '''
+    cols = ['galaxy']
+    for datatype, name in zip(types, names):
+        if datatype in ['map', 'param-med']:
+            cols += [name]
+        elif datatype == 'param-wid':
+            cols += ['{}_lunc'.format(name), '{}_uunc'.format(name)]
+        elif datatype == 'color':
+            cols += spaxel_store.photometry_columns(pca_system.pc_photometry())
+        elif mock and (datatype == 'truth'):
+            pass
+        elif mock and (datatype in ['dev', 'dev-wid']):
+            cols += [name, '{}_lunc'.format(name), '{}_uunc'.format(name)]
+        else:
+            raise ValueError('unrecognized datatype/name: {}/{}'.format(datatype, name))
+
+    res = store.query(sorted(set(cols)), where=spaxel_store.good_spaxels)
+
+    def harvest(datatype, name):
+        if datatype in ['map', 'param-med']:
+            return res[name]
+        elif datatype == 'param-wid':
+            return res['{}_lunc'.format(name)] + res['{}_uunc'.format(name)]
+        elif datatype == 'color':
+            mags = spaxel_store.photometry(res, pca_system.pc_photometry())
+            b1, b2 = tuple(name)
+            return mags['sdss2010-{}'.format(b1)] - mags['sdss2010-{}'.format(b2)]
+
+        truth = store.truth(name, res['galaxy'])
+        if datatype == 'truth':
+            return truth
+        dev = res[name] - truth
+        if datatype == 'dev':
+            return dev
+        return dev / (0.5 * (res['{}_lunc'.format(name)] + res['{}_uunc'.format(name)]))
+
+    return [np.ma.array(harvest(datatype, name)) for datatype, name in zip(types, names)]
+
 def make_binlabel(bin_bds, i, varname):
     if i == 0:
         # left-most bin
@@ -138,6 +185,9 @@ def make_binned_hist_fig(results_fnames, pca_system,
     make multipanel histogram figure where bin1bds defines how points are apportioned into
         subplots, and bin2bds defines how points are apportioned to histograms within
         a given subplot
+
+    `results_fnames` may instead be a `spaxel_store.SpaxelStore`, which is
+        much faster for many galaxies (see `harvest_from_store`)
     '''
     print(bin1datatype, bin1name)
     print(bin2datatype, bin2name)
@@ -157,9 +207,13 @@ def make_binned_hist_fig(results_fnames, pca_system,
     # retrieve color, SNR, and parameter of interest
     types = [bin1datatype, bin2datatype, histdatatype]
     names = [bin1name, bin2name, histname]
-    bin1data, bin2data, histdata = concatenate_zipped(
-        [harvest_from_result(fn, pca_system, types, names, mock)
-         for fn in results_fnames])
+    if isinstance(results_fnames, spaxel_store.SpaxelStore):
+        bin1data, bin2data, histdata = harvest_from_store(
+            results_fnames, pca_system, types, names, mock)
+    else:
+        bin1data, bin2data, histdata = concatenate_zipped(
+            [harvest_from_result(fn, pca_system, types, names, mock)
+             for fn in results_fnames])
 
     # assign each sample to a pair of bins
     bin_assignment_1 = np.digitize(bin1data, bin1bds)
@@ -80,9 +80,72 @@ def broadcasted_cholinvert(K, spatial_axes):
 
     return P
 
+class LowRankCov(object):
+    '''
+    covariance matrix stored as a (k, nl) factor `F`, such that K ~ F.T @ F
+
+    only ever consumed in projected form, so the full nl-by-nl matrix
+        is never formed
+    '''
+    def __init__(self, F):
+        self.F = F
+
+    @property
+    def shape(self):
+        return (self.F.shape[1], ) * 2
+
+    def project(self, H):
+        '''
+        H.T @ K @ H
+        '''
+        FH = self.F @ H
+        return FH.T @ FH
+
+    def todense(self):
+        return self.F.T @ self.F
+
+    @classmethod
+    def from_residuals(cls, R, rank, block_rows=None):
+        '''
+        build factor of the covariance of the rows of `R` by streaming
+            blocks of rows through a frequent-directions sketch
+            (Liberty 2013), holding no more than (rank + block_rows) rows
+            at once. The sketch underestimates K by at most the variance
+            in R beyond its leading `rank` directions
+
+        params:
+         - R: (n, nl) array of residuals (may be memory-mapped)
+         - rank: number of rows of factor
+         - block_rows: rows of `R` added to the sketch at once
+            (defaults to `rank`)
+        '''
+        n, nl = R.shape
+        if block_rows is None:
+            block_rows = rank
+
+        mean = np.zeros(nl)
+        for i0 in range(0, n, block_rows):
+            mean += R[i0:i0 + block_rows].sum(axis=0)
+        mean /= n
+
+        B = np.zeros((0, nl))
+        for i0 in range(0, n, block_rows):
+            B = np.concatenate([B, R[i0:i0 + block_rows] - mean], axis=0)
+            if len(B) <= rank:
+                continue
+            _, s, Vt = np.linalg.svd(B, full_matrices=False)
+            s2 = (s[:rank]**2. - s[rank]**2.).clip(min=0.)
+            B = np.sqrt(s2)[:, None] * Vt[:rank]
+
+        return cls(B / np.sqrt(n - 1.))
+
+
 class PCAProjectionSolver(object):
     '''
     projects data down onto PCs
+
+    `K_th` is either a full covariance matrix, or any object with a
+        `project(H)` method (e.g., `LowRankCov`)
     '''
     def __init__(self, e, K_inst_cacher, K_th, regul=.1):
         self.e = e
@@ -96,7 +159,10 @@ class PCAProjectionSolver(object):
             np.eye(self.nl))
         self.H = self.inv_eTe @ e.T
 
-        self.K_PC_th = self.H.T @ self.K_th @ self.H
+        if hasattr(self.K_th, 'project'):
+            self.K_PC_th = self.K_th.project(self.H)
+        else:
+            self.K_PC_th = self.H.T @ self.K_th @ self.H
 
         self.regul = regul * np.ones(self.nl)
 
@@ -5,17 +5,18 @@ from glob import glob
 from warnings import warn, filterwarnings, catch_warnings, simplefilter
 from functools import partial
 import dataclasses
+import threading
 import multiprocessing as mpc
 
 from importer import *
 import manga_tools as m
 import totalmass
 import read_results
+import catalogs
 
 from astropy import table as t
 from astropy import units as u
 from astropy.cosmology import WMAP9
-from astropy.utils.console import ProgressBar
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -28,31 +29,63 @@ from statsmodels.nonparametric.smoothers_lowess import lowess
 from statsmodels.regression.linear_model import OLS
 from statsmodels.tools.tools import add_constant as sm_add_constant
 
-drpall = m.load_drpall(mpl_v, index='plateifu')
+def result_signature(fname):
+    '''
+    cheap stand-in for a results file's contents
+    '''
+    st = os.stat(fname)
+    return '{}-{}'.format(st.st_size, st.st_mtime_ns)
 
-dapall = m.load_dapall(mpl_v)
-dapall = dapall[dapall['DAPDONE'] * (dapall['DAPTYPE'] == daptype)]
-dapall.add_index('PLATEIFU')
 
-pca_system = read_results.PCASystem.fromfile(os.path.join(csp_basedir, 'pc_vecs.fits'))
+def _aggregate_task(task):
+    '''
+    aggregate one galaxy (in a worker), returning its plateifu, its row of
+        the mass table (or None), and any error
+    '''
+    res_fname, plateifu, signature, mlband = task
+    try:
+        with catch_warnings():
+            simplefilter('ignore')
+            qt = aggregate_one(res_fname, mlband=mlband)
+    except (SystemExit, KeyboardInterrupt) as e:
+        raise e
+    except Exception as e:
+        return plateifu, None, repr(e)
 
-jhumpa = t.Table.read('/usr/data/minhas/zpace/stellarmass_pca/jhu_mpa_{}.fits'.format(
-    mpl_v.replace('-', '').lower()))
-jhumpa['plateifu'] = [plateifu.strip(' ') for plateifu in jhumpa['PLATEIFU']]
-jhumpa = jhumpa['plateifu', 'LOG_MSTAR']
-jhumpa = jhumpa[jhumpa['LOG_MSTAR'] > 0.]
+    qt['res_signature'] = [signature]
+    return plateifu, qt, None
 
-sfrsd_tab = t.Table.read('/usr/data/minhas/zpace/stellarmass_pca/sigma_sfr.fits')
-sfrsd_tab['plateifu'] = sfrsd_tab['names']
-del sfrsd_tab['names']
-sfrsd_tab.add_index('plateifu')
 
 @dataclasses.dataclass
 class MassAggregationManager(object):
+    '''
+    aggregate masses of many galaxies (see `aggregate_one`), in parallel,
+        into one table at `masstable_fname` (relative to `cspbase`)
+
+    the table records a signature of each galaxy's results file, so only new
+        or changed results are aggregated. Rows are added as workers finish,
+        and the table is rewritten (atomically) every `flush_every` galaxies,
+        so an interrupted run loses little
+
+    workers are forked after `pca_system` (with its PC photometry) and
+        `drpall_arrays` are loaded (see `catalogs`), so they share these rather
+        than each loading a copy
+
+    `start_agg_into_tables` returns at once; follow it with `progress`,
+        `agg_done`, `agg_tasks_remaining`, and `wait` (or use `run`)
+    '''
     cspbase: str = csp_basedir
     globstring: str = '*/*-*_zpres.fits'
-    masstable_fname_base: str = 'masstables/{}.ecsv'
+    masstable_fname: str = 'masstable.ecsv'
     mlband: str = 'i'
+    flush_every: int = 50
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._error = None
+        self._counts = {'total': 0, 'done': 0, 'failed': 0}
+        self.errors = {}
 
     @staticmethod
     def plateifu_from_fn(fn):
@@ -60,90 +93,149 @@ class MassAggregationManager(object):
         plateifu = fn_base.split('_')[0]
         return plateifu
 
-    @staticmethod
-    def find_results(cspbase, res_globstr, masstable_fname_base, redo=False):
-        # search in results directory for results files
-        results_fnames = glob(os.path.join(cspbase, res_globstr), recursive=True)
+    @property
+    def masstable_path(self):
+        return os.path.join(self.cspbase, self.masstable_fname)
 
-        # if redo option false, get only filenames that have no associated mass table
-        if redo:
-            pass
-        else:
-            results_fnames = list(filter(
-                lambda fn: not os.path.isfile(os.path.join(
-                    cspbase,
-                    masstable_fname_base.format(
-                        MassAggregationManager.plateifu_from_fn(fn)))),
-                results_fnames))
+    def _read_table(self):
+        if not os.path.isfile(self.masstable_path):
+            return None
+        return t.QTable.read(self.masstable_path)
 
-        plateifus = list(map(MassAggregationManager.plateifu_from_fn, results_fnames))
+    def find(self, redo=False):
+        '''
+        results files (and their plateifus and signatures) that are not in
+            the mass table as they are now (or all, if `redo`)
+        '''
+        results_fnames = sorted(glob(
+            os.path.join(self.cspbase, self.globstring), recursive=True))
+        plateifus = list(map(self.plateifu_from_fn, results_fnames))
+        signatures = list(map(result_signature, results_fnames))
 
-        return results_fnames, plateifus
+        tab = None if redo else self._read_table()
+        if (tab is not None) and ('res_signature' in tab.colnames):
+            known = dict(zip(tab['plateifu'], tab['res_signature']))
+            todo = [known.get(p) != sig for p, sig in zip(plateifus, signatures)]
+            results_fnames, plateifus, signatures = (
+                [a for a, todo_ in zip(l, todo) if todo_]
+                for l in (results_fnames, plateifus, signatures))
 
-    def find(self, redo=False):
-        return self.find_results(
-            cspbase=self.cspbase, res_globstr=self.globstring,
-            masstable_fname_base=self.masstable_fname_base, redo=redo)
+        return results_fnames, plateifus, signatures
 
     def start_agg_into_tables(self, redo=False, processes=None, limit=None):
         '''begin the asynchronous aggregation
         '''
+        if (self._thread is not None) and self._thread.is_alive():
+            raise ValueError('aggregation already running')
 
-        # start pool
-        with mpc.Pool(processes=processes) as pool:
-            # which file names and plateifus to loop over
-            results_fnames, results_plateifus = self.find_results(
-                cspbase=self.cspbase, res_globstr=self.globstring,
-                masstable_fname_base=self.masstable_fname_base, redo=redo)
+        results_fnames, plateifus, signatures = self.find(redo=redo)
+        tasks = [(fn, p, sig, self.mlband) for fn, p, sig in zip(
+            results_fnames, plateifus, signatures)][:limit]
 
-            # map table maker over lists of fnames and plateifus
-            self.current_async_result = pool.starmap_async(
-                aggregate_into_table_file, 
-                zip(results_fnames[:limit], results_plateifus[:limit]))
+        self._counts = {'total': len(tasks), 'done': 0, 'failed': 0}
+        self.errors = {}
+        self._error = None
+
+        # workers fork from here, inheriting PC photometry computed once
+        catalogs.pca_system().pc_photometry()
+        catalogs.drpall_arrays()
+        pool = mpc.get_context('fork').Pool(processes=processes)
+        rows = pool.imap_unordered(_aggregate_task, tasks)
+
+        self._thread = threading.Thread(
+            target=self._collect, args=(pool, rows, redo, [p for _, p, *_ in tasks]),
+            daemon=True)
+        self._thread.start()
+
+    def _collect(self, pool, rows, redo, plateifus):
+        '''
+        gather rows as workers finish, writing table every `flush_every`
+        '''
+        try:
+            tab = None if redo else self._read_table()
+            if tab is not None:
+                # rows for changed results are replaced
+                tab = tab[~np.isin(np.asarray(tab['plateifu']), plateifus)]
+
+            new = []
+            for plateifu, qt, error in rows:
+                with self._lock:
+                    if qt is None:
+                        self._counts['failed'] += 1
+                        self.errors[plateifu] = error
+                    else:
+                        self._counts['done'] += 1
+                if qt is not None:
+                    new.append(qt)
+                if len(new) >= self.flush_every:
+                    tab, new = self._write(tab, new), []
+
+            self._write(tab, new)
+            pool.close()
+        except Exception as e:
+            self._error = e
+            pool.terminate()
+        finally:
+            pool.join()
+
+    def _write(self, tab, new):
+        tabs = ([] if tab is None else [tab]) + new
+        if not tabs:
+            return tab
+        tab = t.vstack(tabs)
+
+        # keep extension, from which astropy infers format
+        dest = self.masstable_path
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(dest), '.tmp-' + os.path.basename(dest))
+        tab.write(tmp, overwrite=True)
+        os.replace(tmp, dest)
+        return tab
+
+    def progress(self):
+        '''numbers of galaxies to aggregate in total, done, and failed
+        '''
+        with self._lock:
+            return dict(self._counts)
 
     def agg_done(self):
         '''is aggregation into tables done?
         '''
-        if not hasattr(self, 'current_async_result'):
+        if self._thread is None:
             raise ValueError('no pool associated with this instance!')
-        else:
-            return self.current_async_result.ready()
+        return not self._thread.is_alive()
 
     def agg_tasks_remaining(self):
         '''status of mass aggregation
         '''
-        if not hasattr(self, 'current_async_result'):
-            raise ValueError('no pool associated with this instance!')
-        elif self.current_async_result.ready():
-            return 0
-        else:
-            return self.current_async_result._number_left
-            
-
-    def table(self):
-        if not self.agg_done():
-            raise UserWarning('aggregation not complete')
-        return t.vstack([t.QTable.read(fn, format='ascii.ecsv') for fn in
-                         glob(os.path.join(
-                            self.cspbase, self.masstable_fname_base.format('*')))])
+        prog = self.progress()
+        return prog['total'] - prog['done'] - prog['failed']
 
+    def wait(self):
+        '''block until aggregation is done (raising any error it met)
+        '''
+        if self._thread is not None:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
 
-def _aggregate_into_table_file(args):
-    return aggregate_into_table_file(*args)
+    def run(self, redo=False, processes=None, limit=None, report_every=30.):
+        '''aggregate, printing progress every `report_every` seconds
+        '''
+        self.start_agg_into_tables(redo=redo, processes=processes, limit=limit)
+        while not self.agg_done():
+            self._thread.join(report_every)
+            print('aggregated {done} of {total} ({failed} failed)'.format(
+                **self.progress()))
+        self.wait()
+        for plateifu, error in self.errors.items():
+            print('{}: {}'.format(plateifu, error))
 
+    def table(self):
+        if (self._thread is not None) and not self.agg_done():
+            raise UserWarning('aggregation not complete')
+        return self._read_table()
 
-def aggregate_into_table_file(res_fname, mlband, cspbase, masstable_fname_base, plateifu):
-    try:
-        qt = aggregate_one(res_fname, mlband=mlband)
-        table_dest = os.path.join(cspbase, masstable_fname_base.format(plateifu))
-        qt.write(table_dest, overwrite=True, format='ascii.ecsv')
-    except (SystemExit, KeyboardInterrupt) as e:
-        raise e
-    except Exception as e:
-        print(e)
-        return False
-    else:
-        return True
 
 def aggregate_one(res_fname, mlband):
     with read_results.PCAOutput.from_fname(res_fname) as res:
@@ -153,7 +245,7 @@ def aggregate_one(res_fname, mlband):
             plate, ifu = plateifu.split('-')
 
             stellarmass = totalmass.StellarMass(
-                res, pca_system, drp, dap, drpall.loc[plateifu],
+                res, catalogs.pca_system(), drp, dap, catalogs.drpall_arrays().row(plateifu),
                 cosmo, mlband=mlband)
 
             mstar_map = stellarmass.mstar[stellarmass.bands_ixs[mlband], ...]
@@ -203,7 +295,7 @@ def mass_agg_onegal(res_fname, mlband):
     dap = res.get_dap_maps(mpl_v, daptype)
 
     stellarmass = totalmass.StellarMass(
-        res, pca_system, drp, dap, drpall.loc[plateifu],
+        res, catalogs.pca_system(), drp, dap, catalogs.drpall_arrays().row(plateifu),
         WMAP9, mlband=mlband)
 
     with catch_warnings():
@@ -926,22 +1018,14 @@ if __name__ == '__main__':
     aggman = MassAggregationManager(
         cspbase='/usr/data/minhas2/zpace/sdss/sas/mangawork/manga/sandbox/mangapca/zachpace/CSPs_CKC14_MaNGA_20190215-1/',
         globstring='**/*-*/*-*_zpres.fits',
-        masstable_fname_base='v2_5_3/2.3.0/masstables/{}.ecsv')
-    res_fnames, res_plateifus = aggman.find(redo=False)
-    nres_to_agg = len(res_fnames)
-
-    if nres_to_agg > 0:
-        print('aggregating {}'.format(nres_to_agg))
-        ProgressBar.map(
-            _aggregate_into_table_file,
-            list(zip(res_fnames, [mlband, ] * nres_to_agg, [aggman.cspbase, ] * nres_to_agg,
-                     res_plateifus)))
+        masstable_fname='v2_5_3/2.3.0/masstable.ecsv', mlband=mlband)
+    aggman.run(redo=False)
 
-    mass_table = t.vstack(
-        [t.QTable.read(fn, format='ascii.ecsv') for fn in glob(
-            os.path.join(aggman.cspbase, aggman.masstable_fname_base.format('*')))])
+    mass_table = aggman.table()
 
-    mass_table['distmod'] = cosmo.distmod([drpall.loc[obj]['nsa_zdist'] for obj in mass_table['plateifu']])
+    drpall = catalogs.drpall_arrays()
+    mass_table['distmod'] = cosmo.distmod(
+        drpall.take(mass_table['plateifu'], ['nsa_zdist'])['nsa_zdist'])
 
     for band in 'griz':
         outerfluxname = f'flux_outer_{band}'
@@ -991,10 +1075,10 @@ if __name__ == '__main__':
         cmlr_gr_i)
     mass_table['outerml_diff'] = mass_table['outerml_cmlr'] - mass_table['outerml_ring']
 
-    drpall.keep_columns(['plateifu', 'mangaid', 'objra', 'objdec', 'ebvgal', 
-                         'mngtarg1', 'mngtarg2', 'mngtarg3', 'nsa_iauname', 'ifudesignsize',
-                         'nsa_z', 'nsa_zdist', 'nsa_nsaid', 'nsa_elpetro_ba',
-                         'nsa_elpetro_mass', 'nsa_elpetro_absmag'])
+    drpall = drpall.to_table(['plateifu', 'mangaid', 'objra', 'objdec', 'ebvgal', 
+                              'mngtarg1', 'mngtarg2', 'mngtarg3', 'nsa_iauname', 'ifudesignsize',
+                              'nsa_z', 'nsa_zdist', 'nsa_nsaid', 'nsa_elpetro_ba',
+                              'nsa_elpetro_mass', 'nsa_elpetro_absmag'])
     full_table = t.join(mass_table, drpall, 'plateifu', join_type='inner')
 
     single_aper_mass = (
@@ -1012,12 +1096,13 @@ if __name__ == '__main__':
     make_missing_mass_fig(full_table, mltype='ring')
     make_missing_mass_fig(full_table, mltype='cmlr')
     make_missing_flux_fig(full_table)
-    compare_mtot_pca_nsa(full_table, jhumpa, mltype='ring')
+    compare_mtot_pca_nsa(full_table, catalogs.jhumpa(), mltype='ring')
     #compare_mtot_pca_nsa(full_table, jhumpa, mltype='cmlr')
     make_meanstdtauV_vs_dMass_fig(full_table)
     make_stdtauV_vs_dMass_ba_fig(full_table)
     make_stdtauV_vs_dMass_fig(full_table)
     
+    sfrsd_tab = catalogs.sfrsd()
     make_stdtauV_vs_dMass_ssfrsd_fig(full_table, sfrsd_tab, mltype='ring')
     make_stdtauV_vs_dMass_ssfrsd_fig(full_table, sfrsd_tab, mltype='cmlr')
     make_stdtauV_vs_ssfrsd_dMass_fig(full_table, sfrsd_tab, mltype='ring')
@@ -1029,7 +1114,7 @@ if __name__ == '__main__':
     #'''
 
     mass_table_loc = os.path.join(
-        aggman.cspbase, os.path.dirname(aggman.masstable_fname_base), 'totalmass.fits')
+        aggman.cspbase, os.path.dirname(aggman.masstable_fname), 'totalmass.fits')
     mass_table_to_write = mass_table['plateifu', 'mass_in_ifu']
     mass_table_to_write['mass_outer_ring'] = (
         mass_table['outerml_ring'] + mass_table[f'logsollum_outer_{mlband}']).to(u.Msun)
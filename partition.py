@@ -1,7 +1,157 @@
 import numpy as np
+
+import os
 from functools import reduce
 from itertools import product
 import utils as ut
+import instrument
+
+
+class MemoryBudgetError(Exception):
+    '''
+    a stage cannot run within the memory budget, even one spaxel at a time
+    '''
+    pass
+
+
+def cgroup_memory():
+    '''
+    memory limit and current usage (bytes) of this process's cgroup
+        (v2, then v1), or None for either if unavailable or unlimited
+    '''
+    for limit_fname, usage_fname in [
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+             '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_fname, 'r') as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        # v1 reports "no limit" as a huge number
+        if (limit == 'max') or (int(limit) >= 2**60):
+            return None, None
+        try:
+            with open(usage_fname, 'r') as f:
+                usage = int(f.read().strip())
+        except OSError:
+            usage = None
+        return int(limit), usage
+    return None, None
+
+
+def system_available_memory():
+    '''
+    memory (bytes) the kernel reports as available to new allocations
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def available_memory():
+    '''
+    memory (bytes) this process may still allocate: the smaller of the
+        headroom under its cgroup limit and the system's available memory
+    '''
+    avail = system_available_memory()
+    limit, usage = cgroup_memory()
+    if limit is not None:
+        avail = min(avail, limit - (usage or ut.current_rss()))
+    return max(avail, 0)
+
+
+# bytes used by each tiled stage, as (fixed, per spaxel of a tile); `nspax`
+# is the number of spaxels in the whole map, and float64 is assumed
+stage_costs = {
+    # solver setup (nl-by-nl inverses), outputs, and per-spaxel variance
+    'solve': (lambda nspax, nl, q, **_: 8 * (3 * nl**2 + nspax * (q + q**2 + 1)),
+              lambda nl, q, **_: 8 * (nl + 2 * (q + q**2 + 1))),
+    # output weights; PC offsets of every model, distances & temporaries
+    'weights': (lambda nspax, nmodels, **_: 8 * nmodels * nspax,
+                lambda nmodels, q, **_: 8 * nmodels * (q + 3)),
+    # output percentiles; copy, sort & cumulative sum of weights
+    'percentiles': (lambda nspax, npctl, **_: 8 * npctl * nspax,
+                    lambda nmodels, **_: 8 * nmodels * 8),
+    # output PC covariances; each spaxel's obs. covariance & its projection
+    'K_PC': (lambda nspax, q, **_: 8 * q**2 * nspax,
+             lambda nl, q, **_: 8 * (2 * nl**2 + 2 * q * nl)),
+}
+
+
+class MemoryPlanner(object):
+    '''
+    plan spatial tiles of each stage's work so that its arrays fit in
+        a memory budget
+
+    the bytes a stage needs are estimated from array shapes (see
+        `stage_costs`), rather than by trial allocations, which on Linux
+        succeed without touching memory. Each tiled stage notes its
+        estimate with `instrument`, to be checked against measured
+        peak RSS
+
+    params:
+     - budget: bytes available to a stage; if None, a `fraction` of
+        `available_memory()` (split among `nshare` concurrent workers)
+        is measured each time a stage is planned
+    '''
+    def __init__(self, budget=None, fraction=.8, nshare=1):
+        self.budget = budget
+        self.fraction = fraction
+        self.nshare = max(1, nshare)
+
+    def current_budget(self):
+        if self.budget is not None:
+            return self.budget
+        return self.fraction * available_memory() / self.nshare
+
+    @staticmethod
+    def estimate(stage, nspax, ntile=None, **dims):
+        '''
+        bytes needed by `stage` for a map of `nspax` spaxels, worked on
+            `ntile` spaxels at a time (default all at once)
+        '''
+        fixed, per_spaxel = stage_costs[stage]
+        if ntile is None:
+            ntile = nspax
+        return fixed(nspax=nspax, **dims) + ntile * per_spaxel(**dims)
+
+    def tile_size(self, stage, nspax, **dims):
+        '''
+        largest number of spaxels `stage` can work on at once
+        '''
+        fixed, per_spaxel = stage_costs[stage]
+        budget = self.current_budget()
+        ntile = int((budget - fixed(nspax=nspax, **dims)) // per_spaxel(**dims))
+        if ntile < 1:
+            raise MemoryBudgetError(
+                '{} needs {:.2f} GB for one spaxel; budget is {:.2f} GB'.format(
+                    stage, self.estimate(stage, nspax, 1, **dims) / 1024.**3,
+                    budget / 1024.**3))
+        return min(ntile, nspax)
+
+    def tiles(self, stage, map_shape, **dims):
+        '''
+        plan `stage` over a map, returning list of (row slice, column slice)
+
+        tiles are whole rows where possible, and parts of one row otherwise
+        '''
+        nspax = int(np.prod(map_shape))
+        ntile = self.tile_size(stage, nspax, **dims)
+        instrument.record_estimate(self.estimate(stage, nspax, ntile, **dims))
+
+        nrows, ncols = map_shape
+        if ntile >= ncols:
+            rows_per_tile = ntile // ncols
+            return [(slice(i, min(i + rows_per_tile, nrows)), slice(None))
+                    for i in range(0, nrows, rows_per_tile)]
+        return [(slice(i, i + 1), slice(j, min(j + ntile, ncols)))
+                for i in range(nrows) for j in range(0, ncols, ntile)]
 
 def factors(n):
     return set(reduce(
@@ -24,21 +174,6 @@ def nsub_subshape(chunkspec1, chunkspec2):
 
     return (chunkspec1[0], chunkspec2[0]), (chunkspec1[1], chunkspec2[1])
 
-def find_largest_good_chunkshape(chunkspecs_I, chunkspecs_J, nl, k_pc_shape):
-    lgst_chunksize = (0, 0)
-    nchunksperaxis = (0, 0)
-    for chunkspec_i, chunkspec_j in product(chunkspecs_I, chunkspecs_J):
-        nsub, subshape = nsub_subshape(chunkspec_i, chunkspec_j)
-
-        # need to also leave roon for PC cov matrix
-        shapes = ((nl, nl) + subshape, ) * 100 + (k_pc_shape, ) * 5
-        if try_arraysize(shapes=shapes, dtype=np.float):
-            if np.product(subshape) > np.product(lgst_chunksize):
-                lgst_chunksize = subshape
-                nchunksperaxis = nsub
-
-    return lgst_chunksize, nchunksperaxis
-
 def extract_fixedlength_subarray(large_array, i0, n):
     '''
     extract a cube into a smaller cube
@@ -58,14 +193,6 @@ def extract_sq_from_sq(sqfsq, i0):
         out[:, :, ind[0], ind[1]] = sqfsq.take(i0[ind[0], ind[1]])
     return out
 
-def try_arraysize(shapes, dtype):
-    try:
-        tests = tuple(np.empty(shape, dtype) for shape in shapes)
-    except MemoryError:
-        return False
-    else:
-        return True
-
 def blockgen(array, bpa):
     '''
     Creates a generator that yields multidimensional blocks from the given
@@ -108,8 +235,12 @@ def blockgen(array, bpa):
         yield blockbounds
 
 class CovCalcPartitioner(object):
-    def __init__(self, kspec_obs, a_map, i0_map, E, ivar_scaled, quiet=False):
+    def __init__(self, kspec_obs, a_map, i0_map, E, ivar_scaled, quiet=False,
+                 planner=None):
         self.quiet = quiet
+        if planner is None:
+            planner = MemoryPlanner()
+        self.planner = planner
         self.kspec_obs = kspec_obs
         self.a_map = a_map
         self.i0_map = i0_map
@@ -119,31 +250,15 @@ class CovCalcPartitioner(object):
         self.E = E
         self.ivar_scaled = ivar_scaled
 
-        self.lgst_chunksize = (4, 4)
-        self.nchunksperaxis = (self.mapshape[0] // 2, self.mapshape[1] // 2)
-
-        self.lgst_chunksize, self.nchunksperaxis = self._how_to_chunkify_maps()
-        self.blockgen = blockgen(ivar_scaled, (1, ) + self.nchunksperaxis)
-
         self.sqfsq = ut.SqFromSqCacher(large_array=kspec_obs, n=self.nl)
 
-    def _how_to_chunkify_maps(self):
-        chunkspecsI, chunkspecsJ = tuple(map(factor_pairs, self.mapshape))
-        lgst_chunksize, nchunksperaxis = find_largest_good_chunkshape(
-            chunkspecsI, chunkspecsJ, self.nl, self.k_pc_shape)
-
-        if not self.quiet:
-            print('Chunk size:', lgst_chunksize)
-            print('Chunks per axis:', nchunksperaxis)
-        return lgst_chunksize, nchunksperaxis
-
     def calc(self, i0, a, var):
         '''
         vector calculation of PC covariance matrix
         '''
 
         if np.all(a == 0.):
-            return 10. * np.ones((self.q, self.q) + self.mapshape)
+            return 10. * np.ones((self.q, self.q) + a.shape)
         # retrieve appropriate obs cov for each spaxel
         kspec_obs_sub = extract_sq_from_sq(self.sqfsq, i0) / a**2.
         # replace main diag of each spaxel's k_obs with its variance array
@@ -156,21 +271,20 @@ class CovCalcPartitioner(object):
 
     def calc_allchunks(self, K_PC=None):
         '''
-        use the blockgen generator to build the full K_PC
+        build the full K_PC, a memory-budgeted tile at a time
         '''
         if K_PC is None:
             K_PC = np.empty(self.k_pc_shape)
 
-        for cubeblk in self.blockgen:
-            lamblk, Iblk, Jblk = cubeblk
-            Istart, Istop = Iblk.start, Iblk.stop
-            Jstart, Jstop = Jblk.start, Jblk.stop
-
-            mapblk = (Iblk, Jblk)
+        tiles = self.planner.tiles(
+            'K_PC', self.mapshape, nl=self.nl, q=self.q)
+        if not self.quiet:
+            print('Tiles:', len(tiles))
 
+        for mapblk in tiles:
             i0_ = self.i0_map[mapblk]
             a_ = self.a_map[mapblk]
-            var_ = (1. / self.ivar_scaled[:, Istart:Istop, Jstart:Jstop]).clip(
+            var_ = (1. / self.ivar_scaled[(slice(None), ) + mapblk]).clip(
                 min=1.0e-6, max=1.0e6)
 
             K_PC[(slice(None, None), slice(None, None)) + mapblk] = self.calc(
@@ -1,10 +1,30 @@
 from importer import *
 
 import os
+import socket
+import sqlite3
+import time
 import numpy as np
+from astropy import table as t
 from datetime import datetime as dt
+from contextlib import contextmanager
 import re
 
+import leases
+
+job_statuses = ['pending', 'running', 'success', 'failed']
+
+# SQLite locking (and WAL) is unsafe over a networked filesystem, so by
+# default each node keeps its own database in its local temporary directory;
+# a lost database is rebuilt from the markers every node leaves in the shared
+# lease directory (see `JobStore.import_claims`), and from the log-files of
+# older runs (see `JobStore.import_logs`)
+default_jobdb_fname = os.environ.get(
+    'PCAY_JOBDB', os.path.join(
+        os.environ.get('TMPDIR', '/tmp'),
+        'pca_jobs_{}.sqlite'.format(socket.gethostname())))
+default_claim_dir = os.path.join(manga_results_basedir, 'claims')
+
 def gen_logfile_name(plateifu):
     plate, ifu = plateifu.split('-')
     status_file_dir = os.path.join(
@@ -67,22 +87,250 @@ def write_log_file(plateifu, msg, clobber=False):
     with open(status_file, mode) as logf:
         logf.write(msg_logged)
 
-def summary_remaining(drpall, group_col='ifudesignsize'): 
+def summary_remaining_logs(drpall, group_col='ifudesignsize'):
+    '''summarize run state from the per-galaxy log files (slow)
+    '''
     complete, hipri = zip(*list(map(log_indicates_complete, drpall['plateifu'])))
     complete, hipri = np.array(complete), np.array(hipri)
     drpall['complete'] = complete
     drpall['hipri_rerun'] = hipri
     drpall['lopri_rerun'] = (~hipri) & (~complete)
-    
+
     runtab = drpall[group_col, 'complete', 'hipri_rerun', 'lopri_rerun']
     runtab_group = runtab.group_by(group_col)
     runtab_groupstats = runtab_group.groups.aggregate(np.sum)
     print(runtab_groupstats)
 
+def summary_remaining(drpall=None, group_col='ifudesignsize', jobs=None,
+                      claims=None):
+    '''summarize run state from the job-state database, first updated from
+        the log-files and from the lease directory `claims` (by default,
+        the one shared by all nodes), so that it covers the whole survey
+    '''
+    if jobs is None:
+        jobs = JobStore()
+    if claims is None:
+        claims = leases.LeaseDir(default_claim_dir)
+    if drpall is not None:
+        jobs.import_logs(drpall)
+    jobs.import_claims(claims, drpall)
+    runtab_groupstats = jobs.summary(group_col)
+    print(runtab_groupstats)
+    return runtab_groupstats
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+class JobStore(object):
+    '''transactional store of per-galaxy run state, in a SQLite database
+
+    each galaxy has an overall status (one of `job_statuses`), the worker
+        that last claimed it, its number of attempts, and the error text of
+        its last failure; each stage of its analysis has its own status,
+        start and end times, and error text
+
+    claims are made inside an immediate (write-locked) transaction, so
+        concurrent workers on the same node never claim the same galaxy.
+        SQLite locking is not reliable over networked filesystems, so the
+        database should live on local disk (set `PCAY_JOBDB`)
+    '''
+    def __init__(self, fname=default_jobdb_fname, timeout=60.):
+        self.fname = fname
+        self.timeout = timeout
+        self._conn, self._pid = None, None
+
+        with self._transaction() as cur:
+            cur.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                plateifu TEXT PRIMARY KEY, ifudesignsize INTEGER,
+                status TEXT NOT NULL DEFAULT 'pending', worker TEXT,
+                nattempts INTEGER NOT NULL DEFAULT 0,
+                claimed_at REAL, ended_at REAL, error TEXT)''')
+            cur.execute('''CREATE TABLE IF NOT EXISTS stages (
+                plateifu TEXT NOT NULL, stage TEXT NOT NULL, status TEXT,
+                started_at REAL, ended_at REAL, error TEXT,
+                PRIMARY KEY (plateifu, stage))''')
+            cur.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+
+    @property
+    def conn(self):
+        # connections must not be shared across a fork, so open one per process
+        if (self._conn is None) or (self._pid != os.getpid()):
+            self._conn = sqlite3.connect(
+                self.fname, timeout=self.timeout, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._pid = os.getpid()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        cur = self.conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            yield cur
+        except:
+            cur.execute('ROLLBACK')
+            raise
+        else:
+            cur.execute('COMMIT')
+
+    def register(self, drpall):
+        '''add galaxies (rows of drpall) not yet known as pending jobs
+        '''
+        rows = [(str(pi), int(ds)) for pi, ds in zip(
+            drpall['plateifu'], drpall['ifudesignsize'])]
+        with self._transaction() as cur:
+            cur.executemany(
+                'INSERT OR IGNORE INTO jobs (plateifu, ifudesignsize) VALUES (?, ?)',
+                rows)
+
+    def claim(self, plateifu, worker=None, redo=False, max_attempts=None,
+              reclaim=False):
+        '''atomically claim a galaxy, returning whether the claim succeeded
+
+        galaxies already running are claimed only if `reclaim` (i.e., the
+            caller knows their worker is dead, e.g., by holding a lease from
+            `leases.LeaseDir`); galaxies already attempted are claimed only
+            if `redo`, and only if they have had fewer than `max_attempts`
+            attempts
+        '''
+        if worker is None:
+            worker = worker_name()
+
+        with self._transaction() as cur:
+            cur.execute('INSERT OR IGNORE INTO jobs (plateifu) VALUES (?)',
+                        (plateifu, ))
+            status, nattempts = cur.execute(
+                'SELECT status, nattempts FROM jobs WHERE plateifu = ?',
+                (plateifu, )).fetchone()
+
+            if (status == 'running') and (not reclaim):
+                return False
+            if (status not in ['pending', 'running']) and (not redo):
+                return False
+            if (max_attempts is not None) and (nattempts >= max_attempts):
+                return False
+
+            cur.execute('''UPDATE jobs SET status = 'running', worker = ?,
+                nattempts = nattempts + 1, claimed_at = ?, ended_at = NULL,
+                error = NULL WHERE plateifu = ?''',
+                (worker, time.time(), plateifu))
+            cur.execute('DELETE FROM stages WHERE plateifu = ?', (plateifu, ))
+
+        return True
+
+    def release(self, plateifu, success, error=None):
+        '''record the end of a claimed galaxy
+        '''
+        with self._transaction() as cur:
+            cur.execute(
+                'UPDATE jobs SET status = ?, ended_at = ?, error = ? WHERE plateifu = ?',
+                ('success' if success else 'failed', time.time(), error, plateifu))
+
+    def start_stage(self, plateifu, stage):
+        with self._transaction() as cur:
+            cur.execute('''INSERT OR REPLACE INTO stages
+                (plateifu, stage, status, started_at) VALUES (?, ?, 'running', ?)''',
+                (plateifu, stage, time.time()))
+
+    def end_stage(self, plateifu, stage, error=None):
+        with self._transaction() as cur:
+            cur.execute('''UPDATE stages SET status = ?, ended_at = ?, error = ?
+                WHERE plateifu = ? AND stage = ?''',
+                ('failed' if error else 'success', time.time(), error,
+                 plateifu, stage))
+
+    @contextmanager
+    def stage(self, plateifu, stage):
+        '''record start, end, and any error of one stage of a galaxy's analysis
+        '''
+        self.start_stage(plateifu, stage)
+        try:
+            yield
+        except Exception as e:
+            self.end_stage(plateifu, stage, error=repr(e))
+            raise
+        else:
+            self.end_stage(plateifu, stage)
+
+    def status(self, plateifu):
+        '''dict of job fields and per-stage records, or None if unknown
+        '''
+        cur = self.conn.cursor()
+        cur.execute('SELECT * FROM jobs WHERE plateifu = ?', (plateifu, ))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        job = dict(zip([d[0] for d in cur.description], row))
+
+        cur.execute('''SELECT stage, status, started_at, ended_at, error
+            FROM stages WHERE plateifu = ? ORDER BY started_at''', (plateifu, ))
+        job['stages'] = [dict(zip([d[0] for d in cur.description], r))
+                         for r in cur.fetchall()]
+        return job
+
+    def summary(self, group_col='ifudesignsize'):
+        '''number of galaxies in each status, grouped by `group_col`
+        '''
+        if group_col not in ['ifudesignsize', 'worker']:
+            raise ValueError('cannot group by {}'.format(group_col))
+
+        cols = ', '.join(["SUM(status = '{0}') AS {0}".format(s)
+                          for s in job_statuses])
+        cur = self.conn.cursor()
+        cur.execute('SELECT {0}, {1} FROM jobs GROUP BY {0} ORDER BY {0}'.format(
+            group_col, cols))
+        rows = cur.fetchall()
+
+        return t.Table(rows=rows if rows else None,
+                       names=[group_col] + job_statuses)
+
+    def import_logs(self, drpall):
+        '''register galaxies (rows of drpall), and seed the statuses of those
+            still pending from their log-files
+
+        a galaxy with a log-file was attempted by an earlier run (or by a
+            run whose database was lost), so is marked as done or failed,
+            and is only re-run if asked to (`redo`)
+        '''
+        self.register(drpall)
+        cur = self.conn.cursor()
+        pending = [r[0] for r in cur.execute(
+            "SELECT plateifu FROM jobs WHERE status = 'pending'").fetchall()]
+        rows = []
+        for plateifu in pending:
+            if not log_file_exists(plateifu):
+                continue
+            complete, hipri = log_indicates_complete(plateifu)
+            rows.append(('success' if complete else 'failed', plateifu))
+        with self._transaction() as cur:
+            cur.executemany('''UPDATE jobs SET status = ?, nattempts = 1
+                WHERE plateifu = ? AND status = 'pending' ''', rows)
+
+    def import_claims(self, claims, drpall=None):
+        '''update statuses from the done and failed markers in a lease
+            directory (a `leases.LeaseDir`) shared by all nodes, registering
+            galaxies (rows of drpall) first, if given
+
+        markers are left by every node's runs, so this brings a node's
+            database (or a new one, e.g., on a login node) up to date with
+            the whole survey; galaxies running on this node are left alone
+        '''
+        if drpall is not None:
+            self.register(drpall)
+        rows = [(status, attempts, error if status == 'failed' else None, name)
+                for name, (status, attempts, error) in claims.markers().items()]
+        with self._transaction() as cur:
+            cur.executemany('''UPDATE jobs SET status = ?,
+                nattempts = MAX(nattempts, ?), error = ?
+                WHERE plateifu = ? AND status != 'running' ''', rows)
+
+
 if __name__ == '__main__':
     import manga_tools as m
 
     drpall = m.load_drpall(mpl_v)
     drpall = drpall[(drpall['ifudesignsize'] > 0) * (drpall['nsa_z'] != -9999.)]
     #print(drpall)
-    summary_remaining(drpall)
+    summary_remaining(drpall, jobs=JobStore())
@@ -12,6 +12,7 @@ from itertools import product as iterprod
 from collections import Counter
 
 import figures_tools
+import read_results
 from find_pcs import *
 
 from spectrophot import reddener
@@ -21,26 +22,37 @@ class Comparator(object):
     compares models to data
     '''
     def __init__(self, trn_metadata, test_metadata, workdir,
-                 mocks_results_fnames, nsub):
+                 mocks_results_fnames, nsub, store=None):
+        '''
+        if `store` (a `spaxel_store.SpaxelStore` of the mocks) is given,
+            model usage is counted from it rather than from results files
+        '''
         self.trn_metadata = trn_metadata
         self.workdir = workdir
         self.test_metadata = test_metadata
 
         self.mocks_results_fnames = mocks_results_fnames
+        self.store = store
         self.trn_usage_cts = self._compute_trn_usage()
 
         self.nsub = nsub
 
     def _compute_trn_usage(self):
         self.n_trn = len(self.trn_metadata)
+
+        if self.store is not None:
+            model = self.store.query(
+                ['MODELNUM'], where=[('MASK', '==', False)])['MODELNUM']
+            return np.bincount(model, minlength=self.n_trn)[:self.n_trn]
+
         ctr = Counter(dict(zip(range(self.n_trn),
                                np.zeros(self.n_trn, dtype=int))))
-        for mocks_result_fname in self.mocks_results_fnames:
-            res = fits.open(mocks_result_fname)
-            mask = res['MASK'].data
-            model = res['MODELNUM'].data
-            ctr.update(model.flatten()[~mask.astype(bool).flatten()])
-            res.close()
+        with read_results.ResultsBatch(self.mocks_results_fnames,
+                                       cls=read_results.MocksPCAOutput) as batch:
+            for _, res in batch:
+                mask = res.flattenedmap('MASK')
+                model = res.flattenedmap('MODELNUM')
+                ctr.update(model[~mask.astype(bool)])
 
         counts = np.array(list(ctr.items()))[:, 1][:self.n_trn]
 
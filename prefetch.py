@@ -0,0 +1,153 @@
+'''
+background prefetch of per-galaxy input data
+
+while one galaxy is being fit, a reader thread loads (and, for compressed
+    files, decompresses) the data of the next few galaxies into a bounded
+    queue, so that disk and CPU are busy at the same time. Galaxies are
+    delivered in the order they were given; no more than `depth` galaxies
+    are loaded (or loading) at once, besides those already handed out
+'''
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# queue depth and number of concurrent readers suited to different storage:
+# network filesystems have high latency, and reward more requests in flight
+storage_profiles = {'local': {'depth': 1, 'nthreads': 1},
+                    'network': {'depth': 3, 'nthreads': 3}}
+
+_end = object()
+
+
+def load_hdulist_data(hdulist):
+    '''
+    force the data of every HDU to be read (and decompressed)
+    '''
+    for hdu in hdulist:
+        hdu.data
+    return hdulist
+
+
+def load_manga_cubes(plateifu, mpl_v, kind):
+    '''
+    extensions of the DRP logcube and DAP maps of a galaxy used in fitting
+        (see `rectify.HDUSubset`), read fully into memory
+    '''
+    import manga_tools as m
+    from rectify import HDUSubset, drp_extnames, dap_extnames
+
+    plate, ifu = plateifu.split('-')
+    drp_hdulist = HDUSubset(m.load_drp_logcube(plate, ifu, mpl_v), drp_extnames)
+    dap_hdulist = HDUSubset(m.load_dap_maps(plate, ifu, mpl_v, kind), dap_extnames)
+
+    return load_hdulist_data(drp_hdulist), load_hdulist_data(dap_hdulist)
+
+
+class Prefetcher(object):
+    '''
+    load data for a sequence of names ahead of their use
+
+    params:
+     - names: names (e.g., plateifus), in the order they will be asked for
+     - loader: callable taking a name, returning its data
+     - depth: maximum number of items loaded (or being loaded) and
+        waiting to be used
+     - nthreads: number of items loaded concurrently
+     - skip: optional callable; names for which it returns True are not
+        loaded (e.g., galaxies already done)
+    '''
+    def __init__(self, names, loader, depth=1, nthreads=1, skip=None):
+        self.loader = loader
+        self.skip = skip
+        self._order = {name: i for i, name in enumerate(names)}
+        self._peeked = None
+        # a load starts only once it has a slot, which is given back when
+        # its item is handed out (or discarded)
+        self._slots = threading.Semaphore(max(1, depth))
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, nthreads))
+
+        self._thread = threading.Thread(
+            target=self._produce, args=(list(names), ), daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_profile(cls, names, loader, profile='local', skip=None, **kwargs):
+        '''
+        use the queue depth and reader count of a named storage profile
+            (see `storage_profiles`), overridden by any `kwargs`
+        '''
+        settings = dict(storage_profiles[profile])
+        settings.update(kwargs)
+        return cls(names, loader, skip=skip, **settings)
+
+    def _reserve(self):
+        while not self._stop.is_set():
+            if self._slots.acquire(timeout=.5):
+                return True
+        return False
+
+    def _produce(self, names):
+        for name in names:
+            if self._stop.is_set():
+                break
+            if (self.skip is not None) and self.skip(name):
+                continue
+            if not self._reserve():
+                break
+            self._queue.put((name, self._executor.submit(self.loader, name)))
+        self._queue.put(_end)
+
+    def _next_item(self):
+        if self._peeked is not None:
+            item, self._peeked = self._peeked, None
+            return item
+        return self._queue.get()
+
+    def get(self, name):
+        '''
+        data for `name`, or None if it was not (or will not be) prefetched
+
+        items queued ahead of `name` are discarded, since the caller
+            has passed them by
+        '''
+        if name not in self._order:
+            return None
+
+        while True:
+            item = self._next_item()
+            if item is _end:
+                self._peeked = item
+                return None
+
+            item_name, future = item
+            if self._order[item_name] > self._order[name]:
+                # `name` was skipped by the reader: keep this one for later
+                self._peeked = item
+                return None
+            elif item_name == name:
+                # loading errors are raised here, as they would be
+                # if loading had been done synchronously
+                try:
+                    return future.result()
+                finally:
+                    self._slots.release()
+
+            future.cancel()
+            self._slots.release()
+
+    def close(self):
+        '''
+        stop reading ahead, and drop anything already read
+        '''
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        self._peeked = None
@@ -0,0 +1,167 @@
+'''
+opt-in per-galaxy profiling with cProfile and tracemalloc
+
+`galaxy_profile` wraps a galaxy's run: a cProfile `.prof` file (readable
+    with `pstats` or snakeviz) and a report of the largest allocations
+    are written next to the galaxy's results. `sampled` picks every Nth
+    galaxy by a stable hash of its name, so the same galaxies are chosen
+    however work is split among workers and nodes
+
+run this module directly to merge the profiles of many galaxies into one
+    hotspot ranking:
+
+    python profiling.py <results dir or .prof files> --top 30
+'''
+
+import os
+import time
+import zlib
+import pstats
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+# only one profiler may be active per process; nested requests do nothing
+_active = False
+
+
+def sampled(name, every=1):
+    '''
+    whether galaxy `name` is one of every `every` galaxies profiled
+    '''
+    if every <= 1:
+        return True
+    return zlib.crc32(name.encode()) % every == 0
+
+
+def profile_fnames(out_dir, name):
+    return (os.path.join(out_dir, '{}.prof'.format(name)),
+            os.path.join(out_dir, '{}-alloc.txt'.format(name)))
+
+
+def write_alloc_report(fname, snapshot, peak, wall, name, top=25):
+    '''
+    write largest allocations still live in `snapshot`, by source line,
+        along with the peak traced memory
+    '''
+    stats = snapshot.statistics('lineno')
+    with open(fname, 'w') as f:
+        f.write('{}: wall time {:.1f} s, peak traced memory {:.1f} MB\n'.format(
+            name, wall, peak / 1024.**2))
+        f.write('top {} allocations live at end of run:\n'.format(top))
+        for stat in stats[:top]:
+            frame = stat.traceback[0]
+            f.write('{:10.2f} MB {:8d} blocks  {}:{}\n'.format(
+                stat.size / 1024.**2, stat.count, frame.filename, frame.lineno))
+
+
+@contextmanager
+def galaxy_profile(name, out_dir, enabled=True, top=25, nframes=1):
+    '''
+    profile the enclosed run of galaxy `name` (if `enabled`), writing
+        `<name>.prof` and `<name>-alloc.txt` to `out_dir`
+
+    params:
+     - top: number of allocation sites reported
+     - nframes: stack depth stored with each traced allocation
+    '''
+    global _active
+
+    if (not enabled) or _active:
+        yield None
+        return
+
+    _active = True
+    profiler = cProfile.Profile()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start(nframes)
+    tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    profiler.enable()
+
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        wall = time.perf_counter() - t0
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+        _active = False
+
+        os.makedirs(out_dir, exist_ok=True)
+        prof_fname, alloc_fname = profile_fnames(out_dir, name)
+        profiler.dump_stats(prof_fname)
+        write_alloc_report(alloc_fname, snapshot, peak, wall, name, top=top)
+
+
+def find_profiles(paths):
+    '''
+    `.prof` files named in, or found (recursively) under, `paths`
+    '''
+    fnames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                fnames += [os.path.join(root, f) for f in files
+                           if f.endswith('.prof')]
+        else:
+            fnames.append(path)
+    return sorted(fnames)
+
+
+def hotspots(fnames, top=30, sort='tottime'):
+    '''
+    merge profiles and rank functions by `sort` ('tottime' or 'cumtime')
+
+    returns merged `pstats.Stats`, and astropy table of the top functions
+        with their call counts, total & cumulative times, share of all
+        profiled time, and mean time per galaxy
+    '''
+    from astropy import table as t
+
+    stats = pstats.Stats(*fnames)
+    ngal = len(fnames)
+    col = {'tottime': 2, 'cumtime': 3}[sort]
+
+    rows = []
+    for (fname, lineno, func), (cc, nc, tt, ct, _) in sorted(
+            stats.stats.items(), key=lambda kv: -kv[1][col])[:top]:
+        rows.append(('{}:{}({})'.format(os.path.basename(fname), lineno, func),
+                     nc, tt, ct, tt / stats.total_tt if stats.total_tt else 0.,
+                     (tt if sort == 'tottime' else ct) / ngal))
+
+    return stats, t.Table(
+        rows=rows if rows else None,
+        names=['function', 'ncalls', 'tottime', 'cumtime', 'tottime_frac',
+               '{}_per_galaxy'.format(sort)])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='merge per-galaxy profiles into one hotspot ranking')
+    parser.add_argument('paths', nargs='+',
+                        help='.prof files, or directories searched for them')
+    parser.add_argument('--top', type=int, default=30,
+                        help='number of functions listed')
+    parser.add_argument('--sort', default='tottime', choices=['tottime', 'cumtime'],
+                        help='rank by own time or by time including callees')
+    parser.add_argument('--out', default=None,
+                        help='also write merged profile here')
+    argsparsed = parser.parse_args()
+
+    fnames = find_profiles(argsparsed.paths)
+    if not fnames:
+        parser.error('no profiles found')
+
+    stats, ranking = hotspots(fnames, top=argsparsed.top, sort=argsparsed.sort)
+    print('{} profiles, {:.1f} s profiled in total'.format(
+        len(fnames), stats.total_tt))
+    ranking.pprint(max_lines=-1, max_width=-1)
+
+    if argsparsed.out is not None:
+        stats.dump_stats(argsparsed.out)
@@ -8,12 +8,14 @@ from astropy import nddata, wcs
 from importer import *
 import utils as ut
 import spectrophot
+import compact_fits
 
 import manga_tools as m
 
 from glob import glob
 import os
 from functools import lru_cache
+from collections import OrderedDict
 
 class PCASystem(fits.HDUList):
     @property
@@ -36,12 +38,35 @@ class PCASystem(fits.HDUList):
     def dlogl(self):
         return ut.determine_dlogl(self.logl)
 
+    def pc_photometry(self, family='sdss2010-*'):
+        '''
+        `spectrophot.PCPhotometry` of this system (made once per family)
+        '''
+        cache = self.__dict__.setdefault('_pc_photometry', {})
+        if family not in cache:
+            cache[family] = spectrophot.PCPhotometry(
+                lam=self.l * m.l_unit, E=self.E, M=self.M,
+                flam_unit=m.spec_unit, family=family)
+        return cache[family]
+
 class PCAOutput(fits.HDUList):
     '''
     stores output data from PCA that as been written to FITS.
+
+    compact files (see `compact_fits`) are read just like standard ones,
+        provided extensions are accessed through `getdata` (or methods
+        using it)
+
+    files are memory-mapped, and each extension is decoded once and kept
+        (up to `cache_bytes` in all, least-recently-used dropped first);
+        channels and flattened maps are read-only views of what is kept
     '''
+
+    cache_bytes = 2**30
+
     @classmethod
     def from_fname(cls, fname, *args, **kwargs):
+        kwargs.setdefault('memmap', True)
         ret = super().fromfile(fname, *args, **kwargs)
         return ret
 
@@ -49,16 +74,38 @@ class PCAOutput(fits.HDUList):
     def from_plateifu(cls, basedir, plate, ifu, *args, **kwargs):
         fname = os.path.join(basedir, '{}-{}'.format(plate, ifu),
                              '{}-{}_res.fits'.format(plate, ifu))
-        return super().fromfile(fname, *args, **kwargs)
+        return cls.from_fname(fname, *args, **kwargs)
+
+    def _cached(self, key, build):
+        '''
+        result of `build()`, kept under `key` (as a read-only array)
+        '''
+        cache = self.__dict__.setdefault('_data_cache', OrderedDict())
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        a = np.asarray(build()).view()
+        a.flags.writeable = False
+        cache[key] = a
+        while (len(cache) > 1) and \
+            (sum(v.nbytes for v in cache.values()) > self.cache_bytes):
+            cache.popitem(last=False)
+        return a
+
+    def close(self, *args, **kwargs):
+        self.__dict__.pop('_data_cache', None)
+        super().close(*args, **kwargs)
 
     def getdata(self, extname):
         '''
-        get full array in one extension
+        get full array in one extension (read-only)
         '''
-        return self[extname].data
+        key = extname.upper() if isinstance(extname, str) else extname
+        return self._cached(key, lambda: compact_fits.expand(self[extname]))
 
     def flattenedmap(self, extname):
-        return self.getdata(extname).flatten()
+        return self.getdata(extname).ravel()
 
     def cubechannel(self, extname, ch):
         '''
@@ -67,11 +114,11 @@ class PCAOutput(fits.HDUList):
         return self.getdata(extname)[ch]
 
     def flattenedcubechannel(self, extname, ch):
-        return self.cubechannel(extname, ch).flatten()
+        return self.cubechannel(extname, ch).ravel()
 
     def flattenedcubechannels(self, extname, chs):
-        return np.stack([self.flattenedcubechannel(extname, ch)
-                         for ch in chs])
+        a = self.getdata(extname)
+        return a.reshape(a.shape[0], -1)[list(chs)]
 
     def param_dist_med(self, extname, flatten=False):
         med = self.cubechannel(extname, 0)
@@ -88,11 +135,10 @@ class PCAOutput(fits.HDUList):
         return distwid
 
     def setup_photometry(self, pca_system):
-        fitcube_f = self.getdata('NORM') * \
-                    (np.einsum('al,a...->l...', pca_system.E, self.getdata('CALPHA')) + \
-                     pca_system.M[:, None, None]) * m.spec_unit
-        self.spec2phot = spectrophot.Spec2Phot(
-            lam=pca_system.l * m.l_unit, flam=fitcube_f, axis=0)
+        '''
+        photometry of best-fit spectra, found directly from PC amplitudes
+        '''
+        self.spec2phot = fit_spec2phot(self, pca_system)
 
     def get_color(self, b1, b2, filterset='sdss2010', flatten=False):
         if not hasattr(self, 'spec2phot'):
@@ -110,11 +156,13 @@ class PCAOutput(fits.HDUList):
 
     @property
     def mask(self):
-        return np.logical_or(self.getdata('mask').astype(bool),
-                             ~self.getdata('success').astype(bool))
+        return self._cached('__mask__', lambda: np.logical_or(
+            self.getdata('MASK').astype(bool),
+            ~self.getdata('SUCCESS').astype(bool)))
 
     def badPDF(self, ch=2, thresh=1.0e-4):
-        return self.cubechannel('GOODFRAC', ch) < thresh
+        return self._cached(('__badPDF__', ch, thresh),
+                            lambda: self.cubechannel('GOODFRAC', ch) < thresh)
 
     def get_drp_logcube(self, mpl_v):
         plateifu = self[0].header['PLATEIFU']
@@ -132,6 +180,63 @@ class PCAOutput(fits.HDUList):
         return mu, sd
 
 
+class ResultsBatch(object):
+    '''
+    iterate over many results files, keeping at most `max_open` open
+
+        with ResultsBatch(fnames) as batch:
+            for fname, res in batch:
+                ...
+
+    files are opened as they are reached (or asked for, with `batch[fname]`),
+        and the least-recently-used is closed once more than `max_open` are
+        open; all are closed on leaving the context
+
+    params:
+     - fnames: results files
+     - cls: reader class (e.g., `PCAOutput` or `MocksPCAOutput`)
+     - max_open: most files open at once
+     - kwargs: passed to `cls.from_fname`
+    '''
+    def __init__(self, fnames, cls=None, max_open=16, **kwargs):
+        self.fnames = list(fnames)
+        self.cls = PCAOutput if cls is None else cls
+        self.max_open = max_open
+        self.kwargs = kwargs
+        self._open = OrderedDict()
+
+    def __getitem__(self, fname):
+        if fname in self._open:
+            self._open.move_to_end(fname)
+            return self._open[fname]
+
+        res = self.cls.from_fname(fname, **self.kwargs)
+        self._open[fname] = res
+        while len(self._open) > self.max_open:
+            _, oldest = self._open.popitem(last=False)
+            oldest.close()
+        return res
+
+    def __iter__(self):
+        for fname in self.fnames:
+            yield fname, self[fname]
+
+    def __len__(self):
+        return len(self.fnames)
+
+    def close(self):
+        while self._open:
+            _, res = self._open.popitem(last=False)
+            res.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
 class MocksPCAOutput(PCAOutput):
     '''
     PCA output for mocks
@@ -139,7 +244,7 @@ class MocksPCAOutput(PCAOutput):
 
     def truth(self, extname, flatten=False):
         truth = self[extname].header['TRUTH']
-        ret = truth * np.ones_like(self['SNRMED'].data)
+        ret = truth * np.ones_like(self.getdata('SNRMED'))
         if flatten:
             ret = ret.flatten()
         return ret
@@ -185,12 +290,11 @@ def bandpass_mass(res, pca_system, cosmo, band, z):
 def fit_spec2phot(res, pca_system):
     '''
     set up a spectrum-to-photometric conversion for a given pca cube
-    '''
-        # construct best-fit cube
-    fitcube_f = res.getdata('NORM') * \
-                (np.einsum('al,a...->l...', pca_system.E, res.getdata('CALPHA')) + \
-                 pca_system.M[:, None, None]) * m.spec_unit
-    spec2phot = spectrophot.Spec2Phot(lam=pca_system.l * m.l_unit, flam=fitcube_f, axis=0)
 
-    return spec2phot
+    photometry of the best-fit cube is linear in the PC amplitudes, so
+        is found without reconstructing spectra (see
+        `spectrophot.PCPhotometry`)
+    '''
+    return pca_system.pc_photometry().photometry(
+        res.getdata('CALPHA'), res.getdata('NORM'))
 
@@ -15,6 +15,69 @@ import spec_tools
 from elines import (balmer_low, balmer_high, helium, bright_metal, faint_metal)
 from itertools import chain
 
+# extensions actually used in fitting and output; nothing else is read
+drp_extnames = ['FLUX', 'IVAR', 'MASK', 'WAVE', 'GIMG', 'RIMG', 'IIMG', 'ZIMG']
+dap_extnames = ['STELLAR_VEL', 'STELLAR_VEL_IVAR', 'STELLAR_VEL_MASK',
+                'STELLAR_SIGMA', 'STELLAR_SIGMACORR', 'STELLAR_SIGMA_IVAR',
+                'STELLAR_SIGMA_MASK', 'EMLINE_SEW', 'EMLINE_GSIGMA',
+                'EMLINE_GSIGMA_IVAR', 'EMLINE_GSIGMA_MASK', 'SPX_ELLCOO']
+
+
+class HDUSubset(object):
+    '''
+    restricted view of an HDU list: the primary HDU and named extensions
+
+    HDUs are only read when first accessed (memory-mapped, where the file
+        allows), and other extensions cannot be accessed at all, so no
+        unused data is ever read
+    '''
+    def __init__(self, hdulist, extnames):
+        self.hdulist = hdulist
+        self.extnames = [n.upper() for n in extnames]
+
+    @classmethod
+    def open(cls, fname, extnames, memmap=True):
+        return cls(fits.open(fname, memmap=memmap, lazy_load_hdus=True),
+                   extnames)
+
+    def _key(self, key):
+        if key in [0, 'PRIMARY']:
+            return 0
+        if isinstance(key, str) and (key.upper() in self.extnames):
+            return key.upper()
+        raise KeyError('extension {} is not in the loaded subset'.format(key))
+
+    def __getitem__(self, key):
+        return self.hdulist[self._key(key)]
+
+    def __contains__(self, key):
+        try:
+            self._key(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        yield self[0]
+        for n in self.extnames:
+            yield self[n]
+
+    def close(self):
+        self.hdulist.close()
+
+
+def as_native_float32(a):
+    '''
+    single-precision, native-byte-order version of a float array
+
+    only arrays that are already single-precision (typically big-endian,
+        straight from FITS) are converted, since that loses nothing
+    '''
+    if (a.dtype.kind == 'f') and (a.dtype.itemsize <= 4):
+        return a.astype(np.float32, copy=False)
+    return a
+
+
 class MaNGA_deredshift(object):
     '''
     class to deredshift reduced MaNGA data based on velocity info from DAP
@@ -28,6 +91,10 @@ class MaNGA_deredshift(object):
 
     def __init__(self, drp_hdulist, dap_hdulist, drpall_row,
                  max_vel_unc=500. * u.Unit('km/s'), drp_dlogl=None):
+        if not isinstance(drp_hdulist, HDUSubset):
+            drp_hdulist = HDUSubset(drp_hdulist, drp_extnames)
+        if not isinstance(dap_hdulist, HDUSubset):
+            dap_hdulist = HDUSubset(dap_hdulist, dap_extnames)
         self.drp_hdulist = drp_hdulist
         self.dap_hdulist = dap_hdulist
         self.drpall_row = drpall_row
@@ -50,26 +117,22 @@ class MaNGA_deredshift(object):
             drp_dlogl = ut.determine_dlogl(self.drp_logl)
         self.drp_dlogl = drp_dlogl
 
-        flux_hdu, ivar_hdu, l_hdu = (drp_hdulist['FLUX'], drp_hdulist['IVAR'],
-                                     drp_hdulist['WAVE'])
-
-        self.flux = flux_hdu.data
-        self.ivar = ivar_hdu.data
-
         self.units = {'l': u.AA, 'flux': u.Unit('1e-17 erg s-1 cm-2 AA-1')}
 
-        self.S2P = Spec2Phot(lam=(self.drp_l * self.units['l']),
-                             flam=(self.flux * self.units['flux']))
-
         self.DONOTUSE = m.mask_from_maskbits(drp_hdulist['MASK'].data, [10])
 
-        self.ivar *= ~self.DONOTUSE
+        # flux & ivar cubes, and photometric objects, are built on first use
+        self._flux, self._ivar = None, None
+        self._S2P, self._S2P_rest, self._S2P_rest_args = None, None, None
 
     @classmethod
     def from_plateifu(cls, plate, ifu, MPL_v, kind, row=None,
-                      **kwargs):
+                      hdulists=None, **kwargs):
         '''
         load a MaNGA galaxy from a plateifu specification
+
+        `hdulists` optionally gives already-loaded (e.g., prefetched)
+            DRP and DAP HDU lists
         '''
 
         plate, ifu = str(plate), str(ifu)
@@ -78,8 +141,13 @@ class MaNGA_deredshift(object):
             drpall = m.load_drpall(MPL_v, index='plateifu')
             row = drpall.loc['{}-{}'.format(plate, ifu)]
 
-        drp_hdulist = m.load_drp_logcube(plate, ifu, MPL_v)
-        dap_hdulist = m.load_dap_maps(plate, ifu, MPL_v, kind)
+        if hdulists is None:
+            drp_hdulist = HDUSubset(
+                m.load_drp_logcube(plate, ifu, MPL_v), drp_extnames)
+            dap_hdulist = HDUSubset(
+                m.load_dap_maps(plate, ifu, MPL_v, kind), dap_extnames)
+        else:
+            drp_hdulist, dap_hdulist = hdulists
         return cls(drp_hdulist, dap_hdulist, row, **kwargs)
 
     @classmethod
@@ -95,10 +163,12 @@ class MaNGA_deredshift(object):
             drpall = m.load_drpall(MPL_v, index='plateifu')
             row = drpall.loc['{}-{}'.format(plate, ifu)]
 
-        drp_hdulist = fits.open(
-            os.path.join(basedir, '{}-{}_drp.fits'.format(plate, ifu)))
-        dap_hdulist = fits.open(
-            os.path.join(basedir, '{}-{}_dap.fits'.format(plate, ifu)))
+        drp_hdulist = HDUSubset.open(
+            os.path.join(basedir, '{}-{}_drp.fits'.format(plate, ifu)),
+            drp_extnames)
+        dap_hdulist = HDUSubset.open(
+            os.path.join(basedir, '{}-{}_dap.fits'.format(plate, ifu)),
+            dap_extnames)
 
         return cls(drp_hdulist, dap_hdulist, row, **kwargs)
 
@@ -135,23 +205,7 @@ class MaNGA_deredshift(object):
                 'template\'s is {}; input spectra\'s is {}'.format(
                     template_dlogl, self.drp_dlogl))
 
-        # correct for MW extinction
-        r_v = 3.1
-        EBV = self.drp_hdulist[0].header['EBVGAL']
-        f_mwcorr, ivar_mwcorr = ut.extinction_correct(
-            l=self.drp_l * u.AA, f=self.flux,
-            ivar=self.ivar, r_v=r_v, EBV=EBV)
-
-        l_rest, f_rest, ivar_rest = self.transform_to_restframe(
-            self.drp_l, f_mwcorr, ivar_mwcorr)
-
-        # and make photometric object to reflect rest-frame spectroscopy
-        ctr = [i // 2 for i in self.z_map.shape]
-        # approximate rest wavelength of whole cube as rest wavelength
-        # of central spaxel
-        l_rest_ctr = l_rest[:, ctr[0], ctr[1]]
-        self.S2P_rest = Spec2Phot(lam=(l_rest_ctr * self.units['l']),
-                                  flam=(f_rest * self.units['flux']))
+        l_rest, f_rest, ivar_rest = self._restframe()
 
         self.regrid = regrid.Regridder(
             loglgrid=template_logl, loglrest=np.log10(l_rest),
@@ -168,6 +222,28 @@ class MaNGA_deredshift(object):
 
         return flux_regr, ivar_regr, spax_mask
 
+    def _restframe(self):
+        '''
+        correct for MW extinction and shift into rest frame, and prepare
+            photometric object reflecting rest-frame spectroscopy
+        '''
+        r_v = 3.1
+        EBV = self.drp_hdulist[0].header['EBVGAL']
+        f_mwcorr, ivar_mwcorr = ut.extinction_correct(
+            l=self.drp_l * u.AA, f=self.flux,
+            ivar=self.ivar, r_v=r_v, EBV=EBV)
+
+        l_rest, f_rest, ivar_rest = self.transform_to_restframe(
+            self.drp_l, f_mwcorr, ivar_mwcorr)
+
+        ctr = [i // 2 for i in self.z_map.shape]
+        # approximate rest wavelength of whole cube as rest wavelength
+        # of central spaxel
+        l_rest_ctr = l_rest[:, ctr[0], ctr[1]]
+        self._S2P_rest, self._S2P_rest_args = None, (l_rest_ctr, f_rest)
+
+        return l_rest, f_rest, ivar_rest
+
     def compute_eline_mask(self, template_logl, template_dlogl=None, ix_eline=7,
                            half_dv=300. * u.Unit('km/s')):
 
@@ -234,10 +310,56 @@ class MaNGA_deredshift(object):
 
         return lam, flux, ivar
 
+    def close(self):
+        '''
+        close input files, and drop the observed-frame cubes and
+            photometric objects built from them
+        '''
+        self.drp_hdulist.close()
+        self.dap_hdulist.close()
+        self._flux, self._ivar = None, None
+        self._S2P, self._S2P_rest, self._S2P_rest_args = None, None, None
+        self.regrid = None
+
     # =====
     # properties
     # =====
 
+    @property
+    def flux(self):
+        if self._flux is None:
+            self._flux = as_native_float32(self.drp_hdulist['FLUX'].data)
+        return self._flux
+
+    @property
+    def ivar(self):
+        if self._ivar is None:
+            self._ivar = as_native_float32(
+                self.drp_hdulist['IVAR'].data) * ~self.DONOTUSE
+        return self._ivar
+
+    @property
+    def S2P(self):
+        if self._S2P is None:
+            self._S2P = Spec2Phot(lam=(self.drp_l * self.units['l']),
+                                  flam=(self.flux * self.units['flux']))
+        return self._S2P
+
+    @property
+    def S2P_rest(self):
+        '''
+        photometric object reflecting rest-frame spectroscopy
+            (prepared by `correct_and_match`, or on first use without it,
+            e.g., when a fit resumes from a checkpoint)
+        '''
+        if self._S2P_rest is None:
+            if self._S2P_rest_args is None:
+                self._restframe()
+            l_rest_ctr, f_rest = self._S2P_rest_args
+            self._S2P_rest = Spec2Phot(lam=(l_rest_ctr * self.units['l']),
+                                       flam=(f_rest * self.units['flux']))
+        return self._S2P_rest
+
     @property
     def z_map(self):
         # prepare to de-redshift
@@ -0,0 +1,227 @@
+'''
+run per-galaxy fits in several worker processes
+
+large, read-only inputs (the PCA basis, and the observational covariance
+    and its precomputed PC projections) are written once to `.npy` files in
+    a shared directory (under /dev/shm where available) and memory-mapped,
+    so workers share one copy of their pages rather than each holding
+    its own. Workers are forked, and each is limited to a few BLAS threads,
+    so that (workers x threads) does not oversubscribe the node
+'''
+
+import numpy as np
+
+import os
+import sys
+import time
+import queue
+import shutil
+import tempfile
+import multiprocessing as mpc
+from traceback import print_exception
+
+blas_env_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# set in parent before workers are forked
+_fit_func = None
+_blas_limiter = None
+
+
+def limit_blas_threads(n):
+    '''
+    limit BLAS/OpenMP thread pools to `n` threads
+
+    environment variables cover libraries not yet initialized; if
+        `threadpoolctl` is available, pools already running are limited too
+    '''
+    global _blas_limiter
+
+    for k in blas_env_vars:
+        os.environ[k] = str(n)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    _blas_limiter = threadpool_limits(limits=n)
+
+
+def default_share_dir():
+    '''
+    make a directory for shared arrays, in RAM-backed /dev/shm if possible
+    '''
+    parent = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    return tempfile.mkdtemp(dir=parent, prefix='pcay_share_')
+
+
+def share_array(a, share_dir, name):
+    '''
+    write `a` to `share_dir` and return a read-only memory map of it
+    '''
+    fname = os.path.join(share_dir, '{}.npy'.format(name))
+    np.save(fname, np.ascontiguousarray(a))
+    return np.load(fname, mmap_mode='r')
+
+
+def share_basis(pca, share_dir, keep_training=False):
+    '''
+    memory-mapped copy of a PCA basis (see `basis_store`)
+
+    the (nmodels, nl) normalized training spectra, used only for figures,
+        are copied only if `keep_training`; a basis already loaded from
+        disk is returned as-is
+    '''
+    if getattr(pca, 'basis_dir', None) is not None:
+        return pca
+
+    basis_dir = os.path.join(share_dir, 'basis')
+    pca.write_basis(basis_dir, skip=[] if keep_training else ['normed_trn'])
+    return type(pca).from_basis(basis_dir)
+
+
+def share_K_obs(K_obs, share_dir, nl):
+    '''
+    replace the large arrays of a `cov_obs.Cov_Obs` (after
+        `precompute_Kpcs`) with memory maps, in place
+
+    `nl` is the window width given to `_init_windows`
+    '''
+    K_obs.cov = share_array(K_obs.cov, share_dir, 'K_obs_cov')
+    K_obs.precision = share_array(K_obs.precision, share_dir, 'K_obs_precision')
+    K_obs.covwindows.all_K_PCs = share_array(
+        K_obs.covwindows.all_K_PCs, share_dir, 'K_obs_all_K_PCs')
+    K_obs._init_windows(nl)
+
+    return K_obs
+
+
+def _init_worker(blas_threads):
+    limit_blas_threads(blas_threads)
+
+
+def _run_one(task):
+    '''
+    run `_fit_func` on one task, returning (task, status, elapsed time)
+
+    `_fit_func` returns None if it declined the task (e.g., already done),
+        and otherwise True on success or False on failure
+    '''
+    t0 = time.time()
+    try:
+        res = _fit_func(task)
+    except Exception:
+        print('ERROR: {}'.format(task))
+        print_exception(*sys.exc_info())
+        res = False
+
+    if res is None:
+        status = 'skipped'
+    elif res:
+        status = 'success'
+    else:
+        status = 'failed'
+
+    return task, status, time.time() - t0
+
+
+class GalaxyScheduler(object):
+    '''
+    run `fit_func` over a sequence of tasks (e.g., plateifus) in
+        `nworkers` forked processes
+
+    params:
+     - fit_func: callable taking one task (see `_run_one` for return values);
+        anything it refers to is inherited by the workers when they fork
+     - nworkers: number of worker processes (1 runs in this process)
+     - blas_threads: BLAS threads per worker (defaults to
+        cores // nworkers)
+    '''
+    def __init__(self, fit_func, nworkers=1, blas_threads=None):
+        self.fit_func = fit_func
+        self.nworkers = max(1, nworkers)
+        if blas_threads is None:
+            blas_threads = max(1, mpc.cpu_count() // self.nworkers)
+        self.blas_threads = blas_threads
+
+    def run(self, tasks, target=None):
+        '''
+        run tasks until `target` of them have been attempted (skipped
+            tasks do not count), or until tasks run out
+
+        no more than `nworkers` tasks are in flight at once, so skipped
+            tasks are replaced by later ones without over-running `target`
+
+        returns list of (task, status, elapsed time)
+        '''
+        global _fit_func
+        _fit_func = self.fit_func
+
+        if target is None:
+            target = np.inf
+
+        tasks = iter(tasks)
+        results = []
+        nattempted, ninflight, exhausted = 0, 0, False
+        t0 = time.time()
+
+        def next_task():
+            try:
+                return next(tasks), True
+            except StopIteration:
+                return None, False
+
+        if self.nworkers == 1:
+            limit_blas_threads(self.blas_threads)
+            while nattempted < target:
+                task, ok = next_task()
+                if not ok:
+                    break
+                res = _run_one(task)
+                results.append(res)
+                if res[1] != 'skipped':
+                    nattempted += 1
+
+        else:
+            done = queue.Queue()
+            ctx = mpc.get_context('fork')
+            with ctx.Pool(processes=self.nworkers, initializer=_init_worker,
+                          initargs=(self.blas_threads, )) as pool:
+                while True:
+                    while (not exhausted) and (ninflight < self.nworkers) and \
+                        (nattempted + ninflight < target):
+                        task, ok = next_task()
+                        if not ok:
+                            exhausted = True
+                            break
+                        pool.apply_async(
+                            _run_one, (task, ), callback=done.put,
+                            error_callback=lambda e, task=task: done.put(
+                                (task, 'failed', np.nan)))
+                        ninflight += 1
+
+                    if ninflight == 0:
+                        break
+
+                    res = done.get()
+                    ninflight -= 1
+                    results.append(res)
+                    if res[1] != 'skipped':
+                        nattempted += 1
+
+        self.report(results, time.time() - t0)
+
+        return results
+
+    def report(self, results, walltime):
+        nsuccess = sum(r[1] == 'success' for r in results)
+        nfailed = sum(r[1] == 'failed' for r in results)
+        print('{} galaxies succeeded, {} failed, in {:.1f} s ({} worker(s))'.format(
+            nsuccess, nfailed, walltime, self.nworkers))
+        if walltime > 0.:
+            print('throughput: {:.1f} galaxies/hour'.format(
+                3600. * (nsuccess + nfailed) / walltime))
+
+
+def cleanup_share_dir(share_dir):
+    shutil.rmtree(share_dir, ignore_errors=True)
@@ -0,0 +1,425 @@
+'''
+survey-wide, columnar store of spaxel-level results
+
+rather than opening thousands of results files to pull a few maps, a
+    consolidation step appends each finished galaxy's spaxel-level products
+    to a store directory. Each product is a flat column (one element per
+    spaxel), and columns are written in chunks of many galaxies, one `.npy`
+    file per column per chunk, alongside a JSON manifest of the chunks,
+    their galaxies, and the range of every column in each chunk
+
+queries memory-map only the columns they use, and skip any chunk whose
+    column ranges show that no spaxel can satisfy the query's conditions
+
+columns (all float32 unless noted) are
+ - galaxy (int32: index into `SpaxelStore.plateifus`), i & j (int16:
+    spaxel indices within map)
+ - <qty>, <qty>_lunc, <qty>_uunc: median, lower & upper uncertainty of each
+    quantity with credible intervals
+ - CALPHA<n>: amplitude of PC n
+ - GOODFRAC<n>: plane n of GOODFRAC
+ - SNRMED, LOG_LUM_I, NORM, MODELNUM (int32), MASK & SUCCESS (bool)
+
+broadband photometry of the best-fit spectra of any selection of spaxels
+    follows from CALPHA<n> and NORM (see `query_photometry`)
+
+for mocks, the true value of each quantity is kept per galaxy, in the
+    manifest (see `SpaxelStore.truth`)
+
+build or update a store from results files (galaxies already in it are
+    skipped), then query it, e.g.:
+
+    python spaxel_store.py <store dir> '<results dir>/*/*_zpres.fits'
+
+    store = SpaxelStore(<store dir>)
+    d = store.query(['MLi', 'SNRMED'], where=good_spaxels)
+'''
+
+import numpy as np
+
+import os
+import re
+import json
+import shutil
+import tempfile
+
+# version 2 added column NORM (needed by `query_photometry`)
+STORE_FORMAT_VERSION = 2
+MANIFEST_FNAME = 'manifest.json'
+
+# conditions selecting spaxels with trustworthy fits, as used (for one file
+# at a time) by `lib_diags.harvest_from_result`
+good_spaxels = [('MASK', '==', False), ('SUCCESS', '==', True),
+                ('GOODFRAC2', '>=', 1.0e-4), ('SNRMED', '>=', .1)]
+
+_ops = {'<': np.less, '<=': np.less_equal, '>': np.greater,
+        '>=': np.greater_equal, '==': np.equal, '!=': np.not_equal}
+
+
+class StoreFormatError(Exception):
+    '''
+    store directory is missing, or of an unsupported version
+    '''
+    pass
+
+
+def _colfname(i):
+    return 'col_{:03d}.npy'.format(i)
+
+
+def _chunkname(i):
+    return 'chunk_{:05d}'.format(i)
+
+
+def galaxy_columns(res):
+    '''
+    flat, per-spaxel columns of one galaxy's results
+
+    params:
+     - res: `read_results.PCAOutput`
+    '''
+    snr = res.getdata('SNRMED')
+    ii, jj = np.indices(snr.shape)
+    cols = {'i': ii.ravel().astype(np.int16), 'j': jj.ravel().astype(np.int16),
+            'SNRMED': snr.ravel().astype(np.float32),
+            'MASK': res.getdata('MASK').ravel().astype(bool),
+            'SUCCESS': res.getdata('SUCCESS').ravel().astype(bool),
+            'MODELNUM': res.getdata('MODELNUM').ravel().astype(np.int32)}
+
+    for hdu in res[1:]:
+        extname = hdu.header['EXTNAME']
+        if extname in ['LOG_LUM_I', 'NORM']:
+            cols[extname] = res.getdata(extname).ravel().astype(np.float32)
+        elif extname in ['CALPHA', 'GOODFRAC']:
+            for n, plane in enumerate(res.getdata(extname)):
+                cols['{}{}'.format(extname, n)] = plane.ravel().astype(np.float32)
+        elif 'QTYNAME' in hdu.header:
+            P50, l_unc, u_unc = res.getdata(extname)
+            qty = hdu.header['QTYNAME']
+            cols[qty] = P50.ravel().astype(np.float32)
+            cols['{}_lunc'.format(qty)] = l_unc.ravel().astype(np.float32)
+            cols['{}_uunc'.format(qty)] = u_unc.ravel().astype(np.float32)
+
+    return cols
+
+
+def galaxy_truths(res):
+    '''
+    true values (from extension headers) of one mock galaxy's quantities
+    '''
+    return {hdu.header['QTYNAME']: float(hdu.header['TRUTH'])
+            for hdu in res[1:]
+            if ('QTYNAME' in hdu.header) and ('TRUTH' in hdu.header)}
+
+
+def plateifu_from_fn(fn):
+    '''
+    plateifu of a results file, from its name (e.g., zpmangapca-8083-12704.fits,
+        res-8083-12704.fits, or 8083-12704_zpres.fits)
+    '''
+    name = os.path.basename(fn)
+    match = re.search(r'\d+-\d+', name)
+    if match is None:
+        raise ValueError('no plateifu in file name {}'.format(name))
+    return match.group()
+
+
+def _col_range(a):
+    '''
+    JSON-serializable (min, max) of `a`, or None if that rules nothing out
+    '''
+    if a.dtype.kind == 'f':
+        a = a[np.isfinite(a)]
+    if a.size == 0:
+        return None
+    return [a.min().item(), a.max().item()]
+
+
+def _may_match(rng, op, value):
+    '''
+    could any element in range `rng` satisfy `op` `value`?
+    '''
+    if rng is None:
+        return True
+    lo, hi = rng
+    return {'<': lambda: lo < value, '<=': lambda: lo <= value,
+            '>': lambda: hi > value, '>=': lambda: hi >= value,
+            '==': lambda: lo <= value <= hi, '!=': lambda: True}[op]()
+
+
+class SpaxelStore(object):
+    '''
+    columnar store of spaxel-level results of many galaxies
+
+    params:
+     - store_dir: directory of store (created on first `append`)
+     - chunk_rows: galaxies are buffered until they have this many spaxels,
+        then written as one chunk
+    '''
+    def __init__(self, store_dir, chunk_rows=2**20):
+        self.store_dir = store_dir
+        self.chunk_rows = chunk_rows
+        self._buffer = []
+        self._truths = {}
+
+        fname = os.path.join(store_dir, MANIFEST_FNAME)
+        if os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                self.manifest = json.load(f)
+            version = self.manifest.get('format_version', None)
+            if version != STORE_FORMAT_VERSION:
+                raise StoreFormatError(
+                    'store format version {} unsupported (expected {}): '
+                    'rebuild store in a new directory'.format(
+                        version, STORE_FORMAT_VERSION))
+        else:
+            self.manifest = {'format_version': STORE_FORMAT_VERSION,
+                             'columns': {}, 'plateifus': [], 'chunks': []}
+
+    @property
+    def plateifus(self):
+        '''
+        galaxies in store, indexed by column 'galaxy'
+        '''
+        return self.manifest['plateifus'] + [p for p, _ in self._buffer]
+
+    @property
+    def columns(self):
+        return list(self.manifest['columns'])
+
+    def __len__(self):
+        return sum(c['nrows'] for c in self.manifest['chunks'])
+
+    def __contains__(self, plateifu):
+        return plateifu in set(self.plateifus)
+
+    def append(self, plateifu, cols, truths=None):
+        '''
+        add one galaxy's columns (e.g., from `galaxy_columns`), and for a
+            mock, its true values (from `galaxy_truths`), writing a chunk
+            when enough have accumulated
+
+        the first galaxy fixes the columns of the store; later galaxies
+            lacking some have them filled (NaN, 0, or False), and any others
+            they have are dropped
+        '''
+        if not self.manifest['columns']:
+            self.manifest['columns'] = {
+                k: {'dtype': a.dtype.str} for k, a in sorted(cols.items())}
+        self._buffer.append((plateifu, cols))
+        if truths:
+            self._truths[plateifu] = truths
+        if sum(len(c['i']) for _, c in self._buffer) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        '''
+        write buffered galaxies as one chunk, and update manifest
+        '''
+        if not self._buffer:
+            return
+
+        g0 = len(self.manifest['plateifus'])
+        chunk = {'name': _chunkname(len(self.manifest['chunks'])),
+                 'plateifus': [p for p, _ in self._buffer],
+                 'nrows': sum(len(c['i']) for _, c in self._buffer),
+                 'ranges': {}}
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.store_dir, prefix='.tmp_chunk_')
+        try:
+            names = ['galaxy'] + self.columns
+            for ci, name in enumerate(names):
+                if name == 'galaxy':
+                    a = np.concatenate(
+                        [np.full(len(c['i']), g0 + gi, dtype=np.int32)
+                         for gi, (_, c) in enumerate(self._buffer)])
+                else:
+                    dtype = np.dtype(self.manifest['columns'][name]['dtype'])
+                    fill = np.nan if dtype.kind == 'f' else 0
+                    a = np.concatenate(
+                        [c[name].astype(dtype) if name in c else
+                         np.full(len(c['i']), fill, dtype=dtype)
+                         for _, c in self._buffer])
+                np.save(os.path.join(tmp_dir, _colfname(ci)), a)
+                chunk['ranges'][name] = _col_range(a)
+            chunk['files'] = {name: _colfname(ci) for ci, name in enumerate(names)}
+
+            # a chunk left by a crash before the manifest listed it
+            chunk_dir = os.path.join(self.store_dir, chunk['name'])
+            if os.path.isdir(chunk_dir):
+                shutil.rmtree(chunk_dir)
+            os.rename(tmp_dir, chunk_dir)
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.manifest['plateifus'] += chunk['plateifus']
+        self.manifest['chunks'].append(chunk)
+        if self._truths:
+            self.manifest.setdefault('truths', {}).update(self._truths)
+        self._buffer, self._truths = [], {}
+
+        # replace manifest atomically: a chunk not listed in it is ignored
+        tmp_fname = os.path.join(self.store_dir, '.' + MANIFEST_FNAME)
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_fname, os.path.join(self.store_dir, MANIFEST_FNAME))
+
+    def truth(self, qty, galaxy):
+        '''
+        true value of `qty` (NaN where unknown) for each element of
+            `galaxy` (column 'galaxy' of a query)
+        '''
+        truths = self.manifest.get('truths', {})
+        per_galaxy = np.array(
+            [truths.get(p, {}).get(qty, np.nan)
+             for p in self.manifest['plateifus']], dtype=float)
+        return per_galaxy[np.asarray(galaxy)]
+
+    def _load(self, chunk, name):
+        if name not in chunk['files']:
+            raise KeyError(name)
+        return np.load(os.path.join(self.store_dir, chunk['name'],
+                                    chunk['files'][name]), mmap_mode='r')
+
+    def query(self, columns, where=[], plateifus=None):
+        '''
+        flat arrays of `columns` for spaxels meeting all conditions
+
+        params:
+         - columns: names of columns (may include 'plateifu', which gives
+            each spaxel's galaxy by name)
+         - where: list of (column, op, value), with op one of
+            '<', '<=', '>', '>=', '==', '!='
+         - plateifus: if given, only spaxels of these galaxies
+
+        returns dict of column name: array
+        '''
+        for _, op, _ in where:
+            if op not in _ops:
+                raise ValueError('unrecognized operator: {}'.format(op))
+
+        gal_ix = None
+        if plateifus is not None:
+            ix = {p: i for i, p in enumerate(self.manifest['plateifus'])}
+            gal_ix = np.array([ix[p] for p in plateifus if p in ix], dtype=np.int32)
+
+        loaded = [c for c in columns if c != 'plateifu']
+        if ('plateifu' in columns) and ('galaxy' not in loaded):
+            loaded.append('galaxy')
+
+        parts = {c: [] for c in loaded}
+        for chunk in self.manifest['chunks']:
+            if (gal_ix is not None) and \
+                not set(chunk['plateifus']).intersection(plateifus):
+                continue
+            if not all(_may_match(chunk['ranges'].get(k), op, v)
+                       for k, op, v in where):
+                continue
+
+            sel = np.ones(chunk['nrows'], dtype=bool)
+            for k, op, v in where:
+                sel &= _ops[op](self._load(chunk, k), v)
+            if gal_ix is not None:
+                sel &= np.isin(self._load(chunk, 'galaxy'), gal_ix)
+
+            for c in loaded:
+                parts[c].append(self._load(chunk, c)[sel])
+
+        res = {}
+        for c in loaded:
+            if parts[c]:
+                res[c] = np.concatenate(parts[c])
+            else:
+                dtype = np.int32 if c == 'galaxy' else \
+                        np.dtype(self.manifest['columns'][c]['dtype'])
+                res[c] = np.empty(0, dtype=dtype)
+
+        if 'plateifu' in columns:
+            res['plateifu'] = np.array(self.manifest['plateifus'])[res['galaxy']] \
+                if len(res['galaxy']) else np.empty(0, dtype=str)
+            if 'galaxy' not in columns:
+                del res['galaxy']
+
+        return res
+
+
+def photometry_columns(pc_photometry):
+    '''
+    columns needed for photometry (see `photometry`)
+    '''
+    q = pc_photometry.R_E.shape[1]
+    return ['CALPHA{}'.format(n) for n in range(q)] + ['NORM']
+
+
+def photometry(res, pc_photometry):
+    '''
+    AB magnitudes (keyed by filter name) of best-fit spectra of spaxels of
+        a query result `res` that includes `photometry_columns`
+
+    params:
+     - pc_photometry: `spectrophot.PCPhotometry` of the PCA system
+    '''
+    *calpha, norm = photometry_columns(pc_photometry)
+    return pc_photometry.ABmags(
+        np.stack([res[c] for c in calpha]), res[norm])
+
+
+def query_photometry(store, pc_photometry, where=[], plateifus=None):
+    '''
+    AB magnitudes (keyed by filter name) of best-fit spectra of spaxels
+        meeting all conditions (see `SpaxelStore.query` and `photometry`)
+    '''
+    res = store.query(photometry_columns(pc_photometry), where=where,
+                      plateifus=plateifus)
+    return photometry(res, pc_photometry)
+
+
+def consolidate(store_dir, results_fnames, mock=False, chunk_rows=2**20):
+    '''
+    append galaxies in `results_fnames` not yet in store at `store_dir`
+
+    galaxies are identified by file name (see `plateifu_from_fn`), so only
+        files of new galaxies are opened
+
+    returns the store
+    '''
+    import read_results
+
+    cls = read_results.MocksPCAOutput if mock else read_results.PCAOutput
+    store = SpaxelStore(store_dir, chunk_rows=chunk_rows)
+    done = set(store.plateifus)
+
+    for fname in sorted(results_fnames):
+        plateifu = plateifu_from_fn(fname)
+        if plateifu in done:
+            continue
+        with cls.from_fname(fname) as res:
+            store.append(plateifu, galaxy_columns(res),
+                         truths=galaxy_truths(res) if mock else None)
+        done.add(plateifu)
+
+    store.flush()
+    return store
+
+
+if __name__ == '__main__':
+    import argparse
+    from glob import glob
+
+    parser = argparse.ArgumentParser(
+        description='add results files to a columnar spaxel store')
+    parser.add_argument('store_dir', help='directory of store')
+    parser.add_argument('globstr', help='glob pattern of results files')
+    parser.add_argument('--mock', action='store_true',
+                        help='results are of mocks')
+    parser.add_argument('--chunkrows', type=int, default=2**20,
+                        help='spaxels per chunk')
+    argsparsed = parser.parse_args()
+
+    store = consolidate(argsparsed.store_dir, glob(argsparsed.globstr, recursive=True),
+                        mock=argsparsed.mock, chunk_rows=argsparsed.chunkrows)
+    print('{}: {} galaxies, {} spaxels, {} chunks'.format(
+        argsparsed.store_dir, len(store.plateifus), len(store),
+        len(store.manifest['chunks'])))
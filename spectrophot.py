@@ -8,6 +8,8 @@ from speclite import filters
 import astropy.io
 
 from warnings import warn
+from collections import OrderedDict
+import hashlib
 
 
 l_eff_d = {'r': 6166. * u.AA, 'i': 7480. * u.AA, 'z': 8932. * u.AA}
@@ -21,38 +23,214 @@ class Spec2PhotWarning(UserWarning):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+def _to_value(a, unit):
+    '''
+    values of `a` in `unit` (plain arrays are taken to be in `unit` already)
+    '''
+    if isinstance(a, u.Quantity):
+        return a.to_value(unit)
+    return np.asarray(a)
+
+def load_filterset(family='sdss2010-*', redshift=None):
+    filts = filters.load_filters(family)
+    if redshift is not None:
+        filts = filters.FilterSequence(
+            [f_.create_shifted(band_shift=redshift) for f_ in filts])
+    return filts
+
+class FilterResponseMatrix(object):
+    '''
+    filter curves of one family resampled onto one wavelength grid, as a
+        (nbands, nl) matrix of integration weights: the maggies of any
+        spectra on that grid are then a single tensordot
+
+    the weights reproduce speclite (trapezoid-rule integration over the
+        grid, padded with zeros where filters extend past it), and are
+        normalized by speclite's own maggies of a flat spectrum
+
+    params:
+     - lam: wavelength grid (Angstroms, if no units)
+     - family: speclite filter family
+     - redshift: if given, filters are shifted blueward by this redshift
+    '''
+    def __init__(self, lam, family='sdss2010-*', redshift=None):
+        self.filters = load_filterset(family, redshift)
+        self.names = list(self.filters.names)
+        self.lam = _to_value(lam, u.AA).astype(np.float64)
+        nl = len(self.lam)
+
+        # grid speclite would integrate over: padded values are zero, so
+        # only weights at the original wavelengths are kept
+        _, lam_pad = self.filters.pad_spectrum(
+            spectrum=np.zeros(nl), wavelength=self.lam, method='zero')
+        lam_pad = _to_value(lam_pad, u.AA)
+        self.padded = len(lam_pad) > nl
+        i0 = np.searchsorted(lam_pad, self.lam[0])
+
+        dl = np.diff(lam_pad)
+        trapz_wt = np.zeros_like(lam_pad)
+        trapz_wt[:-1] += .5 * dl
+        trapz_wt[1:] += .5 * dl
+
+        # photon-weighted response, on padded grid
+        R = np.stack([np.interp(lam_pad, _to_value(f_.wavelength, u.AA),
+                                f_.response, left=0., right=0.)
+                      for f_ in self.filters])
+        U = R * (lam_pad * trapz_wt)[None, :]
+
+        flat = self.filters.get_ab_maggies(
+            spectrum=np.ones_like(lam_pad), wavelength=lam_pad)
+        flat = np.array([np.atleast_1d(flat[n])[0] for n in self.names])
+        self.W = U[:, i0:i0 + nl] * (flat / U.sum(axis=1))[:, None]
+
+    def maggies(self, flam, axis=0):
+        '''
+        maggies in each band (along new leading axis) of spectra `flam`
+            (erg/s/cm2/AA, if no units), with wavelength along `axis`
+        '''
+        flam = _to_value(flam, u.Unit('erg s-1 cm-2 AA-1'))
+        return np.tensordot(self.W, np.ma.getdata(flam), axes=(1, axis))
+
+    def ABmags(self, flam, axis=0):
+        '''
+        AB magnitudes of spectra (see `maggies`), keyed by filter name
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mags = -2.5 * np.log10(self.maggies(flam, axis=axis))
+        return dict(zip(self.names, mags))
+
+# response matrices of recently-used grids, keyed by family, redshift,
+# and hash of grid (e.g., all observed-frame DRP cubes share one)
+_response_cache = OrderedDict()
+response_cache_size = 64
+
+def response_matrix(lam, family='sdss2010-*', redshift=None):
+    '''
+    cached `FilterResponseMatrix` for grid `lam`
+    '''
+    lam_AA = np.ascontiguousarray(_to_value(lam, u.AA), dtype=np.float64)
+    key = (family, redshift, hashlib.sha1(lam_AA.tobytes()).hexdigest())
+    if key in _response_cache:
+        _response_cache.move_to_end(key)
+        return _response_cache[key]
+
+    rm = FilterResponseMatrix(lam_AA, family=family, redshift=redshift)
+    _response_cache[key] = rm
+    while len(_response_cache) > response_cache_size:
+        _response_cache.popitem(last=False)
+    return rm
+
+def speclite_deviation(lam, flam, family='sdss2010-*', axis=0, redshift=None):
+    '''
+    largest difference (in magnitudes, over finite values) between
+        `Spec2Phot` and speclite's own `get_ab_magnitudes`
+    '''
+    filts = load_filterset(family, redshift)
+    flam_pad, lam_pad = filts.pad_spectrum(
+        spectrum=np.moveaxis(flam, axis, -1), wavelength=lam, method='zero')
+    ref = filts.get_ab_magnitudes(spectrum=flam_pad, wavelength=lam_pad, axis=-1)
+    mags = Spec2Phot(lam, flam, family=family, axis=axis, redshift=redshift).ABmags
+
+    dev = 0.
+    for n in ref.colnames:
+        good = np.isfinite(ref[n]) & np.isfinite(mags[n])
+        if good.any():
+            dev = max(dev, np.abs(np.asarray(ref[n])[good] - mags[n][good]).max())
+    return dev
+
 class Spec2Phot(object):
     '''
     object to convert spectra into photometric magnitudes
+
+    magnitudes are found with a cached `FilterResponseMatrix` for the
+        wavelength grid, as a single tensordot (without copying or padding
+        spectra); `ABmags` is keyed by filter name
     '''
     def __init__(self, lam, flam, family='sdss2010-*', axis=0,
                  redshift=None):
 
-        self.filters = filters.load_filters(family)
-
-        if redshift is not None:
-            self.filters = filters.FilterSequence(
-                [f_.create_shifted(band_shift=redshift)
-                 for f_ in self.filters])
-        else:
-            pass
-        # spectral dimension has to be the final one
-        nl0 = flam.shape[axis]
-        flam, self.lam = self.filters.pad_spectrum(
-            spectrum=np.moveaxis(flam, axis, -1),
-            wavelength=lam, method='zero')
-        self.flam = np.moveaxis(flam, -1, axis)
-        if self.flam.shape[axis] > nl0:
+        self.response = response_matrix(lam, family=family, redshift=redshift)
+        self.filters = self.response.filters
+        self.lam = lam
+        self.flam = flam
+
+        if self.response.padded:
             warn('spectrum has been padded, bad mags possible',
                  Spec2PhotWarning)
 
-        self.ABmags = self.filters.get_ab_magnitudes(
-            spectrum=self.flam, wavelength=self.lam,
-            axis=axis).as_array()
+        self.ABmags = self.response.ABmags(flam, axis=axis)
 
     def color(self, b1, b2):
         return self.ABmags[b1] - self.ABmags[b2]
 
+class Photometry(object):
+    '''
+    AB magnitudes (keyed by filter name) in the form `Spec2Phot` gives them
+    '''
+    def __init__(self, ABmags):
+        self.ABmags = ABmags
+
+    def color(self, b1, b2):
+        return self.ABmags[b1] - self.ABmags[b2]
+
+class PCPhotometry(object):
+    '''
+    photometry of spectra reconstructed from principal components
+
+    band flux is linear in the spectrum, so a spectrum norm * (A . E + M)
+        has maggies norm * (A . R_E + R_M), where R_E and R_M (the maggies
+        of each PC and of the mean) are found once: photometry
+        of whole maps, or of spaxels from many galaxies, needs no spectra
+
+    params:
+     - lam: wavelength grid of PCs (with units)
+     - E: q-by-nl array of PCs
+     - M: length-nl mean spectrum
+     - flam_unit: flux-density unit of reconstructed spectra
+     - family, redshift: as for `Spec2Phot`
+    '''
+    def __init__(self, lam, E, M, flam_unit, family='sdss2010-*', redshift=None):
+
+        self.response = response_matrix(lam, family=family, redshift=redshift)
+        self.filters = self.response.filters
+        self.names = self.response.names
+
+        if self.response.padded:
+            warn('spectrum has been padded, bad mags possible',
+                 Spec2PhotWarning)
+
+        basis = np.concatenate([np.atleast_2d(E), np.atleast_2d(M)], axis=0)
+        # (nbands, q) and (nbands, )
+        R = self.response.maggies(basis * flam_unit, axis=-1)
+        self.R_E, self.R_M = R[:, :-1], R[:, -1]
+
+    def maggies(self, A, norm, axis=0):
+        '''
+        maggies in each band (along a new leading axis) of spectra with
+            PC amplitudes `A` (PCs along `axis`) and normalization `norm`
+            (shaped like `A` without `axis`)
+        '''
+        A = np.moveaxis(np.asarray(A), axis, 0)
+        f = np.tensordot(self.R_E, A, axes=(1, 0))
+        f += self.R_M.reshape((-1, ) + (1, ) * (f.ndim - 1))
+        f *= np.asarray(norm)[None, ...]
+        return f
+
+    def ABmags(self, A, norm, axis=0):
+        '''
+        AB magnitudes of spectra (see `maggies`), keyed by filter name
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mags = -2.5 * np.log10(self.maggies(A, norm, axis=axis))
+        return dict(zip(self.names, mags))
+
+    def photometry(self, A, norm, axis=0):
+        '''
+        `Photometry` of spectra (see `maggies`), usable where a `Spec2Phot`
+            of the reconstructed spectra would be
+        '''
+        return Photometry(self.ABmags(A, norm, axis=axis))
+
 def l_eff(lam, band):
     '''
     Calculate the effective (pivot) wavelength of a response function
@@ -24,14 +24,17 @@ import os
 import sys
 from glob import glob
 from functools import partial
+import multiprocessing as mpc
 
 # sklearn
 from sklearn.neighbors import KNeighborsRegressor
+from scipy.spatial import cKDTree
 
 # local
 from importer import *
 import read_results
 import spectrophot
+import catalogs
 
 # personal
 import manga_tools as m
@@ -49,8 +52,6 @@ band_ix = dict(zip('FNugriz', range(len('FNugriz'))))
 sdss_bands = 'ugriz'
 nsa_bands = 'FNugriz'
 
-pca_system = read_results.PCASystem.fromfile(os.path.join(csp_basedir, 'pc_vecs.fits'))
-
 class Sigmoid(object):
     p0 = [70., .1, -5., 20.]
 
@@ -184,8 +185,7 @@ class StellarMass(object):
         results = read_results.PCAOutput.from_plateifu(basedir=res_basedir, plate=plate, ifu=ifu)
         drp = m.load_drp_logcube(plate, ifu, mpl_v)
         dap = m.load_dap_maps(plate, ifu, mpl_v, daptype)
-        drpall = m.load_drpall(mpl_v, 'plateifu')
-        drpall_row = drpall.loc['{}-{}'.format(plate, ifu)]
+        drpall_row = catalogs.drpall_arrays().row('{}-{}'.format(plate, ifu))
 
         return cls(results, pca_system, drp, dap, drpall_row, cosmo, mlband)
 
@@ -397,7 +397,7 @@ def mass_agg_onegal(res_fname, mlband, drpall):
     dap = res.get_dap_maps(mpl_v, daptype)
 
     stellarmass = StellarMass(
-        res, pca_system, drp, dap, drpall.loc[plateifu],
+        res, catalogs.pca_system(), drp, dap, drpall.row(plateifu),
         WMAP9, mlband=mlband)
 
     with catch_warnings():
@@ -411,6 +411,261 @@ def mass_agg_onegal(res_fname, mlband, drpall):
     return mass_table_new_entry
 
 
+# =====
+# batch mode: many galaxies at once, with spaxels of all galaxies in a chunk
+# concatenated along one axis (`gal` gives each spaxel's galaxy)
+
+# offset between galaxies along the KNN "galaxy" axis, larger than any
+# distance within one IFU, so neighbors are only found in the same galaxy
+knn_group_sep = 1.0e4
+
+def knn_infill(q, coords, good_trn, infer_here, k=8):
+    '''
+    replace `q` at `infer_here` with the mean of its `k` nearest neighbors
+        among `good_trn` (as `infer_masked`, but for spaxels of any number
+        of galaxies at once)
+
+    neighbors at equal distances may be chosen differently than by
+        `knn_regr`; where a galaxy has fewer than `k` training spaxels,
+        the result is NaN
+
+    params:
+     - q: values, one per spaxel
+     - coords: (nspax, 3) array of row, column, and galaxy number times
+       `knn_group_sep`
+     - good_trn: boolean array, True where `q` may be used for training
+     - infer_here: boolean array, True where `q` should be inferred
+    '''
+    q_final = np.array(q, dtype=float)
+    if not infer_here.any():
+        return q_final
+    if not good_trn.any():
+        q_final[infer_here] = np.nan
+        return q_final
+
+    tree = cKDTree(coords[good_trn])
+    _, nbrs = tree.query(coords[infer_here], k=k,
+                         distance_upper_bound=.5 * knn_group_sep)
+    # missing neighbors have index len(q_trn)
+    q_trn = np.append(q_final[good_trn], np.nan)
+    q_final[infer_here] = q_trn[nbrs].mean(axis=-1)
+
+    return q_final
+
+def group_median(x, groups, ngroups):
+    '''
+    median of `x` within each group (NaN for empty groups, or any with NaN)
+    '''
+    order = np.lexsort((x, groups))
+    x, groups = x[order], groups[order]
+    counts = np.bincount(groups, minlength=ngroups)
+    starts = np.cumsum(counts) - counts
+
+    med = np.full(ngroups, np.nan)
+    has = counts > 0
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    med[has] = .5 * (x[lo] + x[hi])
+    med[np.bincount(groups, weights=np.isnan(x), minlength=ngroups) > 0] = np.nan
+
+    return med
+
+def batch_inputs(res_fname, mlband='i'):
+    '''
+    everything `batch_to_table` needs from one galaxy's results, DRP, and
+        DAP files, as flattened maps
+    '''
+    with read_results.PCAOutput.from_fname(res_fname) as res:
+        plateifu = res[0].header['PLATEIFU']
+        with res.get_drp_logcube(mpl_v) as drp, \
+             res.get_dap_maps(mpl_v, daptype) as dap:
+            drpmask = drp['MASK'].data
+            low_or_no_cov = m.mask_from_maskbits(drpmask, [0, 1]).mean(axis=0) > .3
+            drp3dmask_interior = m.mask_from_maskbits(drpmask, [2, 3]).mean(axis=0) > .3
+            reff, phi = np.array(dap['SPX_ELLCOO'].data[1:3])
+
+        badpdf = res.cubechannel('GOODFRAC', 2) < 1.0e-4
+        ml_mask = np.logical_or(res.mask, badpdf)
+        calpha = np.array(res.getdata('CALPHA'))
+        inputs = {'A': calpha.reshape(len(calpha), -1),
+                  'norm': np.array(res.getdata('NORM')).ravel(),
+                  'ml0': np.array(res.cubechannel('ML{}'.format(mlband), 0)).ravel()}
+
+    inputs.update(
+        {'plateifu': plateifu, 'shape': badpdf.shape,
+         'badpdf': badpdf.ravel(), 'ml_mask': ml_mask.ravel(),
+         'low_or_no_cov': low_or_no_cov.ravel(),
+         'drp3dmask_interior': drp3dmask_interior.ravel(),
+         'reff': reff.ravel(), 'phi': phi.ravel()})
+    return inputs
+
+def batch_to_table(inputs, pca_system, drpall, cosmo=cosmo, mlband='i',
+                   ba_th=.35, azi_th=30.):
+    '''
+    table of stellar-mass results of many galaxies, with the columns of
+        `StellarMass.to_table` (with the default ring selection)
+
+    params:
+     - inputs: list of outputs of `batch_inputs`
+     - pca_system: `read_results.PCASystem`
+     - drpall: `catalogs.CatalogArrays` of drpall
+     - ba_th, azi_th: minor-to-major axis ratio below which the outer
+       M/L ring is restricted to within `azi_th` degrees of the major axis
+    '''
+    bands = StellarMass.bands
+    mlb = StellarMass.bands_ixs[mlband]
+    absmag_sun = StellarMass.absmag_sun.value[:, None]
+
+    ngal = len(inputs)
+    plateifus = [d['plateifu'] for d in inputs]
+    nspax = np.array([d['norm'].size for d in inputs])
+    gal = np.repeat(np.arange(ngal), nspax)
+    starts = np.cumsum(nspax) - nspax
+
+    def cat(k):
+        return np.concatenate([d[k] for d in inputs], axis=-1)
+
+    ii, jj = np.concatenate(
+        [np.indices(d['shape']).reshape(2, -1) for d in inputs], axis=1)
+    coords = np.column_stack([ii, jj, gal * knn_group_sep]).astype(float)
+
+    cat_rows = drpall.take(
+        plateifus, ['nsa_zdist', 'nsa_elpetro_ba', 'nsa_elpetro_absmag'])
+    distmod = cosmo.distmod(cat_rows['nsa_zdist']).value
+    dm = distmod[gal]
+
+    # photometry of all spaxels of all galaxies
+    pcphot = pca_system.pc_photometry()
+    band_ixs = [pcphot.names.index('sdss2010-{}'.format(b)) for b in bands]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mags = -2.5 * np.log10(pcphot.maggies(cat('A'), cat('norm'))[band_ixs])
+
+    # infer values in interior spaxels affected by bad PDF, foreground
+    # star, or dead fiber (see `StellarMass`)
+    low_or_no_cov, interior = cat('low_or_no_cov'), cat('drp3dmask_interior')
+    nolight = ~np.isfinite(mags)
+    for i in range(len(bands)):
+        mags[i] = knn_infill(
+            mags[i], coords, infer_here=interior,
+            good_trn=~np.logical_or.reduce((low_or_no_cov, interior, nolight[i])))
+    mags[nolight] = np.inf
+
+    ml0, ml_mask = cat('ml0'), cat('ml_mask')
+    logml = knn_infill(ml0, coords, good_trn=~ml_mask,
+                       infer_here=np.logical_or(cat('badpdf'), interior))
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        flux = 10.**(-0.4 * mags)
+        logsollum = -0.4 * (mags - dm - absmag_sun)
+        mstar = 10.**(logsollum[mlb] + logml)
+        mass_in_ifu = np.bincount(gal, weights=mstar, minlength=ngal)
+        ifu_flux = np.stack([np.bincount(gal, weights=f, minlength=ngal)
+                             for f in flux])
+
+        wt = flux[mlb] * ~ml_mask
+        ml_fluxwt = np.bincount(gal, weights=wt * logml, minlength=ngal) / \
+                    np.bincount(gal, weights=wt, minlength=ngal)
+
+        # flux beyond the IFU
+        nsa_absmag = (cat_rows['nsa_elpetro_absmag'][:, [band_ix[b] for b in bands]].T * \
+                      (u.ABmag - u.MagUnit(u.littleh**2))).to(
+                          u.ABmag, u.with_H0(cosmo.H0)).value
+        missing_flux = (10.**(-0.4 * (nsa_absmag + distmod)) - ifu_flux).clip(min=0.)
+        nomissing = (missing_flux <= 0.)
+        outer_absmag = np.where(nomissing, np.inf,
+                                -2.5 * np.log10(missing_flux) - distmod)
+        outer_lum = np.where(nomissing, -np.inf,
+                             -0.4 * (outer_absmag - absmag_sun))
+
+    # "ring" aperture-correction: median M/L of spaxels within .5 Re of the
+    # outermost one; as in `StellarMass.ml_ring`, the azimuthal selection
+    # only determines where that outermost spaxel is
+    phi = cat('phi')
+    angle_from_majoraxis = np.minimum.reduce(
+        (np.abs(phi), np.abs(180. - phi), np.abs(360. - phi)))
+    close_to_majaxis = np.logical_or(
+        (cat_rows['nsa_elpetro_ba'] > ba_th)[gal], angle_from_majoraxis < azi_th)
+    reff = cat('reff')
+    reff_max = np.maximum.reduceat(
+        np.where(~ml_mask & close_to_majaxis, reff, -np.inf), starts)[gal]
+    outer_ring = ~ml_mask & (reff <= reff_max) & (reff >= reff_max - .5)
+    outer_ml_ring = group_median(ml0[outer_ring], gal[outer_ring], ngal)
+
+    tab = t.QTable()
+    tab['plateifu'] = plateifus
+    tab['mass_in_ifu'] = mass_in_ifu * u.Msun
+    for i, b in enumerate(bands):
+        tab['outer_absmag_{}'.format(b)] = outer_absmag[i] * u.ABmag
+        tab['outer_lum_{}'.format(b)] = outer_lum[i] * u.dex(m.bandpass_sol_l_unit)
+    tab['outer_ml_ring'] = outer_ml_ring * u.dex(m.m_to_l_unit)
+    tab['ml_fluxwt'] = ml_fluxwt * u.dex(m.m_to_l_unit)
+    tab['distmod'] = distmod * u.mag
+
+    return tab
+
+def _batch_task(res_fname, mlband):
+    '''
+    `batch_inputs` of one galaxy (in a worker), or None and the error
+    '''
+    try:
+        inputs = batch_inputs(res_fname, mlband=mlband)
+        if inputs['plateifu'] not in catalogs.drpall_arrays():
+            raise KeyError('{} not in drpall'.format(inputs['plateifu']))
+    except (SystemExit, KeyboardInterrupt) as e:
+        raise e
+    except Exception as e:
+        return res_fname, None, repr(e)
+    return res_fname, inputs, None
+
+def aggregate_batch(res_fnames, mlband='i', chunk_size=64, processes=None,
+                    cosmo=cosmo):
+    '''
+    mass table (as `StellarMass.to_table`) of many galaxies, found in
+        chunks of `chunk_size` galaxies by `batch_to_table`
+
+    inputs are read by a pool of `processes` workers (forked once PC
+        photometry and drpall are loaded; 1 reads in this process);
+        galaxies that cannot be read are reported, and left out
+
+    returns table, or None if no galaxies could be read
+    '''
+    pca_system = catalogs.pca_system()
+    pca_system.pc_photometry()
+    drpall = catalogs.drpall_arrays()
+
+    task = partial(_batch_task, mlband=mlband)
+    pool = None if processes == 1 else mpc.get_context('fork').Pool(processes)
+    loaded = map(task, res_fnames) if pool is None else \
+             pool.imap(task, res_fnames, chunksize=4)
+
+    tabs, chunk, errors = [], [], {}
+    try:
+        for i, (res_fname, inputs, error) in enumerate(loaded):
+            if inputs is None:
+                errors[res_fname] = error
+            else:
+                chunk.append(inputs)
+            if (len(chunk) == chunk_size) or \
+               ((i == len(res_fnames) - 1) and chunk):
+                with catch_warnings():
+                    simplefilter('ignore')
+                    tabs.append(batch_to_table(
+                        chunk, pca_system, drpall, cosmo=cosmo, mlband=mlband))
+                chunk = []
+            print('{:^6} / {:^6} completed'.format(i + 1, len(res_fnames)), end='\r')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    for res_fname, error in errors.items():
+        print('{}: {}'.format(res_fname, error))
+
+    if not tabs:
+        return None
+    return t.vstack(tabs)
+
+
 def update_mass_table(res_fnames, mlband='i'):
     '''
     '''
@@ -458,7 +713,6 @@ def chunks(l, nchunks):
         yield l[i::nchunks]
 
 if __name__ == '__main__':
-    drpall = m.load_drpall(mpl_v, 'plateifu')
     mlband = 'i'
 
     mass_table_fname = os.path.join(csp_basedir, 'mass_table.fits')
@@ -466,14 +720,7 @@ if __name__ == '__main__':
     # what galaxies are available to aggregate?
     res_fnames = glob(os.path.join(csp_basedir, 'results/*-*/*-*_res.fits'))
 
-    mass_table = None
-    for i, rfn in enumerate(res_fnames): 
-        if mass_table is None:
-            mass_table = mass_agg_onegal(rfn, mlband, drpall)
-        else:
-            mass_table.add_row(mass_agg_onegal(rfn, mlband, drpall)[0])
-
-        print('{:^6} / {:^6} completed'.format(i + 1, len(res_fnames)), end='\r')
+    mass_table = aggregate_batch(res_fnames, mlband)
 
     cmlr = cmlr_kwargs
     
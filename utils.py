@@ -241,6 +241,17 @@ class MaNGA_LSF(object):
 
         return cls(LSF_R_obs_gpr=regressor, **kwargs)
 
+    def signature(self, lam=np.linspace(3500., 10500., 201)):
+        '''
+        hash of the spectral resolution predicted on a fixed grid
+            (identifies this LSF in cache keys)
+        '''
+        import hashlib
+
+        specres = self.LSF_R_obs_gpr.predict(np.atleast_2d(lam).T)
+        return hashlib.sha1(
+            np.round(specres, 6).astype(np.float64).tobytes()).hexdigest()
+
     def __call__(self, lam, dlogl, y, z):
         '''
         performs convolution with LSF appropriate to a given redshift
@@ -281,12 +292,17 @@ class MedianSpecScaler(object):
     '''
     scale spectra to unit median
     '''
-    def __init__(self, X):
+    def __init__(self, X=None):
         '''
         params:
-         - X (nspec, nl): array of spectra
+         - X (nspec, nl): array of spectra (if None, the scaler is only
+            used to scale new data, e.g., when loaded with a stored basis)
         '''
 
+        if X is None:
+            self.X_sc = None
+            return
+
         med = np.median(X, axis=1, keepdims=True)
         self.X_sc = X / med
 
@@ -333,11 +349,97 @@ class KPCGen(object):
         return (self.E @ (kspec) @ self.E.T)
 
 
-def interp_large(x0, y0, xnew, axis, nchunks=1, **kwargs):
+class LinearResampler(object):
+    '''
+    linear interpolation from a fixed grid `x0` onto a fixed grid `xnew`,
+        along the last axis
+
+    the bracketing indices and weights are computed once, and then applied
+        to (nspec, nl) blocks of rows sized to fit in `block_bytes`, writing
+        into a preallocated output. Suited to resampling many spectra from
+        one uniform log-lambda grid onto another
+    '''
+    def __init__(self, x0, xnew):
+        x0, xnew = np.asarray(x0), np.asarray(xnew)
+
+        if np.any(np.diff(x0) <= 0.):
+            raise ValueError('x0 must be strictly increasing')
+        if (xnew.min() < x0[0]) or (xnew.max() > x0[-1]):
+            raise ValueError('A value in xnew is outside the range of x0')
+
+        self.n0, self.nnew = len(x0), len(xnew)
+
+        # left-hand bracketing index and weight of right-hand neighbor
+        self.ix = (np.searchsorted(x0, xnew, side='right') - 1).clip(
+            0, self.n0 - 2)
+        self.wt = (xnew - x0[self.ix]) / (x0[self.ix + 1] - x0[self.ix])
+
+    def rows_per_block(self, block_bytes, itemsize=8):
+        # three (nrows, nnew) arrays live at once: two neighbors & output
+        return max(1, int(block_bytes // (3 * self.nnew * itemsize)))
+
+    def _apply_block(self, y, out):
+        yl = np.take(y, self.ix, axis=-1)
+        yr = np.take(y, self.ix + 1, axis=-1)
+        yr -= yl
+        yr *= self.wt
+        np.add(yl, yr, out=out)
+
+    def __call__(self, y, out=None, block_bytes=2**28, threads=1):
+        '''
+        resample `y` (shape (nspec, n0)) into `out` (shape (nspec, nnew))
+
+        params:
+         - block_bytes: approximate working memory per block
+         - threads: number of blocks processed concurrently
+        '''
+        if y.shape[-1] != self.n0:
+            raise ValueError('last axis of y has length {}, expected {}'.format(
+                y.shape[-1], self.n0))
+
+        nspec = y.shape[0]
+        if out is None:
+            out = np.empty((nspec, self.nnew), dtype=np.result_type(y, self.wt))
+
+        nper = self.rows_per_block(block_bytes, out.itemsize)
+        blocks = [slice(i, min(i + nper, nspec)) for i in range(0, nspec, nper)]
+
+        def do_block(sl):
+            self._apply_block(y[sl], out[sl])
+
+        if (threads is None) or (threads > 1):
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=threads) as ex:
+                list(ex.map(do_block, blocks))
+        else:
+            for sl in blocks:
+                do_block(sl)
+
+        return out
+
+
+def interp_large(x0, y0, xnew, axis, nchunks=1, block_bytes=2**28, threads=1,
+                 **kwargs):
     '''
     large-array-tolerant interpolation
+
+    plain linear interpolation onto a 1-d grid uses `LinearResampler`, with
+        working memory bounded by `block_bytes`; anything else falls back to
+        `interp1d` over chunks of `xnew`, doubling the number of chunks
+        whenever a MemoryError is raised
     '''
 
+    xnew = np.asarray(xnew)
+
+    if (set(kwargs) <= {'kind'}) and (kwargs.get('kind', 'linear') == 'linear') \
+        and (xnew.ndim == 1):
+        y0_ = np.moveaxis(y0, axis, -1)
+        ishape = y0_.shape[:-1]
+        resampler = LinearResampler(x0=x0, xnew=xnew)
+        ynew = resampler(y0_.reshape((-1, y0_.shape[-1])),
+                         block_bytes=block_bytes, threads=threads)
+        return np.moveaxis(ynew.reshape(ishape + (len(xnew), )), -1, axis)
+
     success = False
 
     specs_interp = interp1d(x=x0, y=y0, axis=axis, **kwargs)
@@ -349,7 +451,7 @@ def interp_large(x0, y0, xnew, axis, nchunks=1, **kwargs):
             ynew = np.concatenate(
                 [specs_interp(xc) for xc in xchunks], axis=axis)
         except MemoryError:
-            nchunks += 1
+            nchunks *= 2
         else:
             success = True
 
@@ -676,6 +778,47 @@ def ba_to_i_holmberg(ba, alpha=0.2):
     return i
 
 
+def reset_peak_rss():
+    '''
+    reset this process's peak resident set size, so that `peak_rss` reports
+        the peak since now (Linux only; returns whether it was reset)
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def peak_rss():
+    '''
+    peak resident set size (bytes) of this process, since start or since
+        last `reset_peak_rss`
+    '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_rss():
+    '''
+    current resident set size (bytes) of this process
+    '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return peak_rss()
+
+
 class LogcubeDimError(Exception):
     def __init__(self, *args, **kwargs):
         super().__init__()